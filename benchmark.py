@@ -0,0 +1,317 @@
+import multiprocessing
+import random
+import sys
+import time
+from rdtp import rdtp_common
+from rdtp.rdtp_async_client import AsyncRDTPClient
+from rdtp import rdtp_async_client
+from chat.chat_db import ChatDB
+
+HOST, PORT = "localhost", 9999
+
+# Seconds without any delivery after which the fan-out benchmark stops waiting
+IDLE_TIMEOUT = 5
+
+# The MongoDB database the lookup benchmark fills, and drops when it is done
+BENCHMARK_DATABASE = 'chat_benchmark'
+
+def usage():
+    """
+    Simple usage function that is printed when the command line arguments
+    are not valid.
+    """
+    print "Usage: python benchmark.py <protocol|load [clients] [messages]|fanout [processes] [clients] [messages]|db [users] [lookups]>"
+    exit()
+
+def protocol_workload():
+    """
+    Builds a representative mix of RDTP traffic: many small send_user
+    requests, and a few large fetch results and get_users listings.
+
+    :return: A list of (action, status, args) tuples.
+    """
+    workload = []
+
+    for i in range(500):
+        workload.append(('send_user', 0, ['QWERTYUIOPAS', 'bob', 'hey bob, message number {}'.format(i)]))
+        workload.append(('R', 0, []))
+
+    for i in range(20):
+        messages = ['alice @ cs262 >>> this is message {} of the day'.format(j) for j in range(50)]
+        workload.append(('fetch', 0, ['QWERTYUIOPAS']))
+        workload.append(('R', 0, ['\n'.join(messages)]))
+
+    for i in range(20):
+        workload.append(('get_users', 0, ['.*']))
+        workload.append(('R', 0, ['user{}'.format(j) for j in range(200)]))
+
+    return workload
+
+def benchmark_protocol():
+    """
+    Encodes and decodes the protocol workload with every combination of the
+    optional RDTP features, and reports the bytes on the wire and the time spent.
+    """
+    workload = protocol_workload()
+    configurations = [
+        ('strings', []),
+        ('opcodes', [rdtp_common.FEATURE_OPCODES]),
+        ('opcodes+fields', [rdtp_common.FEATURE_OPCODES, rdtp_common.FEATURE_FIELDS]),
+        ('opcodes+fields+zlib', [rdtp_common.FEATURE_OPCODES, rdtp_common.FEATURE_FIELDS,
+                                 rdtp_common.FEATURE_COMPRESSION]),
+    ]
+
+    print "{} frames".format(len(workload))
+    print "{:<22}{:>12}{:>10}{:>14}{:>14}".format('features', 'bytes', 'saved', 'encode (ms)', 'decode (ms)')
+
+    baseline = None
+    for name, features in configurations:
+        encoder = rdtp_common.FrameEncoder()
+        encoder.opcodes = rdtp_common.FEATURE_OPCODES in features
+        encoder.fields = rdtp_common.FEATURE_FIELDS in features
+        if rdtp_common.FEATURE_COMPRESSION in features:
+            encoder.compress()
+
+        start = time.time()
+        frames = [encoder.encode(action, status, args) for action, status, args in workload]
+        encode_time = time.time() - start
+
+        wire = str(bytearray().join(segment for frame in frames for segment in frame))
+
+        decoder = rdtp_common.FrameDecoder()
+        start = time.time()
+        decoder.feed(wire)
+        decoded = decoder.frames()
+        decode_time = time.time() - start
+        assert(len(decoded) == len(workload))
+
+        if baseline is None:
+            baseline = len(wire)
+        saved = 100.0 * (baseline - len(wire)) / baseline
+
+        print "{:<22}{:>12}{:>9.1f}%{:>14.2f}{:>14.2f}".format(name, len(wire), saved,
+                                                             encode_time * 1000, decode_time * 1000)
+
+def benchmark_load(clients, messages):
+    """
+    Opens many sessions against a running RDTP server (python server.py RDTP)
+    from a single thread, and has every session send messages to random
+    other sessions, all pipelined. Reports the request throughput and how
+    many messages were delivered live.
+
+    :param clients: How many sessions to open
+    :param messages: How many messages each session sends
+    """
+    channel_map = {}
+    names = ['bench{}'.format(i) for i in range(clients)]
+    sessions = [AsyncRDTPClient(HOST, PORT, channel_map) for name in names]
+    progress = {'logged_in': 0, 'answered': 0}
+
+    def logged_in(status, response):
+        progress['logged_in'] += 1
+
+    def answered(status, response):
+        progress['answered'] += 1
+
+    start = time.time()
+    for session, name in zip(sessions, names):
+        session.create_account(name, 'bench')
+        session.login(name, 'bench', logged_in)
+    rdtp_async_client.run(channel_map, until=lambda: progress['logged_in'] == clients)
+    print "{} sessions logged in in {:.2f}s".format(clients, time.time() - start)
+
+    total = clients * messages
+    start = time.time()
+    for session in sessions:
+        for i in range(messages):
+            session.send_user(random.choice(names), 'load test message {}'.format(i), answered)
+    rdtp_async_client.run(channel_map, until=lambda: progress['answered'] == total)
+    elapsed = time.time() - start
+
+    delivered = sum(session.messages_received for session in sessions)
+    print "{} messages sent in {:.2f}s ({:.0f} requests/s), {} delivered live".format(total, elapsed,
+                                                                                   total / elapsed, delivered)
+
+def fanout_process(index, clients, messages, ready, go, results):
+    """
+    One process of the fan-out benchmark: opens its sessions, puts them all
+    in a group of their own, and once every process is ready, has each
+    session send messages to the group. Puts the number of messages delivered
+    live and the seconds it took on the results queue.
+    """
+    channel_map = {}
+    group_name = 'fanout{}-{}'.format(index, random.randint(0, 1 << 30))
+    names = ['{}-{}'.format(group_name, i) for i in range(clients)]
+    sessions = [AsyncRDTPClient(HOST, PORT, channel_map) for name in names]
+    progress = {'answered': 0}
+
+    def answered(status, response):
+        progress['answered'] += 1
+
+    for session, name in zip(sessions, names):
+        session.create_account(name, 'bench')
+        session.login(name, 'bench', answered)
+    rdtp_async_client.run(channel_map, until=lambda: progress['answered'] == clients)
+
+    # Only once every account exists, as they were created over other connections
+    sessions[0].request(answered, 'create_group', group_name)
+    sessions[0].add_users_to_group(names, group_name, answered)
+    rdtp_async_client.run(channel_map, until=lambda: progress['answered'] == clients + 2)
+
+    ready.put(index)
+    go.wait()
+
+    progress['answered'] = 0
+    total = clients * messages
+    expected = total * clients
+    start = time.time()
+    for session in sessions:
+        for i in range(messages):
+            session.send_group(group_name, 'fan-out test message {}'.format(i), answered)
+
+    # Deliveries a slow consumer policy spilled never arrive, so give up
+    # on them once the traffic stops
+    last = {'delivered': 0, 'time': start}
+    def done():
+        delivered = sum(session.messages_received for session in sessions)
+        if delivered != last['delivered']:
+            last['delivered'] = delivered
+            last['time'] = time.time()
+        if progress['answered'] == total and delivered == expected:
+            return True
+        return time.time() - last['time'] > IDLE_TIMEOUT
+    rdtp_async_client.run(channel_map, until=done)
+
+    results.put((last['delivered'], last['time'] - start))
+
+def benchmark_fanout(processes, clients, messages):
+    """
+    Measures group fan-out against a running RDTP server (python server.py
+    RDTP [--workers N]). Each of several client processes opens many sessions,
+    all members of one group, and has every session send messages to the
+    group, so every message is delivered to every session of the process.
+    Reports the deliveries per second over all processes.
+
+    Run it against servers with different numbers of workers to see the
+    throughput scale with the cores: use at least as many processes as
+    workers, so that the clients are not the bottleneck.
+
+    :param processes: How many client processes to run
+    :param clients: How many sessions each process opens
+    :param messages: How many messages each session sends
+    """
+    ready = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=fanout_process, args=(index, clients, messages, ready, go, results))
+               for index in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        ready.get()
+
+    go.set()
+    outcomes = [results.get() for worker in workers]
+    for worker in workers:
+        worker.join()
+
+    delivered = sum(count for count, seconds in outcomes)
+    elapsed = max(seconds for count, seconds in outcomes)
+
+    expected = processes * clients * messages * clients
+    print "{} of {} group messages delivered in {:.2f}s ({:.0f} deliveries/s)".format(delivered, expected,
+                                                                                elapsed, delivered / elapsed)
+
+def benchmark_user(i):
+    """
+    A user document of the lookup benchmark, as ChatDB keeps them, logged in.
+    """
+    return {
+        'username': 'bench{}'.format(i),
+        'password': 'bench',
+        'groups': [],
+        'logged_in': True,
+        'session_token': 'TOKEN{:07d}'.format(i),
+    }
+
+def benchmark_db(users, lookups):
+    """
+    Measures the latency of ChatDB lookups (by username and by session token)
+    against a local MongoDB as the number of users grows, with the indexes of
+    ChatDB and without any. Fills a database of its own, BENCHMARK_DATABASE,
+    and drops it when done.
+
+    :param users: The most users to measure with. The benchmark starts at 1000,
+    and grows tenfold up to this number.
+    :param lookups: How many lookups of each kind to time at every size
+    """
+    chat_db = ChatDB(BENCHMARK_DATABASE)
+    collection = chat_db.userCollection
+    collection.drop()
+
+    sizes = []
+    size = 1000
+    while size < users:
+        sizes.append(size)
+        size *= 10
+    sizes.append(users)
+
+    print "{:>10}{:>10}{:>18}{:>18}{:>18}".format('users', 'indexes', 'user_exists (ms)', 'is_online (ms)',
+                                                 'session (ms)')
+
+    count = 0
+    try:
+        for size in sizes:
+            while count < size:
+                batch = min(1000, size - count)
+                collection.insert_many([benchmark_user(i) for i in range(count, count + batch)])
+                count += batch
+
+            for indexed in (True, False):
+                if indexed:
+                    chat_db.ensure_indexes()
+                else:
+                    collection.drop_indexes()
+
+                picks = [random.randrange(size) for i in range(lookups)]
+                timings = []
+                for lookup in (lambda i: chat_db.user_exists('bench{}'.format(i)),
+                               lambda i: chat_db.is_online('bench{}'.format(i)),
+                               lambda i: chat_db.username_for_session_token('TOKEN{:07d}'.format(i))):
+                    start = time.time()
+                    for i in picks:
+                        lookup(i)
+                    timings.append((time.time() - start) * 1000 / lookups)
+
+                print "{:>10}{:>10}{:>18.3f}{:>18.3f}{:>18.3f}".format(size, 'yes' if indexed else 'no', *timings)
+    finally:
+        collection.database.client.drop_database(BENCHMARK_DATABASE)
+
+def main():
+    """
+    Main routine of the program. Runs the benchmark named by the single
+    command line argument.
+    """
+    if len(sys.argv) < 2:
+        usage()
+
+    if sys.argv[1] == 'protocol':
+        benchmark_protocol()
+    elif sys.argv[1] == 'load':
+        clients = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        messages = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+        benchmark_load(clients, messages)
+    elif sys.argv[1] == 'fanout':
+        processes = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+        clients = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+        messages = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+        benchmark_fanout(processes, clients, messages)
+    elif sys.argv[1] == 'db':
+        users = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        lookups = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+        benchmark_db(users, lookups)
+    else:
+        usage()
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 from functools import wraps
 import cmd
 
+# Messages asked for at once by clients that fetch their messages in pages
+FETCH_PAGE = 100
+
 def check_authorization(f):
     """
     Wrapper that checks if the user is logged in.
@@ -113,6 +116,33 @@ class ChatClient(cmd.Cmd):
             else:
                 print "User {} added to group {} successfully.".format(username, group_id)
 
+    @check_authorization
+    def do_add_users_to_group(self, params):
+        """
+        Adds many users to a specified group at once. Assumes user is logged in.
+
+        :param params: The parameters passed in to the command line interface,
+        which have to be broken down into group_id and usernames (separated by spaces)
+        """
+
+        if len(params.split()) < 2:
+            print "The appropriate command format is: add_users_to_group [group] [username] ..."
+        else:
+            group_id = params.split()[0]
+            usernames = params.split()[1:]
+
+            response = self.add_users_to_group(usernames, group_id)
+            if response == 1:
+                print "Your session has expired."
+            elif response == 2:
+                print "Could not add users to group {}. Please, try again.".format(group_id)
+            elif response == 3:
+                print "Server timed out. Are you connected?"
+            elif response:
+                print "Users added to group {}, except {}, which do not exist.".format(group_id, ', '.join(response))
+            else:
+                print "Users added to group {} successfully.".format(group_id)
+
     def do_login(self, params):
         """
         Login with credentials.
@@ -1,9 +1,63 @@
+import logging
 import socket
 import select
-from pymongo import MongoClient
-from random import choice
+from random import SystemRandom
 from string import ascii_uppercase
 import re
+import time
+
+try:
+    from pymongo import MongoClient
+    from pymongo import ReturnDocument
+    from pymongo.errors import DuplicateKeyError
+    from pymongo.errors import OperationFailure
+except ImportError:
+    # Only the MongoDB backend (ChatDB) needs pymongo
+    MongoClient = None
+
+log = logging.getLogger(__name__)
+
+# Storage backends a server can run on (see open_chat_db)
+BACKEND_MONGO = 'mongo'
+BACKEND_MEMORY = 'memory'
+BACKEND_SQLITE = 'sqlite'
+BACKENDS = (BACKEND_MONGO, BACKEND_MEMORY, BACKEND_SQLITE)
+DEFAULT_BACKEND = BACKEND_MONGO
+
+# The MongoDB database ChatDB keeps its collections in
+CHAT_DATABASE = 'chat_server'
+
+# Indexes ChatDB makes sure exist on startup, as (keys, options) by collection.
+# Without them, every lookup by username, group name or session token is a
+# collection scan. Only logged in users have a session token (see
+# ChatDB.logout), so its index is sparse.
+USER_INDEXES = [
+    ([('username', 1)], {'unique': True}),
+    ([('session_token', 1)], {'sparse': True}),
+    # For finding the members of groups (see ChatDB.get_users_in_group)
+    ([('groups', 1)], {}),
+]
+GROUP_INDEXES = [
+    ([('name', 1)], {'unique': True}),
+]
+MESSAGE_INDEXES = [
+    ([('recipient', 1), ('seq', 1)], {'unique': True}),
+]
+
+# The fields of a queued message that ChatDB hands out
+MESSAGE_FIELDS = {'seq': True, 'message': True, 'from_username': True, 'from_group_name': True, '_id': False}
+
+# Most messages taken out of a queue at once (see ChatDB.drain_user_message_queue)
+DRAIN_BATCH = 500
+
+# Seconds after which messages claimed by a drain that never deleted them may
+# be claimed again (see ChatDB.drain_user_message_queue)
+DRAIN_CLAIM_TIMEOUT = 60
+
+# Messages in a page of a queue, unless asked for otherwise, and the most
+# that may be asked for (see ChatDB.fetch_user_messages)
+FETCH_LIMIT = 100
+MAX_FETCH_LIMIT = 1000
 
 ################
 ## EXCEPTIONS ##
@@ -72,11 +126,121 @@ class GroupDoesNotExist(Exception):
     def __str__(self):
         return "Group {} does not exist.".format(self.group_id)
 
+######################
+## STORAGE BACKENDS ##
+######################
+
+def open_chat_db(backend=DEFAULT_BACKEND, path=None):
+    """
+    Opens a storage backend by name.
+
+    :param backend: One of BACKENDS. Defaults to DEFAULT_BACKEND (MongoDB).
+    :param path: The database file, for backends that keep one (sqlite). Defaults to None,
+                 for the default file of the backend.
+    :return: A ChatDBBackend.
+    :raises: ValueError if there is no such backend.
+    """
+
+    if backend == BACKEND_MONGO:
+        return ChatDB()
+    if backend == BACKEND_MEMORY:
+        from chat_db_memory import MemoryChatDB
+        return MemoryChatDB()
+    if backend == BACKEND_SQLITE:
+        from chat_db_sqlite import SQLiteChatDB
+        return SQLiteChatDB(path) if path else SQLiteChatDB()
+    raise ValueError("Unknown storage backend: {}".format(backend))
+
+session_random = SystemRandom()
+
+def new_session_token():
+    """
+    Makes up a session token for a login. Drawn from the randomness of the
+    operating system, since forked workers share the state of the random module.
+    """
+    return ''.join(session_random.choice(ascii_uppercase) for i in range(12))
+
+class ChatDBBackend(object):
+    """
+    The storage interface ChatServer is written against. ChatDB implements
+    it on MongoDB, MemoryChatDB (chat_db_memory) in plain Python dictionaries,
+    and SQLiteChatDB (chat_db_sqlite) in an embedded SQLite database; see
+    ChatDB for what each method takes, returns and raises.
+
+    Every backend may be called from several threads at once.
+    """
+
+    def create_account(self, username, password):
+        raise NotImplementedError()
+
+    def login(self, username, password, kickout_method = None):
+        raise NotImplementedError()
+
+    def user_exists(self, username):
+        raise NotImplementedError()
+
+    def is_online(self, username):
+        raise NotImplementedError()
+
+    def needs_kickout(self, username, password):
+        raise NotImplementedError()
+
+    def logout(self, username, session_token=None):
+        raise NotImplementedError()
+
+    def users_online(self):
+        raise NotImplementedError()
+
+    def online_users(self, usernames):
+        raise NotImplementedError()
+
+    def delete_account(self, username):
+        raise NotImplementedError()
+
+    def username_for_session_token(self, session_token):
+        raise NotImplementedError()
+
+    def get_users(self, query):
+        raise NotImplementedError()
+
+    def create_group(self, group_name):
+        raise NotImplementedError()
+
+    def get_users_in_group(self, group_name):
+        raise NotImplementedError()
+
+    def add_user_to_group(self, username, group_name):
+        raise NotImplementedError()
+
+    def add_users_to_group(self, usernames, group_name):
+        raise NotImplementedError()
+
+    def get_groups(self, query):
+        raise NotImplementedError()
+
+    def queue_message(self, message, from_username, username, group_name = None):
+        raise NotImplementedError()
+
+    def queue_messages(self, message, from_username, usernames, group_name = None):
+        raise NotImplementedError()
+
+    def get_user_queued_messages(self, username, limit=None):
+        raise NotImplementedError()
+
+    def clear_user_message_queue(self, username):
+        raise NotImplementedError()
+
+    def drain_user_message_queue(self, username, limit=DRAIN_BATCH):
+        raise NotImplementedError()
+
+    def fetch_user_messages(self, username, since=0, limit=FETCH_LIMIT):
+        raise NotImplementedError()
+
 ################
 ## DB MANAGER ##
 ################
 
-class ChatDB(object):
+class ChatDB(ChatDBBackend):
     """
     Handles all database related actions for the application.
     Anything that involves persistance across application launches is
@@ -85,18 +249,84 @@ class ChatDB(object):
     Server subclasses will call into ChatDB in order to complete their actions.
     Therefore, the application workflow is:
         client -> server -> chat_db -> server -> client
+
+    This is the MongoDB backend, and the default one (see open_chat_db).
     """
 
-    def __init__(self):
+    def __init__(self, database=CHAT_DATABASE):
         """
         Initializes a ChatDB on the given host and port.
         Sets up the underlying MongoClient that is used
-        for all database-related tasks.
+        for all database-related tasks, and the indexes
+        of the collections.
+
+        :param database: The name of the MongoDB database. Defaults to CHAT_DATABASE.
+        :raises: ImportError if pymongo is not installed.
         """
+        if MongoClient is None:
+            raise ImportError("The MongoDB backend needs pymongo (pip install pymongo).")
+
         client = MongoClient()
-        db = client.chat_server
+        db = client[database]
         self.userCollection = db.users
         self.groupCollection = db.groups
+        # Queued messages live apart from their recipients (see queue_message)
+        self.messageCollection = db.messages
+        self.counterCollection = db.counters
+        # Ids of the groups looked up so far, by name (see group_id)
+        self.group_ids = {}
+        self.ensure_indexes()
+        self.migrate_message_queues()
+
+    def ensure_indexes(self):
+        """
+        Creates the indexes of USER_INDEXES, GROUP_INDEXES and MESSAGE_INDEXES that do not exist
+        yet (creating one that exists does nothing). An index that cannot be
+        built is logged; only a unique one keeps the server from starting,
+        since create_account and create_group rely on them to refuse
+        duplicates. Other indexes only make lookups faster, and are skipped.
+
+        :raises: OperationFailure if a unique index cannot be built, like over
+        duplicates left by an older version, which need removing first.
+        """
+        for collection, indexes in ((self.userCollection, USER_INDEXES), (self.groupCollection, GROUP_INDEXES),
+                                    (self.messageCollection, MESSAGE_INDEXES)):
+            for keys, options in indexes:
+                try:
+                    collection.create_index(keys, **options)
+                except OperationFailure:
+                    if options.get('unique'):
+                        log.critical("Could not create the unique index %s on %s, remove its duplicates first.",
+                                     keys, collection.name)
+                        raise
+                    log.exception("Could not create the index %s on %s.", keys, collection.name)
+
+    def migrate_message_queues(self):
+        """
+        Moves the messages older versions queued in the user documents
+        themselves (in messageQ) to the messages collection. Each queue is
+        taken out of its document atomically, so that servers starting at
+        the same time do not move it twice.
+        """
+        # Empty queues need nothing but removing
+        self.userCollection.update_many({'messageQ': {'$size': 0}}, {'$unset': {'messageQ': ''}})
+
+        for user in self.userCollection.find({'messageQ': {'$exists': True}}, {'_id': True}):
+            user = self.userCollection.find_one_and_update(
+                {'_id': user['_id'], 'messageQ': {'$exists': True}},
+                {'$unset': {'messageQ': ''}},
+                projection={'username': True, 'messageQ': True}
+            )
+            if user is None or not user['messageQ']:
+                continue
+
+            seq = self.next_sequence(len(user['messageQ']))
+            self.messageCollection.insert_many([
+                dict(queued_message, recipient=user['username'], seq=seq + i)
+                for i, queued_message in enumerate(user['messageQ'])
+            ])
+            log.info("Moved %s queued messages of %s to the messages collection.", len(user['messageQ']),
+                     user['username'])
 
     ##########
     ## USER ##
@@ -111,21 +341,18 @@ class ChatDB(object):
         :param password: The password for the new account.
         """
 
-        user = self.userCollection.find_one({"username": username})
-
-        if user is not None:
+        # The unique index on username turns away duplicates
+        try:
+            self.userCollection.insert_one(
+                {
+                    'username': username,
+                    'password': password,
+                    'groups': [],
+                    'logged_in': False
+                }
+            )
+        except DuplicateKeyError:
             raise UsernameExists(username)
-
-        self.userCollection.insert_one(
-            {
-                'username': username,
-                'password': password,
-                'groups': [],
-                'logged_in': False,
-                'session_token': None,
-                'messageQ': []
-            }
-        )
         return True
 
     def login(self, username, password, kickout_method = None):
@@ -144,7 +371,7 @@ class ChatDB(object):
         :return: tuple of (False, '') on failure, tuple of (True, session_token) on success.
         """
 
-        user = self.userCollection.find_one({'username': username})
+        user = self.userCollection.find_one({'username': username}, {'password': True, 'logged_in': True})
         if user is None:
             return False, ''
         if user['password'] == password:
@@ -152,7 +379,7 @@ class ChatDB(object):
                 # Kickout current user, so this guy can log in.
                 kickout_method(username)
 
-            session_token = ''.join(choice(ascii_uppercase) for i in range(12))
+            session_token = new_session_token()
             self.userCollection.update_one(
                 {"_id": user["_id"]},
                 {
@@ -174,7 +401,7 @@ class ChatDB(object):
         :return: True if user exists. False if no user exists with this username.
         """
 
-        user = self.userCollection.find_one({'username': username})
+        user = self.userCollection.find_one({'username': username}, {'_id': True})
         if user is None:
             return False
         return True
@@ -192,7 +419,7 @@ class ChatDB(object):
         :raises: UserKeyError if no user exists with this username.
         """
 
-        user = self.userCollection.find_one({'username': username})
+        user = self.userCollection.find_one({'username': username}, {'logged_in': True, '_id': False})
         if user is None:
             raise UserKeyError(username)
 
@@ -210,29 +437,41 @@ class ChatDB(object):
                  False otherwise.
         """
 
-        user = self.userCollection.find_one({'username': username})
+        user = self.userCollection.find_one({'username': username},
+                                            {'password': True, 'logged_in': True, '_id': False})
         if user['password'] == password and user['logged_in']:
             return True
         else:
             return False
 
-    def logout(self, username):
+    def logout(self, username, session_token=None):
         """
         Tell the underlying database (MongoDB) that a user has been logged out.
 
         :param username: The username to logout.
+        :param session_token: Defaults to None.
+                              If given, the user is only logged out if this is still their session
+                              token, so that a session that replaced it in the meantime stays logged in.
         """
 
-        user = self.userCollection.find_one({'username': username})
+        user = self.userCollection.find_one({'username': username}, {'_id': True})
         if user is None:
             raise UserKeyError(username)
 
+        query = {"_id": user["_id"]}
+        if session_token is not None:
+            query["session_token"] = session_token
+
+        # Removed rather than set to None, to keep the user out of the
+        # sparse index on session_token
         self.userCollection.update_one(
-            {"_id": user["_id"]},
+            query,
             {
                 "$set": {
-                    "logged_in": False,
-                    "session_token": None
+                    "logged_in": False
+                },
+                "$unset": {
+                    "session_token": ""
                 }
             }
         )
@@ -244,9 +483,23 @@ class ChatDB(object):
         :return: List of usernames of users who are logged in.
         """
 
-        users = self.userCollection.find({"logged_in": True})
+        users = self.userCollection.find({"logged_in": True}, {"username": True, "_id": False})
         return [user["username"] for user in users]
 
+    def online_users(self, usernames):
+        """
+        Check which of some users are online, in a single query.
+
+        :param usernames: The usernames to check.
+        :return: The set of those usernames whose users are logged in.
+        """
+
+        users = self.userCollection.find(
+            {"username": {"$in": list(usernames)}, "logged_in": True},
+            {"username": True, "_id": False}
+        )
+        return set(user["username"] for user in users)
+
     def delete_account(self, username):
         """
         Deletes the account corresponding to a username.
@@ -254,6 +507,7 @@ class ChatDB(object):
         :param username: The username of the account to delete.
         """
         self.userCollection.remove({"username": username})
+        self.messageCollection.delete_many({"recipient": username})
 
     def username_for_session_token(self, session_token):
         """
@@ -264,7 +518,7 @@ class ChatDB(object):
         :return: The username of the user logged in with this session_token.
         :raises: UserNotLoggedInError if there is no user logged in with this session_token.
         """
-        user = self.userCollection.find_one({'session_token': session_token})
+        user = self.userCollection.find_one({'session_token': session_token}, {'username': True, '_id': False})
         if user is None:
             raise UserNotLoggedInError(session_token)
         return user['username']
@@ -274,10 +528,10 @@ class ChatDB(object):
         Return a list of all users who match some regex query.
 
         :param query: The regex query to evaluate.
-        :return: A list of users who are logged in.
+        :return: A list of users who match, with their username, groups and whether they are logged in.
         """
         regex = re.compile(query)
-        users = self.userCollection.find({"username": regex})
+        users = self.userCollection.find({"username": regex}, {"username": True, "groups": True, "logged_in": True})
         return list(users)
 
     ###########
@@ -291,16 +545,17 @@ class ChatDB(object):
         :param group_name: The name of the group to create.
         """
 
-        if self.groupCollection.find_one({'name': group_name}):
+        # The unique index on name turns away duplicates. Members are not
+        # kept in the group, but in the groups of each user (see add_user_to_group).
+        try:
+            self.groupCollection.insert_one(
+                {
+                    'name': group_name
+                }
+            )
+        except DuplicateKeyError:
             raise GroupExists(group_name)
 
-        self.groupCollection.insert_one(
-            {
-                'name': group_name,
-                'users': []
-            }
-        )
-
     def get_users_in_group(self, group_name):
         """
         Return the usernames of users who are in some group.
@@ -311,7 +566,7 @@ class ChatDB(object):
         regex = re.compile(group_name)
 
         # fetch all matching groups
-        groups = self.groupCollection.find({"name": regex})
+        groups = self.groupCollection.find({"name": regex}, {"_id": True})
 
         # create an array of group ids
         group_ids = [group["_id"] for group in groups]
@@ -320,7 +575,7 @@ class ChatDB(object):
             raise GroupDoesNotExist(group_name)
 
         # fetch all users with that group id
-        users = self.userCollection.find({"groups": {"$in": group_ids} })
+        users = self.userCollection.find({"groups": {"$in": group_ids} }, {"username": True, "_id": False})
 
         # generate usernames
         usernames = [user["username"] for user in users]
@@ -336,51 +591,114 @@ class ChatDB(object):
                  UsernameDoesNotExist if the username does not exist.
         """
 
-        group = self.groupCollection.find_one({'name': group_name})
-        if group is None:
-            raise GroupDoesNotExist(group_name)
+        group_id = self.group_id(group_name)
 
-        user = self.userCollection.find_one({"username": username})
-        if user is None:
+        # $addToSet leaves users already in the group as they are
+        result = self.userCollection.update_one(
+            {"username": username},
+            {
+                "$addToSet": {
+                    "groups": group_id
+                }
+            }
+        )
+        if result.matched_count == 0:
             raise UsernameDoesNotExist(username)
 
-        users_in_group = self.get_users_in_group(group_name)
-        if username in users_in_group:
-            return
+    def add_users_to_group(self, usernames, group_name):
+        """
+        Add many users to some group at once, like when provisioning a team,
+        in a single update however many users there are. Users already in the
+        group stay as they are.
 
-        if group["_id"] not in user['groups']:
-            self.userCollection.update_one(
-                {"_id": user["_id"]},
-                {
-                    "$push": {
-                        "groups": group["_id"]
-                    }
+        :param usernames: The usernames of the users to add to this group.
+        :param group_name: The name of the group to which to add these users.
+        :return: The usernames that do not exist, which were skipped.
+        :raises: GroupDoesNotExist if the group does not exist.
+        """
+
+        group_id = self.group_id(group_name)
+        usernames = set(usernames)
+        if not usernames:
+            return []
+
+        result = self.userCollection.update_many(
+            {"username": {"$in": list(usernames)}},
+            {
+                "$addToSet": {
+                    "groups": group_id
                 }
-            )
+            }
+        )
+        if result.matched_count == len(usernames):
+            return []
 
-            self.groupCollection.update_one(
-                {"_id": group["_id"]},
-                {
-                    "$push": {
-                        "users": user["_id"]
-                    }
-                })
+        # Only a partial match takes the query for which users were missing
+        users = self.userCollection.find({"username": {"$in": list(usernames)}}, {"username": True, "_id": False})
+        return sorted(usernames.difference(user["username"] for user in users))
+
+    def group_id(self, group_name):
+        """
+        Get the id of some group, which is what users keep in their groups.
+        Groups are never renamed or deleted, so an id, once found, is kept,
+        and adding users to a group it knows takes a single update.
+
+        :param group_name: The name of the group to lookup.
+        :raises: GroupDoesNotExist if the group does not exist.
+        """
+
+        group_id = self.group_ids.get(group_name)
+        if group_id is not None:
+            return group_id
+
+        # Groups that do not exist are not remembered, since another process may create them
+        group = self.groupCollection.find_one({'name': group_name}, {'_id': True})
+        if group is None:
+            raise GroupDoesNotExist(group_name)
+        self.group_ids[group_name] = group['_id']
+        return group['_id']
 
     def get_groups(self, query):
         """
         Returns all groups that match some regex query.
 
         :param query: The query to lookup.
-        :return: A list of groups that match the provided regex query.
+        :return: A list of groups that match the provided regex query, with their names.
         """
         regex = re.compile(query)
-        groups = self.groupCollection.find({"name": regex})
+        groups = self.groupCollection.find({"name": regex}, {"name": True})
         return list(groups)
 
     ##############
     ## MESSAGES ##
     ##############
 
+    # Queued messages are kept in a collection of their own, one document per
+    # message and recipient, rather than in the user documents, which would
+    # otherwise grow with every message (up to the size limit of a document)
+    # and be rewritten with every one. Each message has a sequence number,
+    # from a single counter, so they increase for every recipient: a queue
+    # is read in the order of the (recipient, seq) index.
+
+    def next_sequence(self, count=1):
+        """
+        Takes sequence numbers for queued messages, in a single atomic update
+        of the counter, so that processes sharing the database never take
+        the same ones.
+
+        :param count: How many sequence numbers to take. Defaults to 1.
+        :return: The first of them; the others follow it.
+        """
+
+        counter = self.counterCollection.find_one_and_update(
+            {"_id": "messages"},
+            {"$inc": {"seq": count}},
+            projection={"seq": True},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["seq"] - count + 1
+
     def queue_message(self, message, from_username, username, group_name = None):
         """
         Add a message to the queue of some user, for delivery later.
@@ -392,37 +710,70 @@ class ChatDB(object):
         :raises: UserKeyError if the user does not exist.
         """
 
-        user = self.userCollection.find_one({'username': username})
-        if user is None:
+        if not self.user_exists(username):
             raise UserKeyError(username)
 
-        self.userCollection.update_one(
-            {"_id": user["_id"]},
+        self.messageCollection.insert_one(
             {
-                "$push": {
-                    "messageQ": {
-                        "message": message,
-                        "from_username": from_username,
-                        "from_group_name": group_name
-                    }
-                }
+                "recipient": username,
+                "seq": self.next_sequence(),
+                "message": message,
+                "from_username": from_username,
+                "from_group_name": group_name
             }
         )
 
-    def get_user_queued_messages(self, username):
+    def queue_messages(self, message, from_username, usernames, group_name = None):
+        """
+        Add a message to the queues of several users at once, for delivery later.
+        Takes one query for the recipients that exist, one update for their
+        sequence numbers and one bulk insert, however many users there are.
+        Usernames that do not exist are skipped.
+
+        :param message: The message string to deliver.
+        :param from_username: The username of the user who is sending this message.
+        :param usernames: The usernames of the users to which this message should be delivered.
+        :param group_name: If this message is sent as part of a group message, the name of the group from which it is sent (optional).
+        """
+
+        if not usernames:
+            return
+
+        users = self.userCollection.find({"username": {"$in": list(usernames)}}, {"username": True, "_id": False})
+        recipients = [user["username"] for user in users]
+        if not recipients:
+            return
+
+        seq = self.next_sequence(len(recipients))
+        self.messageCollection.insert_many(
+            [
+                {
+                    "recipient": recipient,
+                    "seq": seq + i,
+                    "message": message,
+                    "from_username": from_username,
+                    "from_group_name": group_name
+                }
+                for i, recipient in enumerate(recipients)
+            ],
+            ordered=False
+        )
+
+    def get_user_queued_messages(self, username, limit=None):
         """
-        Get all messages queued for some user.
+        Get the messages queued for some user, leaving them queued.
 
         :param username: The username to lookup.
-        :return: A list of messages in the message queue of this user.
+        :param limit: The most messages to get, or None for all of them. Defaults to None.
+        :return: A list of messages in the message queue of this user, oldest first.
         :raises: UserKeyError if the user does not exist.
         """
 
-        user = self.userCollection.find_one({'username': username})
-        if not user:
+        if not self.user_exists(username):
             raise UserKeyError(username)
 
-        return user['messageQ']
+        messages = self.messageCollection.find({"recipient": username}, MESSAGE_FIELDS).sort("seq", 1)
+        return list(messages.limit(limit or 0))
 
     def clear_user_message_queue(self, username):
         """
@@ -431,15 +782,98 @@ class ChatDB(object):
         :param username: The username of the user whose messages should be cleared.
         :raises: UserKeyError if the user does not exist.
         """
-        user = self.userCollection.find_one({'username': username})
-        if user is None:
+
+        if not self.user_exists(username):
             raise UserKeyError(username)
 
-        self.userCollection.update_one(
-            {"_id": user["_id"]},
-            {
-                "$set": {
-                    "messageQ": []
-                }
-            }
+        self.messageCollection.delete_many({"recipient": username})
+
+    def drain_user_message_queue(self, username, limit=DRAIN_BATCH):
+        """
+        Take the oldest messages queued for some user out of their queue.
+        Unlike a get_user_queued_messages followed by a clear_user_message_queue,
+        this never loses a message queued in between: only the messages it
+        returns are removed.
+
+        The batch is first claimed, by marking its messages with a token of
+        this drain, and then read and deleted by that token. The marking only
+        matches messages nobody has claimed, so two drains of the same queue
+        at the same time never both return a message. Messages claimed by a
+        drain that never got to delete them (like when its worker died) are
+        up for claiming again after DRAIN_CLAIM_TIMEOUT seconds.
+
+        :param username: The username to lookup.
+        :param limit: The most messages to take. Defaults to DRAIN_BATCH.
+        :return: A list of at most limit messages, oldest first.
+        :raises: UserKeyError if the user does not exist.
+        """
+
+        now = time.time()
+        unclaimed = {"recipient": username,
+                     "$or": [{"claim": {"$exists": False}}, {"claimed_at": {"$lt": now - DRAIN_CLAIM_TIMEOUT}}]}
+        ids = [message["_id"] for message in
+               self.messageCollection.find(unclaimed, {"_id": True}).sort("seq", 1).limit(limit)]
+
+        if not ids:
+            # Only an empty queue needs telling apart from a missing user
+            if not self.user_exists(username):
+                raise UserKeyError(username)
+            return []
+
+        claim = new_session_token()
+        self.messageCollection.update_many(dict(unclaimed, _id={"$in": ids}),
+                                           {"$set": {"claim": claim, "claimed_at": now}})
+
+        # Whatever another drain claimed in between is simply not ours
+        mine = {"recipient": username, "claim": claim}
+        messages = list(self.messageCollection.find(mine, MESSAGE_FIELDS).sort("seq", 1))
+        self.messageCollection.delete_many(mine)
+        return messages
+
+    def fetch_user_messages(self, username, since=0, limit=FETCH_LIMIT):
+        """
+        Get a page of the messages queued for some user, for clients that keep
+        a cursor: the one returned with the last page they got. Asking with a
+        cursor acknowledges the pages up to it, whose messages are removed
+        from the queue. A client that lost a page (like when its connection
+        went away) asks for it again with the same cursor.
+
+        A sequence number is taken before its message is inserted, so a
+        message may show up in the queue after others with higher numbers
+        were returned. Hence the cursor does not acknowledge sequence numbers:
+        every message returned is marked with the cursor it was asked for
+        with, and only the messages marked with an earlier cursor than the
+        one asked with now (that is, of the pages the client got) are
+        removed. The messages of pages it did not get are unmarked, to be
+        returned again. That takes four round trips.
+
+        :param username: The username to lookup.
+        :param since: The cursor returned with the last page. Defaults to 0,
+                      for the whole queue.
+        :param limit: The most messages to return. Defaults to FETCH_LIMIT.
+        :return: The cursor to ask with next, and a list of at most limit
+                 messages, oldest first.
+        :raises: UserKeyError if the user does not exist.
+        """
+
+        if since > 0:
+            self.messageCollection.delete_many({"recipient": username, "fetched": {"$lt": since}})
+        self.messageCollection.update_many(
+            {"recipient": username, "fetched": {"$gte": since}},
+            {"$unset": {"fetched": ""}}
+        )
+
+        fields = dict(MESSAGE_FIELDS, _id=True)
+        messages = list(self.messageCollection.find({"recipient": username}, fields).sort("seq", 1).limit(limit))
+
+        if not messages:
+            # Only an empty queue needs telling apart from a missing user
+            if not self.user_exists(username):
+                raise UserKeyError(username)
+            return since, messages
+
+        self.messageCollection.update_many(
+            {"_id": {"$in": [message.pop("_id") for message in messages]}},
+            {"$set": {"fetched": since}}
         )
+        return max(since + 1, messages[-1]["seq"]), messages
@@ -0,0 +1,266 @@
+"""
+A storage backend kept in plain Python dictionaries and sets, for running
+small deployments, and benchmarking the servers, without a database. Nothing
+survives a restart.
+"""
+
+import re
+import threading
+
+from chat_db import ChatDBBackend
+from chat_db import DRAIN_BATCH
+from chat_db import FETCH_LIMIT
+from chat_db import GroupDoesNotExist
+from chat_db import GroupExists
+from chat_db import UserKeyError
+from chat_db import UserNotLoggedInError
+from chat_db import UsernameDoesNotExist
+from chat_db import UsernameExists
+from chat_db import new_session_token
+
+class MemoryUser(object):
+    """
+    An account, and everything kept about it.
+    """
+
+    __slots__ = ('username', 'password', 'logged_in', 'session_token', 'groups')
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.logged_in = False
+        self.session_token = None
+        # Names of the groups the user is in
+        self.groups = set()
+
+    def document(self):
+        """
+        The user as ChatDB returns it.
+        """
+        return {
+            'username': self.username,
+            'groups': list(self.groups),
+            'logged_in': self.logged_in,
+        }
+
+class MemoryChatDB(ChatDBBackend):
+    """
+    The in-memory storage backend. Users are indexed by username and by
+    session token, groups by name, and each group keeps the set of its
+    members, so nothing but the regular expression queries has to look at
+    every user or every group. Queued messages are kept apart from the
+    users, by recipient, numbered from a single sequence like in ChatDB.
+    """
+
+    def __init__(self):
+        # Every method holds the lock for as long as it runs
+        self.lock = threading.RLock()
+        self.users = {}
+        self.users_by_token = {}
+        self.online = set()
+        # Usernames of the members of each group, by group name
+        self.groups = {}
+        # Queued messages by recipient, oldest first
+        self.messages = {}
+        # The sequence number of the last message queued
+        self.seq = 0
+
+    def user(self, username, error=UserKeyError):
+        """
+        Returns the MemoryUser of a username.
+
+        :raises: error (UserKeyError by default) if there is no such user.
+        """
+        user = self.users.get(username)
+        if user is None:
+            raise error(username)
+        return user
+
+    ##########
+    ## USER ##
+    ##########
+
+    def create_account(self, username, password):
+        with self.lock:
+            if username in self.users:
+                raise UsernameExists(username)
+            self.users[username] = MemoryUser(username, password)
+            return True
+
+    def login(self, username, password, kickout_method = None):
+        with self.lock:
+            user = self.users.get(username)
+            if user is None or user.password != password:
+                return False, ''
+
+            if user.logged_in and kickout_method:
+                # Kickout current user, so this guy can log in.
+                kickout_method(username)
+
+            self.users_by_token.pop(user.session_token, None)
+            user.session_token = new_session_token()
+            user.logged_in = True
+            self.users_by_token[user.session_token] = user
+            self.online.add(username)
+            return True, user.session_token
+
+    def user_exists(self, username):
+        return username in self.users
+
+    def is_online(self, username):
+        with self.lock:
+            return self.user(username).logged_in
+
+    def needs_kickout(self, username, password):
+        with self.lock:
+            user = self.user(username)
+            return user.password == password and user.logged_in
+
+    def logout(self, username, session_token=None):
+        with self.lock:
+            user = self.user(username)
+            if session_token is not None and user.session_token != session_token:
+                return
+
+            self.users_by_token.pop(user.session_token, None)
+            user.session_token = None
+            user.logged_in = False
+            self.online.discard(username)
+
+    def users_online(self):
+        with self.lock:
+            return list(self.online)
+
+    def online_users(self, usernames):
+        with self.lock:
+            return self.online.intersection(usernames)
+
+    def delete_account(self, username):
+        with self.lock:
+            user = self.users.pop(username, None)
+            if user is None:
+                return
+
+            self.users_by_token.pop(user.session_token, None)
+            self.online.discard(username)
+            self.messages.pop(username, None)
+            for group_name in user.groups:
+                self.groups[group_name].discard(username)
+
+    def username_for_session_token(self, session_token):
+        with self.lock:
+            user = self.users_by_token.get(session_token)
+            if user is None:
+                raise UserNotLoggedInError(session_token)
+            return user.username
+
+    def get_users(self, query):
+        regex = re.compile(query)
+        with self.lock:
+            return [user.document() for user in self.users.itervalues() if regex.search(user.username)]
+
+    ###########
+    ## GROUP ##
+    ###########
+
+    def create_group(self, group_name):
+        with self.lock:
+            if group_name in self.groups:
+                raise GroupExists(group_name)
+            self.groups[group_name] = set()
+
+    def get_users_in_group(self, group_name):
+        regex = re.compile(group_name)
+        with self.lock:
+            groups = [members for name, members in self.groups.iteritems() if regex.search(name)]
+            if not groups:
+                raise GroupDoesNotExist(group_name)
+            return list(set().union(*groups))
+
+    def add_user_to_group(self, username, group_name):
+        with self.lock:
+            members = self.groups.get(group_name)
+            if members is None:
+                raise GroupDoesNotExist(group_name)
+            user = self.user(username, UsernameDoesNotExist)
+
+            members.add(username)
+            user.groups.add(group_name)
+
+    def add_users_to_group(self, usernames, group_name):
+        with self.lock:
+            members = self.groups.get(group_name)
+            if members is None:
+                raise GroupDoesNotExist(group_name)
+
+            missing = []
+            for username in set(usernames):
+                user = self.users.get(username)
+                if user is None:
+                    missing.append(username)
+                    continue
+                members.add(username)
+                user.groups.add(group_name)
+            return sorted(missing)
+
+    def get_groups(self, query):
+        regex = re.compile(query)
+        with self.lock:
+            return [{'name': name, 'users': list(members)}
+                    for name, members in self.groups.iteritems() if regex.search(name)]
+
+    ##############
+    ## MESSAGES ##
+    ##############
+
+    def enqueue(self, message, from_username, username, group_name):
+        """
+        Appends a message to the queue of a user. Must be called with the lock held.
+        """
+        self.seq += 1
+        self.messages.setdefault(username, []).append({
+            'seq': self.seq,
+            'message': message,
+            'from_username': from_username,
+            'from_group_name': group_name
+        })
+
+    def queue_message(self, message, from_username, username, group_name = None):
+        with self.lock:
+            self.user(username)
+            self.enqueue(message, from_username, username, group_name)
+
+    def queue_messages(self, message, from_username, usernames, group_name = None):
+        with self.lock:
+            for username in usernames:
+                if username in self.users:
+                    self.enqueue(message, from_username, username, group_name)
+
+    def get_user_queued_messages(self, username, limit=None):
+        with self.lock:
+            self.user(username)
+            return list(self.messages.get(username, ())[:limit])
+
+    def clear_user_message_queue(self, username):
+        with self.lock:
+            self.user(username)
+            self.messages.pop(username, None)
+
+    def drain_user_message_queue(self, username, limit=DRAIN_BATCH):
+        with self.lock:
+            self.user(username)
+            messages = self.messages.get(username, [])
+            drained = messages[:limit]
+            del messages[:limit]
+            return drained
+
+    def fetch_user_messages(self, username, since=0, limit=FETCH_LIMIT):
+        with self.lock:
+            self.user(username)
+            messages = self.messages.get(username, [])
+            acknowledged = 0
+            while acknowledged < len(messages) and messages[acknowledged]['seq'] <= since:
+                acknowledged += 1
+            del messages[:acknowledged]
+            page = messages[:limit]
+            return page[-1]['seq'] if page else since, page
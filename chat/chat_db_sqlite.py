@@ -0,0 +1,342 @@
+"""
+A storage backend on an embedded SQLite database (the sqlite3 module that
+ships with Python), for small deployments that should keep their data
+without running a database server.
+"""
+
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from chat_db import ChatDBBackend
+from chat_db import DRAIN_BATCH
+from chat_db import FETCH_LIMIT
+from chat_db import GroupDoesNotExist
+from chat_db import GroupExists
+from chat_db import UserKeyError
+from chat_db import UserNotLoggedInError
+from chat_db import UsernameDoesNotExist
+from chat_db import UsernameExists
+from chat_db import new_session_token
+
+# The database file, unless told otherwise
+SQLITE_PATH = 'chat.sqlite3'
+
+# Seconds to wait for another process (like another worker) to let go of the database
+SQLITE_TIMEOUT = 30
+
+# Created in a single immediate transaction (see create_schema)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    logged_in INTEGER NOT NULL DEFAULT 0,
+    session_token TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_session_token ON users (session_token);
+CREATE INDEX IF NOT EXISTS users_logged_in ON users (logged_in);
+
+CREATE TABLE IF NOT EXISTS groups (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS memberships (
+    group_id INTEGER NOT NULL REFERENCES groups (id),
+    username TEXT NOT NULL REFERENCES users (username),
+    PRIMARY KEY (group_id, username)
+);
+CREATE INDEX IF NOT EXISTS memberships_username ON memberships (username);
+
+-- Queued messages, numbered from a single sequence that never goes back,
+-- even after the last ones are deleted (AUTOINCREMENT), like in ChatDB
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL REFERENCES users (username),
+    message TEXT NOT NULL,
+    from_username TEXT,
+    from_group_name TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, seq);
+"""
+
+def regexp(pattern, value):
+    """
+    The REGEXP operator of SQLite, which it leaves to the application, with
+    the search semantics of the MongoDB backend.
+    """
+    return value is not None and re.search(pattern, value) is not None
+
+def message_document(row):
+    """
+    A queued message as ChatDB returns it, from a (seq, message, from_username,
+    from_group_name) row.
+    """
+    seq, message, from_username, from_group_name = row
+    return {'seq': seq, 'message': message, 'from_username': from_username, 'from_group_name': from_group_name}
+
+class SQLiteChatDB(ChatDBBackend):
+    """
+    The SQLite storage backend. A single connection is shared by every
+    thread, one statement (or transaction) at a time.
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        """
+        :param path: The database file, created if it does not exist, or ':memory:'.
+                     Defaults to SQLITE_PATH.
+        """
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        # Keep strings as the byte strings the servers hand us
+        self.connection.text_factory = str
+        self.connection.create_function('REGEXP', 2, regexp)
+        self.create_schema()
+        if path != ':memory:':
+            self.connection.execute('PRAGMA journal_mode=WAL')
+
+    def create_schema(self):
+        """
+        Creates whatever tables and indexes are missing, holding the write
+        lock of the database throughout, so that workers opening the same
+        file at once do not trip over each other.
+        """
+        with self.immediate():
+            for statement in SCHEMA.split(';'):
+                if statement.strip():
+                    self.connection.execute(statement)
+
+    @contextmanager
+    def immediate(self):
+        """
+        Runs a block in a transaction that takes the write lock of the database
+        from the start (rather than at its first write, like the transactions
+        of the sqlite3 module), so that no other process writes between its
+        reads and its writes.
+        """
+        with self.lock:
+            isolation_level = self.connection.isolation_level
+            # Leave the transaction to us, rather than the sqlite3 module
+            self.connection.isolation_level = None
+            try:
+                self.connection.execute('BEGIN IMMEDIATE')
+                try:
+                    yield
+                except:
+                    self.connection.execute('ROLLBACK')
+                    raise
+                self.connection.execute('COMMIT')
+            finally:
+                self.connection.isolation_level = isolation_level
+
+    def query(self, sql, *args):
+        """
+        Runs a query, and returns all of its rows.
+        """
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def execute(self, sql, *args):
+        """
+        Runs a statement in a transaction of its own.
+
+        :return: The number of rows it changed.
+        """
+        with self.lock:
+            with self.connection:
+                return self.connection.execute(sql, args).rowcount
+
+    ##########
+    ## USER ##
+    ##########
+
+    def create_account(self, username, password):
+        try:
+            self.execute('INSERT INTO users (username, password) VALUES (?, ?)', username, password)
+        except sqlite3.IntegrityError:
+            raise UsernameExists(username)
+        return True
+
+    def login(self, username, password, kickout_method = None):
+        rows = self.query('SELECT password, logged_in FROM users WHERE username = ?', username)
+        if not rows or rows[0][0] != password:
+            return False, ''
+
+        if rows[0][1] and kickout_method:
+            # Kickout current user, so this guy can log in.
+            kickout_method(username)
+
+        session_token = new_session_token()
+        self.execute('UPDATE users SET logged_in = 1, session_token = ? WHERE username = ?',
+                     session_token, username)
+        return True, session_token
+
+    def user_exists(self, username):
+        return bool(self.query('SELECT 1 FROM users WHERE username = ?', username))
+
+    def is_online(self, username):
+        rows = self.query('SELECT logged_in FROM users WHERE username = ?', username)
+        if not rows:
+            raise UserKeyError(username)
+        return bool(rows[0][0])
+
+    def needs_kickout(self, username, password):
+        rows = self.query('SELECT password, logged_in FROM users WHERE username = ?', username)
+        return bool(rows) and rows[0][0] == password and bool(rows[0][1])
+
+    def logout(self, username, session_token=None):
+        if not self.user_exists(username):
+            raise UserKeyError(username)
+
+        if session_token is None:
+            self.execute('UPDATE users SET logged_in = 0, session_token = NULL WHERE username = ?', username)
+        else:
+            self.execute('UPDATE users SET logged_in = 0, session_token = NULL '
+                         'WHERE username = ? AND session_token = ?', username, session_token)
+
+    def users_online(self):
+        return [row[0] for row in self.query('SELECT username FROM users WHERE logged_in = 1')]
+
+    def online_users(self, usernames):
+        online = set()
+        for chunk in chunks(list(usernames)):
+            rows = self.query('SELECT username FROM users WHERE logged_in = 1 AND username IN ({})'.format(
+                ','.join('?' * len(chunk))), *chunk)
+            online.update(row[0] for row in rows)
+        return online
+
+    def delete_account(self, username):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM messages WHERE recipient = ?', (username,))
+                self.connection.execute('DELETE FROM memberships WHERE username = ?', (username,))
+                self.connection.execute('DELETE FROM users WHERE username = ?', (username,))
+
+    def username_for_session_token(self, session_token):
+        rows = self.query('SELECT username FROM users WHERE session_token = ?', session_token)
+        if not rows:
+            raise UserNotLoggedInError(session_token)
+        return rows[0][0]
+
+    def get_users(self, query):
+        re.compile(query)
+        rows = self.query('SELECT username, logged_in FROM users WHERE username REGEXP ?', query)
+        return [{'username': username, 'logged_in': bool(logged_in)} for username, logged_in in rows]
+
+    ###########
+    ## GROUP ##
+    ###########
+
+    def create_group(self, group_name):
+        try:
+            self.execute('INSERT INTO groups (name) VALUES (?)', group_name)
+        except sqlite3.IntegrityError:
+            raise GroupExists(group_name)
+
+    def get_users_in_group(self, group_name):
+        re.compile(group_name)
+        with self.lock:
+            if not self.query('SELECT 1 FROM groups WHERE name REGEXP ? LIMIT 1', group_name):
+                raise GroupDoesNotExist(group_name)
+            rows = self.query('SELECT DISTINCT memberships.username FROM memberships '
+                              'JOIN groups ON groups.id = memberships.group_id WHERE groups.name REGEXP ?',
+                              group_name)
+        return [row[0] for row in rows]
+
+    def add_user_to_group(self, username, group_name):
+        with self.lock:
+            rows = self.query('SELECT id FROM groups WHERE name = ?', group_name)
+            if not rows:
+                raise GroupDoesNotExist(group_name)
+            if not self.user_exists(username):
+                raise UsernameDoesNotExist(username)
+            self.execute('INSERT OR IGNORE INTO memberships (group_id, username) VALUES (?, ?)',
+                         rows[0][0], username)
+
+    def add_users_to_group(self, usernames, group_name):
+        usernames = list(set(usernames))
+        with self.immediate():
+            rows = self.query('SELECT id FROM groups WHERE name = ?', group_name)
+            if not rows:
+                raise GroupDoesNotExist(group_name)
+            existing = set()
+            for chunk in chunks(usernames):
+                existing.update(row[0] for row in self.query(
+                    'SELECT username FROM users WHERE username IN ({})'.format(','.join('?' * len(chunk))), *chunk))
+            self.connection.executemany('INSERT OR IGNORE INTO memberships (group_id, username) VALUES (?, ?)',
+                                        [(rows[0][0], username) for username in existing])
+        return sorted(set(usernames).difference(existing))
+
+    def get_groups(self, query):
+        re.compile(query)
+        rows = self.query('SELECT name FROM groups WHERE name REGEXP ?', query)
+        return [{'name': row[0]} for row in rows]
+
+    ##############
+    ## MESSAGES ##
+    ##############
+
+    def queue_message(self, message, from_username, username, group_name = None):
+        if not self.user_exists(username):
+            raise UserKeyError(username)
+        self.execute('INSERT INTO messages (recipient, message, from_username, from_group_name) '
+                     'VALUES (?, ?, ?, ?)', username, message, from_username, group_name)
+
+    def queue_messages(self, message, from_username, usernames, group_name = None):
+        if not usernames:
+            return
+        with self.lock:
+            with self.connection:
+                # Usernames that do not exist are skipped
+                self.connection.executemany(
+                    'INSERT INTO messages (recipient, message, from_username, from_group_name) '
+                    'SELECT username, ?, ?, ? FROM users WHERE username = ?',
+                    [(message, from_username, group_name, username) for username in usernames])
+
+    def get_user_queued_messages(self, username, limit=None):
+        with self.lock:
+            if not self.user_exists(username):
+                raise UserKeyError(username)
+            # A negative limit is no limit at all
+            rows = self.query('SELECT seq, message, from_username, from_group_name FROM messages '
+                              'WHERE recipient = ? ORDER BY seq LIMIT ?', username, -1 if limit is None else limit)
+        return [message_document(row) for row in rows]
+
+    def clear_user_message_queue(self, username):
+        if not self.user_exists(username):
+            raise UserKeyError(username)
+        self.execute('DELETE FROM messages WHERE recipient = ?', username)
+
+    def drain_user_message_queue(self, username, limit=DRAIN_BATCH):
+        with self.immediate():
+            if not self.user_exists(username):
+                raise UserKeyError(username)
+            rows = self.query('SELECT seq, message, from_username, from_group_name FROM messages '
+                              'WHERE recipient = ? ORDER BY seq LIMIT ?', username, limit)
+            if rows:
+                # Nothing can be queued meanwhile, so the range is exactly the rows read
+                self.connection.execute('DELETE FROM messages WHERE recipient = ? AND seq <= ?',
+                                        (username, rows[-1][0]))
+        return [message_document(row) for row in rows]
+
+    def fetch_user_messages(self, username, since=0, limit=FETCH_LIMIT):
+        with self.immediate():
+            if not self.user_exists(username):
+                raise UserKeyError(username)
+            if since > 0:
+                self.connection.execute('DELETE FROM messages WHERE recipient = ? AND seq <= ?', (username, since))
+            rows = self.query('SELECT seq, message, from_username, from_group_name FROM messages '
+                              'WHERE recipient = ? AND seq > ? ORDER BY seq LIMIT ?', username, since, limit)
+        # Sequence numbers are taken as messages are inserted, so none can
+        # turn up behind the cursor
+        return rows[-1][0] if rows else since, [message_document(row) for row in rows]
+
+# SQLite takes at most 999 parameters per statement
+MAX_PARAMETERS = 999
+
+def chunks(items, size=MAX_PARAMETERS):
+    """
+    Splits a list into lists of at most size items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,174 @@
+"""
+Logging for the servers, on top of the standard logging library.
+
+Every server module logs through its own logger (logging.getLogger(__name__)),
+and configure sends all of them to a BackgroundHandler, which formats and
+writes the records on a thread of its own, so that logging never makes a
+request wait on stdout.
+
+Events that happen for every request or every message are logged at DEBUG,
+through a Sampler, which only logs one of every so many of them. At the
+default level (INFO) they cost a counter increment, and nothing is formatted
+or written.
+"""
+
+import logging
+import os
+import sys
+import threading
+import Queue
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+DEFAULT_LEVEL = 'info'
+
+# One of every this many per-request and per-message events is logged
+DEFAULT_SAMPLE = 100
+
+# Records waiting to be written, beyond which new ones are dropped
+MAX_BUFFERED_RECORDS = 10000
+
+# Most records written at once
+BATCH_SIZE = 256
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+class BackgroundHandler(logging.Handler):
+    """
+    A logging handler that hands its records to a thread, which formats
+    them and writes them to a stream in batches. Records beyond
+    MAX_BUFFERED_RECORDS are dropped (and counted) rather than waited for.
+    """
+
+    def __init__(self, stream):
+        """
+        :param stream: the file to write to
+        """
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.write_lock = threading.Lock()
+        self.dropped = 0
+        self.pid = None
+
+    def start(self):
+        """
+        Starts the writer thread of this process.
+        """
+        self.records = Queue.Queue(MAX_BUFFERED_RECORDS)
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self.write_forever)
+        thread.daemon = True
+        thread.start()
+
+    def emit(self, record):
+        # A forked process does not inherit the writer thread, so it needs its own
+        if self.pid != os.getpid():
+            self.start()
+
+        try:
+            self.records.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def write_forever(self):
+        """
+        Writes records as they come, forever.
+        """
+        while 1:
+            records = [self.records.get()]
+            self.write(records + self.pending_records(BATCH_SIZE - 1))
+
+    def pending_records(self, limit=None):
+        """
+        Takes the records waiting to be written, without waiting for more.
+
+        :param limit: the most records to take. Defaults to all of them.
+        """
+        records = []
+        try:
+            while limit is None or len(records) < limit:
+                records.append(self.records.get_nowait())
+        except Queue.Empty:
+            pass
+        return records
+
+    def write(self, records):
+        """
+        Formats records and writes them out at once.
+        """
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+
+        if self.dropped:
+            lines.append('{} log records were dropped.'.format(self.dropped))
+            self.dropped = 0
+
+        if lines:
+            with self.write_lock:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+
+    def flush(self):
+        """
+        Writes whatever is waiting, right away. Called by the logging library
+        at exit.
+        """
+        if self.pid == os.getpid():
+            self.write(self.pending_records())
+
+class Sampler(object):
+    """
+    Logs only one of every so many occurrences of an event, for events
+    too frequent to log each time (like every message delivered). Called
+    like the logging method of the level it logs at:
+
+        delivered = Sampler(log)
+        delivered('Sent a message to %s.', username)
+    """
+
+    # Set by configure
+    every = DEFAULT_SAMPLE
+
+    def __init__(self, logger, level=logging.DEBUG):
+        """
+        :param logger: the logger to log to
+        :param level: the level to log at. Defaults to DEBUG.
+        """
+        self.logger = logger
+        self.level = level
+        self.count = 0
+
+    def __call__(self, message, *args):
+        self.count += 1
+        if self.count >= self.every:
+            self.count = 0
+            if self.logger.isEnabledFor(self.level):
+                self.logger.log(self.level, message, *args)
+
+def configure(level=DEFAULT_LEVEL, sample=DEFAULT_SAMPLE, stream=None):
+    """
+    Sends the records of every logger to a BackgroundHandler.
+
+    :param level: the name of the lowest level logged (see LEVELS). Defaults to DEFAULT_LEVEL.
+    :param sample: log one of every this many frequent events (see Sampler).
+    Defaults to DEFAULT_SAMPLE.
+    :param stream: the file to write to. Defaults to stdout.
+    """
+    handler = BackgroundHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(LEVELS[level])
+
+    Sampler.every = max(1, sample)
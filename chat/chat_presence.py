@@ -0,0 +1,151 @@
+"""
+Who is logged in, kept in memory by ChatServer, so that checking whether a
+user is online never takes a trip to the database.
+
+The servers tell the registry about every login and logout (including the
+ones that happen because a connection went away), and the registry answers
+every presence question from then on. The database still records who is
+logged in, which is where the registry starts from, unless it was told to
+keep snapshots: then it starts from the last snapshot, and writes a new one
+every SNAPSHOT_INTERVAL seconds for as long as something changed.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Seconds between snapshots, when anything changed
+SNAPSHOT_INTERVAL = 5
+
+class Presence(object):
+    """
+    The users who are online, and the session each of them is logged in
+    with. Shared by every thread of a server.
+    """
+
+    def __init__(self, snapshot_path=None):
+        """
+        :param snapshot_path: the file to keep snapshots in. Defaults to None,
+        for no snapshots.
+        """
+        self.lock = threading.Lock()
+        # Session token by username. The token is None when we do not know
+        # it, like for users logged in through another worker.
+        self.sessions = {}
+        self.snapshot_path = snapshot_path
+        self.changed = False
+
+        if snapshot_path is not None:
+            thread = threading.Thread(target=self.snapshot_forever)
+            thread.daemon = True
+            thread.start()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def reset(self, usernames):
+        """
+        Starts over with some users online, in sessions we do not know.
+        """
+        with self.lock:
+            self.sessions = dict.fromkeys(usernames)
+            self.changed = True
+
+    def login(self, username, session_token=None):
+        """
+        Records that a user is online, with a session in place of any they had.
+        """
+        with self.lock:
+            self.sessions[username] = session_token
+            self.changed = True
+
+    def logout(self, username, session_token=None):
+        """
+        Records that a user went offline.
+
+        :param session_token: only if they were still in this session. Defaults
+        to None, for whatever session they were in.
+        :return True if the user was online, and is not anymore
+        """
+        with self.lock:
+            if username not in self.sessions:
+                return False
+            current = self.sessions[username]
+            if session_token is not None and current is not None and current != session_token:
+                return False
+            del self.sessions[username]
+            self.changed = True
+            return True
+
+    def is_online(self, username):
+        return username in self.sessions
+
+    def online(self, usernames):
+        """
+        Returns the set of the users among some usernames who are online.
+        """
+        sessions = self.sessions
+        return set(username for username in usernames if username in sessions)
+
+    def users(self):
+        """
+        Returns the usernames of everyone online.
+        """
+        with self.lock:
+            return list(self.sessions)
+
+    ###############
+    ## SNAPSHOTS ##
+    ###############
+
+    def restore(self):
+        """
+        Starts from the last snapshot, if there is one.
+
+        :return True if there was a snapshot to start from
+        """
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return False
+
+        try:
+            with open(self.snapshot_path) as snapshot:
+                sessions = json.load(snapshot)
+        except (IOError, ValueError):
+            log.exception("Could not read the presence snapshot %s.", self.snapshot_path)
+            return False
+
+        with self.lock:
+            self.sessions = sessions
+            self.changed = False
+        log.info("Restored %s online users from %s.", len(sessions), self.snapshot_path)
+        return True
+
+    def save(self):
+        """
+        Writes a snapshot, replacing the last one at once, so that a crash
+        halfway through never leaves half a snapshot behind.
+        """
+        with self.lock:
+            sessions = dict(self.sessions)
+            self.changed = False
+
+        temporary_path = '{}.{}.tmp'.format(self.snapshot_path, os.getpid())
+        with open(temporary_path, 'w') as snapshot:
+            json.dump(sessions, snapshot)
+        os.rename(temporary_path, self.snapshot_path)
+
+    def snapshot_forever(self):
+        """
+        Saves a snapshot every SNAPSHOT_INTERVAL seconds, when anything changed.
+        """
+        while 1:
+            time.sleep(SNAPSHOT_INTERVAL)
+            if self.changed:
+                try:
+                    self.save()
+                except (IOError, OSError):
+                    log.exception("Could not write the presence snapshot %s.", self.snapshot_path)
@@ -1,5 +1,17 @@
-from chat_db import ChatDB
+import logging
+
+from chat_db import DEFAULT_BACKEND
+from chat_db import DRAIN_BATCH
+from chat_db import FETCH_LIMIT
+from chat_db import MAX_FETCH_LIMIT
+from chat_db import open_chat_db
 from chat_db import UsernameExists
+from chat_log import Sampler
+from chat_presence import Presence
+from chat_sessions import SessionCache
+
+log = logging.getLogger(__name__)
+delivery_log = Sampler(log)
 
 class ChatServer(object):
     """
@@ -7,20 +19,33 @@ class ChatServer(object):
     server. Notice that the functions here are almost always simple wrappers
     to functions in ChatDB. Those may raise exceptions, and should be handled
     appropriately by the caller; this class does NOT handle them.
+
+    Who is online is the exception: it is kept in memory (see chat_presence),
+    and every login and logout goes through here to keep it up to date. So
+    are the users of recent session tokens (see chat_sessions).
     """
     
-    def __init__(self, host, port):
+    def __init__(self, host, port, presence_snapshot=None, db_backend=DEFAULT_BACKEND, db_path=None):
         """
         Initializes a ChatServer host and port class variables.
-        Also starts the ChatDB instance, which handles interactions 
-        with an underlying database. 
+        Also opens the storage backend (ChatDB, unless told otherwise), which
+        handles interactions with an underlying database.
 
         :param host: The host where this client should connect to
         :param port: The port that this client should connect to
+        :param presence_snapshot: The file to keep snapshots of who is online in,
+        to start from after a restart. Defaults to None, to start from the database.
+        :param db_backend: The storage backend, one of chat_db.BACKENDS. Defaults to MongoDB.
+        :param db_path: The database file, for the sqlite backend. Defaults to None, for its default.
         """
         self.host = host
         self.port = port
-        self.chatDB = ChatDB()
+        self.chatDB = open_chat_db(db_backend, db_path)
+
+        self.presence = Presence(presence_snapshot)
+        if not self.presence.restore():
+            self.presence.reset(self.chatDB.users_online())
+        self.sessions = SessionCache()
 
     def kickout_user(self, username):
         """
@@ -42,29 +67,64 @@ class ChatServer(object):
 
         :param username: The username of the account to be logged in
         :param password: The corresponding password
-        """
-        self.chatDB.login(username, password, self.kickout_user)
 
-    def logout(self, username):
+        :return: tuple of (False, '') on failure, tuple of (True, session_token) on success.
+        """
+        success, session_token = self.chatDB.login(username, password, self.kickout_user)
+        if success:
+            # Whoever was logged in before has a token that is not valid anymore
+            self.sessions.invalidate(username)
+            self.presence.login(username, session_token)
+        return success, session_token
+
+    def logout(self, username, session_token=None):
         """
         Logout off an account given a username.
 
         :param username: The username of the account to be logged off
+        :param session_token: Only log off this session of the account. Defaults to None (any session).
         """
-        self.chatDB.logout(username)
+        self.chatDB.logout(username, session_token)
+        self.sessions.invalidate(username, session_token)
+        self.presence.logout(username, session_token)
 
-    def is_online(self, username):
+    def username_exists(self, username):
+        """
+        Check if an account exists with a username.
+
+        :param username: Username that we want to check
+
+        :return: True if the account exists, False otherwise
         """
-        Check if a user is online. 
+        return self.chatDB.user_exists(username)
 
-        Should be overriden in some server implementations if "logged in"
-        scheme is senseless.
+    def is_online(self, username):
+        """
+        Check if a user is online, without asking the database.
 
         :param username: Username that we want to check
 
         :return: True if user is online, False otherwise
         """
-        return self.chatDB.is_online(username)
+        return self.presence.is_online(username)
+
+    def users_online(self):
+        """
+        Return the usernames of the users who are logged in.
+
+        :return: List of usernames
+        """
+        return self.presence.users()
+
+    def online_users(self, usernames):
+        """
+        Check which of some users are online, all at once.
+
+        :param usernames: Usernames that we want to check
+
+        :return: Set of the usernames of the users who are online
+        """
+        return self.presence.online(usernames)
 
     def delete_account(self, username):
         """
@@ -73,17 +133,20 @@ class ChatServer(object):
         :param username: Username to be deleted
         """
         self.chatDB.delete_account(username)
+        self.sessions.invalidate(username)
+        self.presence.logout(username)
 
     def username_for_session_token(self, session_token):
         """
-        Fetches a username, given a session token.
+        Fetches a username, given a session token. Recently used tokens are
+        answered without asking the database.
 
         :param session_token: The session token to be queried
 
         :return: The username matching the session_token.
         """
 
-        return self.chatDB.username_for_session_token(session_token)
+        return self.sessions.lookup(session_token, self.chatDB.username_for_session_token)
 
     ###########
     ## GROUP ##
@@ -102,6 +165,16 @@ class ChatServer(object):
         """
         return self.chatDB.get_users(query)
 
+    def get_users_in_group(self, group_name):
+        """
+        Return the usernames of the users in the groups matching a regex.
+
+        :param group_name: The regex query to be matched
+
+        :return: List of usernames
+        """
+        return self.chatDB.get_users_in_group(group_name)
+
     def add_user_to_group(self, username, group_name):
         """
         Adds a user to a group.
@@ -112,6 +185,17 @@ class ChatServer(object):
         
         self.chatDB.add_user_to_group(username, group_name)
 
+    def add_users_to_group(self, usernames, group_name):
+        """
+        Adds many users to a group at once.
+
+        :param usernames: The usernames to be added
+        :param group_name: The group to which the users should be added
+
+        :return: The usernames that do not exist, which were skipped
+        """
+        return self.chatDB.add_users_to_group(usernames, group_name)
+
     def get_groups(self, query):
         """
         Return all groups that match some regex query.
@@ -127,19 +211,45 @@ class ChatServer(object):
     ## MESSAGE ##
     #############
 
+    def send_user(self, message, from_username, username, group_name = None):
+        """
+        Deliver a message right away to a user who is online. Implementation
+        specific: servers that cannot push messages to their users leave it
+        to raise, and the message is queued for the user instead.
+        """
+        raise NotImplementedError()
+
     def send_message_to_group(self, session_token, message, group_name):
         """
-        Send message to a group with this group_name. This uses send_or_queue_message
-        in a loop.
+        Send message to a group with this group_name. Same as send_or_queue_message
+        for every member, but the sender is looked up once, the presence of all
+        members is checked at once, and the message is queued for every member
+        it could not be sent to at once.
 
         :param session_token: The session_token of the sender.
         :param message: The message to be sent.
         :param group_name: The group to which message will be sent.
         """
+        # Even an empty group only takes messages from a logged in user
+        from_username = self.username_for_session_token(session_token)
         users = self.chatDB.get_users_in_group(group_name)
+        if not users:
+            return
+
+        online = self.online_users(users)
 
+        offline = []
         for username in users:
-            self.send_or_queue_message(session_token, message, username, group_name)
+            if username in online:
+                try:
+                    self.send_user(message, from_username, username, group_name)
+                    delivery_log('Found %s online! Sending message.', username)
+                    continue
+                except Exception:
+                    delivery_log('%s not online. Queuening message.', username)
+            offline.append(username)
+
+        self.chatDB.queue_messages(message, from_username, offline, group_name)
 
     def send_or_queue_message(self, session_token, message, username, group_name = None):
         """
@@ -151,28 +261,29 @@ class ChatServer(object):
         :param group_name: The group where this message was sent; default is None 
         """
 
-        from_username = self.chatDB.username_for_session_token(session_token)
+        from_username = self.username_for_session_token(session_token)
 
         if self.is_online(username):
             try:
                 self.send_user(message, from_username, username, group_name)
-                print 'Found {} online! Sending message.'.format(username)
+                delivery_log('Found %s online! Sending message.', username)
             except:
                 self.chatDB.queue_message(message, from_username, username, group_name)
-                print '{} not online. Queuening message.'.format(username)
+                delivery_log('%s not online. Queuening message.', username)
         else:
             self.chatDB.queue_message(message, from_username, username, group_name)
-            print '{} not online. Queuening message.'.format(username)
+            delivery_log('%s not online. Queuening message.', username)
 
-    def get_user_queued_messages(self, username):
+    def get_user_queued_messages(self, username, limit=None):
         """
-        Get all messages queued for some user.
+        Get the messages queued for some user, leaving them queued.
 
         :param username: Username for which to get queued messages.
+        :param limit: The most messages to get, or None for all of them. Defaults to None.
 
-        :return: List of all queued messages.
+        :return: List of the oldest queued messages.
         """
-        return self.chatDB.get_user_queued_messages(username)
+        return self.chatDB.get_user_queued_messages(username, limit)
 
     def clear_user_message_queue(self, username):
         """
@@ -181,3 +292,31 @@ class ChatServer(object):
         :param username: Username for which to clear.
         """
         self.chatDB.clear_user_message_queue(username)
+
+    def drain_user_message_queue(self, username, limit=DRAIN_BATCH):
+        """
+        Take a batch of the oldest messages queued for some user out of their
+        queue, so that no single query or reply holds a whole large queue, and
+        no message queued meanwhile is lost (see ChatDB.drain_user_message_queue).
+        A full batch means there may be more to take with another call.
+
+        :param username: Username for which to take queued messages.
+        :param limit: The most messages to take. Defaults to DRAIN_BATCH.
+
+        :return: List of at most limit messages taken, oldest first.
+        """
+        return self.chatDB.drain_user_message_queue(username, limit)
+
+    def fetch_user_messages(self, username, since=0, limit=FETCH_LIMIT):
+        """
+        Get a page of the messages queued for some user, after a cursor,
+        acknowledging (and removing) the ones up to it (see
+        ChatDB.fetch_user_messages).
+
+        :param username: Username for which to get queued messages.
+        :param since: The cursor returned with the last page the client got. Defaults to 0.
+        :param limit: The most messages to return, up to MAX_FETCH_LIMIT. Defaults to FETCH_LIMIT.
+
+        :return: The cursor to ask with next, and a list of at most limit messages, oldest first.
+        """
+        return self.chatDB.fetch_user_messages(username, since, min(limit, MAX_FETCH_LIMIT))
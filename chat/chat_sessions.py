@@ -0,0 +1,119 @@
+"""
+A cache of the users of session tokens, so that authenticating a request
+does not take a query on the session token every time.
+
+Entries expire after a while, since a session can end without this server
+knowing (like when its user logs in through another process), and the least
+recently used ones go once the cache is full. Whatever ends a session that
+this server knows of (a logout, a kickout, a deleted account) takes its
+token out of the cache right away.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# Most tokens cached at once
+MAX_SESSIONS = 10000
+
+# Seconds a token stays cached
+SESSION_TTL = 60
+
+class SessionCache(object):
+    """
+    A least recently used cache of username by session token, with a time
+    to live. Shared by every thread of a server.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL):
+        """
+        :param max_sessions: the most tokens cached at once. Defaults to MAX_SESSIONS.
+        :param ttl: seconds a token stays cached. Defaults to SESSION_TTL.
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (username, expiry time) by session token, least recently used first
+        self.entries = OrderedDict()
+        # Session token by username, to find the token of a user to invalidate
+        self.tokens = {}
+        # Bumped by every invalidation, so that a lookup that raced with one
+        # does not cache what it found (see lookup)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, session_token, load):
+        """
+        Returns the username of a session token, from the cache if it is
+        there, or else from load, whose answer is cached.
+
+        :param load: called with the session token on a miss, returns the
+        username or raises if the token is not valid
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(session_token, None)
+            if entry is not None and entry[1] > now:
+                # Back to the most recently used end
+                self.entries[session_token] = entry
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self.tokens.pop(entry[0], None)
+            self.misses += 1
+            generation = self.generation
+
+        username = load(session_token)
+
+        with self.lock:
+            if generation == self.generation:
+                self.store(session_token, username, now + self.ttl)
+        return username
+
+    def store(self, session_token, username, expires):
+        """
+        Caches a token. Must be called with the lock held.
+        """
+        previous_token = self.tokens.get(username)
+        if previous_token is not None and previous_token != session_token:
+            self.entries.pop(previous_token, None)
+        self.entries[session_token] = (username, expires)
+        self.tokens[username] = session_token
+
+        while len(self.entries) > self.max_sessions:
+            token, (evicted_username, expires) = self.entries.popitem(last=False)
+            if self.tokens.get(evicted_username) == token:
+                del self.tokens[evicted_username]
+
+    def invalidate(self, username, session_token=None):
+        """
+        Takes the token of a user out of the cache.
+
+        :param session_token: only if it is this one. Defaults to None, for
+        whichever token the user has.
+        """
+        with self.lock:
+            self.generation += 1
+            token = self.tokens.get(username)
+            if token is None or (session_token is not None and token != session_token):
+                return
+            del self.tokens[username]
+            self.entries.pop(token, None)
+
+    def stats(self):
+        """
+        Returns counters about the cache, as a dictionary:
+
+        session_cache_size: tokens cached
+        session_cache_hits: lookups answered from the cache
+        session_cache_misses: lookups that had to load the token
+        """
+        return {
+            'session_cache_size': len(self.entries),
+            'session_cache_hits': self.hits,
+            'session_cache_misses': self.misses,
+        }
@@ -0,0 +1,72 @@
+"""
+Defines the one-byte opcodes of every RDTP action.
+
+Both RDTPClient and RDTPServer go through this table: once a connection has
+negotiated opcodes (see the 'negotiate' action), the action of each frame is
+sent as its single opcode byte instead of its full name, and the receiver gets
+the name back with a single index into ACTIONS.
+"""
+
+# action name -> opcode
+OPCODES = {}
+
+# opcode -> action name (None for unassigned opcodes)
+ACTIONS = [None] * 256
+
+def register_action(name, opcode):
+    """
+    Assigns an opcode to an action.
+
+    :param name: the action name, as used by the string form of the protocol
+    :param opcode: an integer between 1 and 255, unique among all actions
+    :raises ValueError if the name or the opcode is already registered, or the opcode does not fit in a byte
+    """
+    if not 0 < opcode < len(ACTIONS):
+        raise ValueError("Opcode {} does not fit in one byte.".format(opcode))
+    if ACTIONS[opcode] is not None:
+        raise ValueError("Opcode {} is already used by {}.".format(opcode, ACTIONS[opcode]))
+    if name in OPCODES:
+        raise ValueError("Action {} already has an opcode.".format(name))
+
+    OPCODES[name] = opcode
+    ACTIONS[opcode] = name
+
+##################################
+### Server to client
+##################################
+register_action('R', 0x01)
+register_action('M', 0x02)
+register_action('KILL', 0x03)
+
+##################################
+### Connection setup
+##################################
+register_action('negotiate', 0x10)
+
+##################################
+### Either way
+##################################
+register_action('PING', 0x11)
+register_action('PONG', 0x12)
+
+##################################
+### Client to server
+##################################
+register_action('username_exists', 0x20)
+register_action('create_account', 0x21)
+register_action('login', 0x22)
+register_action('logout', 0x23)
+register_action('create_group', 0x24)
+register_action('add_to_group_current_user', 0x25)
+register_action('add_to_group', 0x26)
+register_action('send_user', 0x27)
+register_action('send_group', 0x28)
+register_action('get_groups', 0x29)
+register_action('get_users', 0x2A)
+register_action('fetch', 0x2B)
+register_action('send', 0x2C)
+register_action('users_online', 0x2D)
+register_action('get_users_in_group', 0x2E)
+register_action('fetch_since', 0x2F)
+register_action('add_users_to_group', 0x30)
+register_action('stats', 0x31)
@@ -0,0 +1,185 @@
+import asyncore
+import errno
+import socket
+from collections import deque
+
+import rdtp_common
+from rdtp_common import ClientDied
+
+class AsyncRDTPClient(asyncore.dispatcher):
+    """
+    A non-blocking RDTP client, meant for load generation rather than for
+    people. Any number of them share one thread and one asyncore loop, so a
+    single process can hold thousands of sessions (see run).
+
+    Nothing here blocks: requests take a callback, which is called with the
+    status and the response arguments once the response arrives. Requests
+    can be issued before the connection is even established; they are
+    buffered and written out as the socket becomes writable. Messages from
+    other users are counted, and handed to on_message if it is set.
+
+    This class uses asyncore, the asynchronous socket framework that ships
+    with Python 2. The documentation for asyncore can be found here:
+    [https://docs.python.org/2/library/asyncore.html]
+    """
+
+    def __init__(self, host, port, channel_map=None, on_message=None):
+        """
+        Starts connecting to a server, and negotiating every optional protocol
+        feature with it.
+
+        :param host: The host where this client should connect to
+        :param port: The port that this client should connect to
+        :param channel_map: The asyncore map this client is part of. Defaults to
+        asyncore's global map.
+        :param on_message: Called with every message from other users. Defaults to None.
+        """
+        asyncore.dispatcher.__init__(self, map=channel_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        self.decoder = rdtp_common.FrameDecoder()
+        self.encoder = rdtp_common.FrameEncoder()
+        self.outbound = deque()
+
+        # Callbacks of the requests waiting for a response, by request ID,
+        # and in order for responses without one
+        self.pending = {}
+        self.unnumbered = deque()
+        self.next_request_id = 0
+
+        self.on_message = on_message
+        self.messages_received = 0
+        self.session_token = None
+
+        self.connect((host, port))
+        self.request(self.negotiated, 'negotiate', *rdtp_common.FEATURES)
+
+    ##################################
+    ### Requests
+    ##################################
+
+    def request(self, callback, action, *args):
+        """
+        Queues a request to the server.
+
+        :param callback: Called with the status and the response arguments once
+        the response arrives, or None to ignore the response.
+        :param action: The action name
+        """
+        if self.encoder.request_ids:
+            request_id = self.next_request_id
+            self.next_request_id = (request_id + 1) & rdtp_common.REQUEST_ID_MAX
+            self.pending[request_id] = callback
+        else:
+            request_id = None
+            self.unnumbered.append(callback)
+
+        frame = self.encoder.encode(action, 0, args, request_id)
+        self.outbound.append(str(bytearray().join(frame)))
+
+    def negotiated(self, status, features):
+        """
+        Turns on whichever optional protocol features the server agreed to.
+        """
+        if status != 0:
+            return
+
+        self.encoder.opcodes = rdtp_common.FEATURE_OPCODES in features
+        self.encoder.fields = rdtp_common.FEATURE_FIELDS in features
+        self.encoder.request_ids = rdtp_common.FEATURE_REQUEST_IDS in features
+        if rdtp_common.FEATURE_COMPRESSION in features:
+            self.encoder.compress()
+
+    def create_account(self, username, password, callback=None):
+        self.request(callback, 'create_account', username, password)
+
+    def login(self, username, password, callback=None):
+        """
+        Logs in, and keeps the session token for the requests that need it.
+        """
+        def logged_in(status, response):
+            if status == 0:
+                self.session_token = response[0]
+            if callback:
+                callback(status, response)
+
+        self.request(logged_in, 'login', username, password)
+
+    def send_user(self, username, message, callback=None):
+        self.request(callback, 'send_user', self.session_token, username, message)
+
+    def send_group(self, group_name, message, callback=None):
+        self.request(callback, 'send_group', self.session_token, group_name, message)
+
+    def add_users_to_group(self, usernames, group_name, callback=None):
+        self.request(callback, 'add_users_to_group', self.session_token, group_name, *usernames)
+
+    def fetch(self, callback=None):
+        self.request(callback, 'fetch', self.session_token)
+
+    def fetch_since(self, since, limit, callback=None):
+        self.request(callback, 'fetch_since', self.session_token, str(since), str(limit))
+
+    ##################################
+    ### asyncore.dispatcher
+    ##################################
+
+    def writable(self):
+        return not self.connected or len(self.outbound) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        data = self.outbound[0]
+        sent = self.send(data)
+        if sent < len(data):
+            self.outbound[0] = data[sent:]
+        else:
+            self.outbound.popleft()
+
+    def handle_read(self):
+        try:
+            self.decoder.read_from(self.socket)
+        except ClientDied:
+            self.handle_close()
+            return
+        except socket.error as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        for action, status, args, request_id in self.decoder.frames():
+            if action == "R":
+                if request_id is not None:
+                    callback = self.pending.pop(request_id, None)
+                elif self.unnumbered:
+                    callback = self.unnumbered.popleft()
+                else:
+                    callback = None
+
+                if callback:
+                    callback(status, args)
+            elif action == "M":
+                self.messages_received += 1
+                if self.on_message:
+                    self.on_message(':'.join(args))
+            elif action == "PING":
+                self.outbound.append(str(bytearray().join(self.encoder.encode('PONG', 0, ()))))
+
+    def handle_close(self):
+        self.close()
+
+def run(channel_map=None, until=None, timeout=1):
+    """
+    Runs the asyncore loop of a set of clients.
+
+    :param channel_map: The asyncore map of the clients. Defaults to asyncore's global map.
+    :param until: A function called after every round of events; the loop stops
+    once it returns True. Defaults to running until every client is closed.
+    :param timeout: Seconds each round waits for events.
+    """
+    while channel_map if channel_map is not None else asyncore.socket_map:
+        if until is not None and until():
+            return
+        asyncore.loop(timeout=timeout, use_poll=True, map=channel_map, count=1)
@@ -2,19 +2,68 @@ import socket
 import sys
 import select
 import thread
-import Queue
+import threading
+from collections import deque
 
 import rdtp_common
 from rdtp_common import ClientDied
 from chat.chat_client import ChatClient
+from chat.chat_client import FETCH_PAGE
 
 MAX_RECV_LEN = 1024
 
+# Seconds to wait for a response before assuming the server will not answer
+RESPONSE_TIMEOUT = 3
+
 class BadMessageFormat(Exception):
     def __init__(self, message):
         self.message = message
     def __str__(self):
-        return "The following message was received from the server in bad format: {}.".format(message)
+        return "The following message was received from the server in bad format: {}.".format(self.message)
+
+def number(value):
+    """
+    The int or float a counter of the server was sent as (see RDTPClient.stats).
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+class ResponseFuture(object):
+    """
+    The response to a request that was sent to the server, which will be
+    filled in by the listener thread once it arrives.
+    """
+
+    def __init__(self, discard=None):
+        """
+        :param discard: Called if we give up waiting for the response, so that
+        the request stops being tracked. Defaults to None.
+        """
+        self.event = threading.Event()
+        self.response = None
+        self.discard = discard
+
+    def set_result(self, status, response):
+        self.response = (status, response)
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=RESPONSE_TIMEOUT):
+        """
+        Waits for the response.
+
+        :param timeout: seconds to wait before assuming the server will not respond
+        :return the status and the response arguments. On timeout, 3 and None.
+        """
+        if not self.event.wait(timeout):
+            if self.discard:
+                self.discard()
+            return 3, None
+        return self.response
 
 class RDTPClient(ChatClient):
     """
@@ -24,7 +73,14 @@ class RDTPClient(ChatClient):
     These are standard ways to do networking, and are considerably 
     low-level.
 
-    It also uses Queue in order to queue the messages received in the sockets.
+    Every request returns a ResponseFuture (see send). When the server
+    agrees to request IDs, responses are matched to requests by ID, so any
+    number of requests can be in flight on the connection at once:
+
+        futures = [client.send('send_user', token, user, msg) for user in users]
+        statuses = [future.result()[0] for future in futures]
+
+    Otherwise responses are matched to requests in the order they were sent.
     """
 
     def __init__(self, host, port):
@@ -32,10 +88,24 @@ class RDTPClient(ChatClient):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.username = None
         self.session_token = None
-
-        # This is synchronized which is cool since we
-        # want to use it across two different threads below
-        self.response_queue = Queue.Queue()
+        self.encoder = rdtp_common.FrameEncoder()
+
+        # Whether the server pages message queues (see fetch), and the
+        # sequence number of the last message we got from it
+        self.cursors = False
+        self.fetch_cursor = 0
+
+        # Requests waiting for a response, by request ID, and in order for
+        # responses without one. Both are shared with the listener thread,
+        # under lock, which is never held while writing to the socket, so
+        # that the listener keeps taking responses while a request goes out.
+        self.lock = threading.Lock()
+        # Held while encoding and writing a frame, so that frames (and the
+        # compression stream) go out whole and in order
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.unnumbered = deque()
+        self.next_request_id = 0
 
     ##################################
     ### Connectivity
@@ -47,6 +117,31 @@ class RDTPClient(ChatClient):
         # fork thread that will print received messages
         thread.start_new_thread(self.listener, ())
 
+        self.negotiate()
+
+    def negotiate(self):
+        """
+        Asks the server for the optional protocol features we support, and
+        turns on whichever it agrees to. Servers that do not know about
+        negotiation never answer, so once we give up on the answer (which
+        stops waiting for it, see discard_unnumbered) we just keep talking
+        the plain protocol.
+        """
+        status, response = self.send('negotiate', *rdtp_common.FEATURES).result()
+        if status != 0 or response is None:
+            return
+
+        if rdtp_common.FEATURE_OPCODES in response:
+            self.encoder.opcodes = True
+        if rdtp_common.FEATURE_FIELDS in response:
+            self.encoder.fields = True
+        if rdtp_common.FEATURE_REQUEST_IDS in response:
+            self.encoder.request_ids = True
+        if rdtp_common.FEATURE_COMPRESSION in response:
+            self.encoder.compress()
+        if rdtp_common.FEATURE_CURSORS in response:
+            self.cursors = True
+
     # Right now, the client only supports two types of actions. 'C' or 'M'
     def listener(self):
         """
@@ -54,39 +149,75 @@ class RDTPClient(ChatClient):
         and server responses. New messages are directly printed to stdout, server
         responses are queue'd up to be handled later
         """
+        decoder = rdtp_common.FrameDecoder()
         while 1: # listen forever
             try:
-                action, status, args = rdtp_common.recv(self.socket)
+                decoder.read_from(self.socket)
+                frames = decoder.frames()
             except ClientDied:
                 print "You were disconnected."
                 exit()
 
-            if action:
+            for action, status, args, request_id in frames:
+                if not action:
+                    continue
+
                 if action == "R": # Response
-                    self.response_queue.put((status, args))
+                    self.resolve(request_id, status, args)
                 elif action == "M": # Message
-                    message = args[0]
+                    # Without fields, colons in the message split it up
+                    message = ':'.join(args)
                     sys.stdout.write(message + "\n")
+                elif action == "PING": # The server checking on us
+                    self.pong()
                 elif action == "KILL":
                     while 1:
                         sys.stdout.write('\a')
                         sys.stdout.write('DIE HAHAHAHA\n')
                 else:
-                    raise BadMessageFormat(message)
+                    raise BadMessageFormat(action)
 
-    def getNextMessage(self):
+    def resolve(self, request_id, status, response):
         """
-        Gets the next message on the response queue. Usually called directly
-        after sending a message to the server.
+        Hands a response from the server to the request waiting for it.
+        Responses to requests we gave up on are dropped.
 
-        Has a three second timeout, and assumes that after that timeout the server
-        will not respond.
+        :param request_id: the ID the response carries, or None
         """
+        with self.lock:
+            if request_id is not None:
+                future = self.pending.pop(request_id, None)
+            elif self.unnumbered:
+                future = self.unnumbered.popleft()
+            else:
+                future = None
+
+        if future is not None:
+            future.set_result(status, response)
+
+    def pong(self):
+        """
+        Answers a ping from the server, which takes clients that stay quiet
+        for too long for dead. If a request is being written right now, that
+        is answer enough, and the listener does not wait for it.
+        """
+        if not self.write_lock.acquire(False):
+            return
         try:
-            status, response = self.response_queue.get(block=True, timeout=3)
-            return status, response
-        except Queue.Empty:
-            return 3, None
+            rdtp_common.send_frame(self.socket, self.encoder.encode('PONG', 0, ()))
+        finally:
+            self.write_lock.release()
+
+    def discard_unnumbered(self, future):
+        """
+        Stops waiting for the response to a request without an ID, so that
+        the responses to the requests after it still go to the right ones.
+        """
+        with self.lock:
+            try:
+                self.unnumbered.remove(future)
+            except ValueError:
+                pass
 
     def close(self):
         self.socket.close()
@@ -97,9 +228,35 @@ class RDTPClient(ChatClient):
 
     def send(self, action_name, *args):
         """
+        Sends a request to the server without waiting for its response.
         See the rdtp_common file for more information on how send works
+
+        :return a ResponseFuture for the response
         """
-        rdtp_common.send(self.socket, action_name, 0, *args)
+        future = ResponseFuture()
+
+        # Registering the request and writing it out go together, so that
+        # the order of the unnumbered requests is the order on the wire
+        with self.write_lock:
+            with self.lock:
+                if self.encoder.request_ids:
+                    request_id = self.next_request_id
+                    self.next_request_id = (request_id + 1) & rdtp_common.REQUEST_ID_MAX
+                    self.pending[request_id] = future
+                    future.discard = lambda: self.pending.pop(request_id, None)
+                else:
+                    request_id = None
+                    self.unnumbered.append(future)
+                    future.discard = lambda: self.discard_unnumbered(future)
+
+            frame = self.encoder.encode(action_name, 0, args, request_id)
+            if frame is None:
+                future.discard()
+                future.set_result(3, None)
+            else:
+                rdtp_common.send_frame(self.socket, frame)
+
+        return future
 
     # request is of type () ->
     def request_handler(self, callback, *args):
@@ -110,8 +267,7 @@ class RDTPClient(ChatClient):
 
         :return Return value matches that of the callback
         """
-        self.send(*args)
-        status, response = self.getNextMessage()
+        status, response = self.send(*args).result()
         return callback(status, response)
 
     # A request handler that just returns the status of the request
@@ -139,8 +295,7 @@ class RDTPClient(ChatClient):
 
         :return On success, returns 0. On failure, returns an integer that is handled on a per-action basis
         """
-        self.send('create_account', username, password)
-        status, response = self.getNextMessage()
+        status, response = self.send('create_account', username, password).result()
         if status != 0:
             return status
 
@@ -158,6 +313,16 @@ class RDTPClient(ChatClient):
         """Instructs server to add a user to a group."""
         return self.status_request_handler('add_to_group', username, group_id)
 
+    def add_users_to_group(self, usernames, group_id):
+        """Instructs server to add many users to a group at once.
+
+        :return On success, returns the list of usernames that do not exist, which were skipped.
+        On failure, returns an integer that is handled on a per-action basis."""
+        status, response = self.send('add_users_to_group', self.session_token, group_id, *usernames).result()
+        if status != 0:
+            return status
+        return [username for username in response if username]
+
     def login(self, username, password):
         """Login with given username and password.
         Returns boolean."""
@@ -167,14 +332,15 @@ class RDTPClient(ChatClient):
 
         # Login with new account
         # This logic should be moved to chat_client
-        self.send('login', username, password)
-        status, response = self.getNextMessage()
+        status, response = self.send('login', username, password).result()
 
         if status != 0:
             return status
 
         self.username = username
         self.session_token = response[0]
+        # Cursors are only good for the queue of the user they came from
+        self.fetch_cursor = 0
         return 0
 
     def logout(self):
@@ -182,12 +348,12 @@ class RDTPClient(ChatClient):
         :return indicating success or failure"""
         if not self.session_token:
             return False
-        self.send('logout', self.session_token)
-        status, response = self.getNextMessage()
+        status, response = self.send('logout', self.session_token).result()
 
         if status != 0:
             return status
 
+        # The connection, and everything negotiated on it, outlives the session
         self.username = None
         self.session_token = None
         return 0
@@ -197,11 +363,19 @@ class RDTPClient(ChatClient):
         Query the users that are currently online
 
         :return list of users logged into http-sucks-chat."""
-        self.send('users_online')
-        status, response = self.getNextMessage()
+        status, response = self.send('users_online').result()
         assert(status == 0)
         return response
 
+    def stats(self):
+        """
+        Query the counters of the server (see RDTPServer.stats)
+
+        :return dictionary of counter names to values"""
+        status, response = self.send('stats').result()
+        assert(status == 0)
+        return dict((response[i], number(response[i + 1])) for i in range(0, len(response) - 1, 2))
+
     def get_users_in_group(self, group):
         """
         Query the list of users in some group or some group matched by wildcards
@@ -210,8 +384,7 @@ class RDTPClient(ChatClient):
 
         :return list of users in some group (including possible wildcard characters)
         """
-        self.send('get_users_in_group', group)
-        status, response = self.getNextMessage()
+        status, response = self.send('get_users_in_group', group).result()
         assert(status == 0)
         return response
 
@@ -226,8 +399,7 @@ class RDTPClient(ChatClient):
         """
         if len(wildcard) == 0:
             wildcard = '.*'
-        self.send('get_groups', wildcard)
-        status, response = self.getNextMessage()
+        status, response = self.send('get_groups', wildcard).result()
         assert(status == 0)
         return response
 
@@ -242,8 +414,7 @@ class RDTPClient(ChatClient):
         """
         if len(wildcard) == 0:
             wildcard = '.*'
-        self.send('get_users', wildcard)
-        status, response = self.getNextMessage()
+        status, response = self.send('get_users', wildcard).result()
         assert(status == 0)
         return response
 
@@ -257,8 +428,7 @@ class RDTPClient(ChatClient):
         :return On success, 0. On failure, an integer corresponding to the error code
 
         """
-        self.send('send_user', self.session_token, user_id, message)
-        status, response = self.getNextMessage()
+        status, response = self.send('send_user', self.session_token, user_id, message).result()
         return status
 
     def send_group(self, group_id, message):
@@ -270,15 +440,43 @@ class RDTPClient(ChatClient):
 
         :return On success, 0. On failure, an integer corresponding to the error code
         """
-        self.send('send_group', self.session_token, group_id, message)
-        status, response = self.getNextMessage()
+        status, response = self.send('send_group', self.session_token, group_id, message).result()
         return status
 
     def fetch(self):
-        """Fetch new messages from the server."""
-        self.send('fetch', self.session_token)
-        status, response = self.getNextMessage()
-        if response is None or len(response) == 0 or response[0] == '':
+        """Fetch new messages from the server.
+
+        When the server pages queues, they are fetched FETCH_PAGE messages at a
+        time after our cursor, until an empty page, which acknowledges the
+        last of them. A page that is lost on the way is simply asked for again
+        with the same cursor, so nothing is lost if we get disconnected.
+        Otherwise, the queue is taken out a batch at a time, until an empty
+        batch."""
+        if not self.cursors:
+            # Queues come a batch at a time, until an empty one
+            batches = []
+            while 1:
+                status, response = self.send('fetch', self.session_token).result()
+                if status != 0 and not batches:
+                    return status
+                if status != 0 or response is None or len(response) == 0 or response[0] == '':
+                    break
+                batches.append(':'.join(response))
+            if not batches:
+                return "Your inbox is empty."
+            return '\n'.join(batches)
+
+        messages = []
+        while 1:
+            status, response = self.send('fetch_since', self.session_token, str(self.fetch_cursor),
+                                         str(FETCH_PAGE)).result()
+            if status != 0:
+                return status
+            self.fetch_cursor = int(response[0])
+            if len(response) == 1:
+                break
+            messages.extend(response[1:])
+
+        if len(messages) == 0:
             return "Your inbox is empty."
-        else:
-            return response[0]
+        return '\n'.join(messages)
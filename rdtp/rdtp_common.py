@@ -1,26 +1,149 @@
-import select
+import errno
+import logging
 import socket
+import struct
+import zlib
+from collections import deque
+
+from rdtp_actions import ACTIONS
+from rdtp_actions import OPCODES
+
+log = logging.getLogger(__name__)
 
 class ClientDied(Exception):
     def __str__(self):
         return "The client died."
 
+class MalformedFrame(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+    def __str__(self):
+        return "Received a malformed RDTP frame: {}.".format(self.reason)
+
+class SlowConsumer(Exception):
+    def __init__(self, username):
+        self.username = username
+    def __str__(self):
+        return "The client of {} is not reading its messages fast enough.".format(self.username)
+
 ##################################
 ### Real Data Transfer Protocol
 ##################################
 #
-# Magic number (1 byte) / Version (1 byte) /  Action (1 byte) /
-# Length (1 byte) / Message (Length bytes)
+# Version 1:
+# Magic number (1 byte) / Version (1 byte) / Status (1 byte) /
+# Action length (1 byte) / Message length (1 byte) / Action / Message
+#
+# Version 2:
+# Magic number (1 byte) / Version (1 byte) / Flags (1 byte) / Status (1 byte) /
+# Action length (2 bytes) / Message length (4 bytes) / Action / Message
+#
+# Every length field is unsigned and in network byte order. Both versions
+# start with the magic number and the version, so a receiver reads those
+# two bytes first and then knows which header layout follows.
+#
+# Flags (version 2 only):
+# FLAG_OPCODE: the action is a single opcode byte (see rdtp_actions)
+# FLAG_FIELDS: the message is a sequence of length-prefixed fields, instead
+#              of colon-delimited arguments
+# FLAG_REQUEST_ID: a request ID (4 bytes) follows the header. A response
+#              carries the ID of the request it answers, so a client can
+#              have many requests in flight on the same connection.
+# FLAG_COMPRESSED: the message is zlib compressed. Each direction of a
+#              connection is a single zlib stream (flushed at the end of
+#              every compressed message), so the compression history, and
+#              with it the dictionary, carries over from frame to frame.
+#
+# Field:
+# Type (1 byte) / Length (1 byte) / Value (Length bytes), for values shorter
+# than 255 bytes, or else
+# Type (1 byte) / 255 (1 byte) / Length (4 bytes) / Value (Length bytes)
+#
+# FIELD_STR values are UTF-8 text, FIELD_BYTES values are arbitrary binary
+# data and FIELD_INT values are 8-byte signed integers. Since every field
+# carries its own length, arguments can contain colons (or anything else).
+
+RDTP_MAGIC = 0x42
+RDTP_VERSION_1 = 1
+RDTP_VERSION_2 = 2
+RDTP_VERSION = RDTP_VERSION_2
+
+RDTP_PREAMBLE = struct.Struct('!BB')
+RDTP_V1_HEADER = struct.Struct('!BBBBB')
+RDTP_V2_HEADER = struct.Struct('!BBBBHI')
+RDTP_HEADER_LENGTH = RDTP_V2_HEADER.size
+
+FLAG_OPCODE = 0x01
+FLAG_FIELDS = 0x02
+FLAG_REQUEST_ID = 0x04
+FLAG_COMPRESSED = 0x08
+
+RDTP_REQUEST_ID = struct.Struct('!I')
+REQUEST_ID_MAX = 0xFFFFFFFF
+
+RDTP_FIELD_LONG_LENGTH = struct.Struct('!I')
+RDTP_FIELD_INT = struct.Struct('!q')
+
+# The length byte of fields whose (4-byte) length follows it
+FIELD_LONG = 0xFF
 
-RDTP_HEADER_LENGTH = 5
-RDTP_MAGIC = unichr(0x42)
-RDTP_VERSION = unichr(1)
-ARG_LEN_MAX = 256
+FIELD_STR = 0x01
+FIELD_BYTES = 0x02
+FIELD_INT = 0x03
+
+# The headers of the fields shorter than FIELD_LONG, by type and length,
+# so that arguments do not take a pack each
+SHORT_FIELD_HEADERS = dict((kind, [chr(kind) + chr(length) for length in range(FIELD_LONG)])
+                           for kind in (FIELD_STR, FIELD_BYTES, FIELD_INT))
+
+# Optional protocol features a client can ask for with the 'negotiate' action
+FEATURE_OPCODES = 'opcodes'
+FEATURE_FIELDS = 'fields'
+FEATURE_REQUEST_IDS = 'request_ids'
+FEATURE_COMPRESSION = 'zlib'
+# The client answers PING frames with PONG frames, so the server may ping it
+# when it has been quiet for a while, instead of taking it for dead
+FEATURE_HEARTBEATS = 'heartbeats'
+# The server pages message queues after a cursor, with the 'fetch_since' action.
+# Only granted along with FEATURE_FIELDS, which keeps messages in one argument each
+FEATURE_CURSORS = 'cursors'
+FEATURES = (FEATURE_OPCODES, FEATURE_FIELDS, FEATURE_REQUEST_IDS, FEATURE_COMPRESSION, FEATURE_HEARTBEATS,
+            FEATURE_CURSORS)
+
+# Messages shorter than this are not worth compressing
+COMPRESS_THRESHOLD = 256
+
+# Statuses any response may carry; the others are up to each action. Status 3
+# is what RDTPClient reports for requests that got no response in time.
+STATUS_OK = 0
+STATUS_BAD_ARGUMENTS = 4
+STATUS_UNKNOWN_ACTION = 5
+STATUS_SERVER_ERROR = 6
+
+
+# Maximum lengths of the action and of the message, per version
+ARG_LEN_MAX = 255
+ACTION_LEN_MAX = 0xFFFF
+MSG_LEN_MAX = 0xFFFFFFFF
+
+# Most bytes of action and message a frame we receive may have, well below
+# what the length fields allow, so that a peer cannot make us buffer (or
+# inflate) gigabytes for it
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# How much we ask the kernel for at once when reading from a connection
+RECV_CHUNK_SIZE = 65536
+
+# Most bytes of queued segments joined into a single send
+SEND_CHUNK_SIZE = 65536
+
+# Frames without a message, keyed by (action, status, version, flags)
+EMPTY_FRAMES = {}
 
 def recv_message(sock):
     """
     recv_message: receives a message formatted according to RDTP from a ready socket
-    Assumes the message is in the format of RDTP.
+    Assumes the message is in the format of RDTP, either version 1 or version 2.
     Assumes no dropped bytes.
 
     Parameters
@@ -31,75 +154,283 @@ def recv_message(sock):
     :return On success, returns the sent action, the status code, and the message delimited by colons
 
     """
-    # get the first 3 bytes which are supposed to be part of the preamble
-    header = recv_nbytes(sock, RDTP_HEADER_LENGTH)
-    assert(len(header) == RDTP_HEADER_LENGTH)
-
-    magic, version, status, action_len, msg_len = header[0], header[1], header[2], header[3], header[4]
-    assert(magic == RDTP_MAGIC)
-    assert(version == RDTP_VERSION)
-
-    # read in the expected message
-    action = recv_nbytes(sock, ord(action_len))
-    message = recv_nbytes(sock, ord(msg_len))
-    status_code = ord(status)
-
-    return action, status_code, message
+    action, status, args, request_id = recv_frame(sock)
+    return action, status, ':'.join(str(arg) for arg in args)
 
 def recv(sock):
     """
     recv receives a message on a socket, parses the output, and returns the different parts
-    the final part of the message is assumed to be colon-delimited
+    the final part of the message is assumed to be colon-delimited (see FrameDecoder for
+    messages made of fields)
 
     :param sock: A socket that has a message ready to be read
 
     :return On success, the action, response status, and a list of string arguments for the action
     """
-    action, status, message = recv_message(sock)
-    args = message.split(':')
+    action, status, args, request_id = recv_frame(sock)
     return action, status, args
 
+def recv_frame(sock):
+    """
+    recv_frame reads exactly one frame from a socket, blocking until all of it arrives,
+    and decodes it. Only meant for one-off reads; a connection that is read over and over
+    should have its own FrameDecoder.
+
+    :param sock: A socket that has a message ready to be read
+
+    :return the action, the status, the list of arguments and the request ID (or None)
+    """
+    # the magic number and the version tell us how long the rest of the header is
+    preamble = recv_nbytes(sock, RDTP_PREAMBLE.size)
+    magic, version = RDTP_PREAMBLE.unpack(preamble)
+    if magic != RDTP_MAGIC:
+        raise MalformedFrame('bad magic number {}'.format(magic))
+
+    flags = 0
+    if version == RDTP_VERSION_1:
+        header = preamble + recv_nbytes(sock, RDTP_V1_HEADER.size - RDTP_PREAMBLE.size)
+        _, _, status, action_len, msg_len = RDTP_V1_HEADER.unpack(header)
+    elif version == RDTP_VERSION_2:
+        header = preamble + recv_nbytes(sock, RDTP_V2_HEADER.size - RDTP_PREAMBLE.size)
+        _, _, flags, status, action_len, msg_len = RDTP_V2_HEADER.unpack(header)
+    else:
+        raise MalformedFrame('unknown version {}'.format(version))
+
+    check_frame_size(action_len, msg_len, MAX_FRAME_SIZE)
+    body_len = action_len + msg_len
+    if flags & FLAG_REQUEST_ID:
+        body_len += RDTP_REQUEST_ID.size
+
+    decoder = FrameDecoder(chunk_size=0)
+    decoder.feed(header + recv_nbytes(sock, body_len))
+    return decoder.frames()[0]
+
 def send(sock, action, status, *args):
     """
-    send acts as a wrapper for send_message. It just makes sure that the parts of the message
-    are joined by colons for later parsing. see send_message for details
+    send acts as a wrapper for send_frame. It just makes sure that the parts of the message
+    are separated by colons for later parsing. see send_message for details
     """
-    send_message(sock, action, status, ':'.join(args))
+    frame = encode_frame(action, status, args)
+    if frame is None:
+        return False
+    send_frame(sock, frame)
 
-def send_message(sock, action, status, message):
+def send_message(sock, action, status, message, version=RDTP_VERSION):
     """
     send_message: sends a message according to the RDTP protocol along the provided socket object
     Assumes that message is colon-delimited.
 
     :param sock: the socket object along which to send the message
-    :param action: specifies the specific action the sender wants the receiver to take. less than ARG_LEN_MAX.
+    :param action: specifies the specific action the sender wants the receiver to take. less than ACTION_LEN_MAX.
     Actions for the server to send specify whether the message is a message from another user or a server
     response to a previously requested action. Actions for the client to send are different commands available
     to the client.
     :param status: Different possible error code. The client always sends zero as a status, while the server is
     free to send any code that the client would understand.
+    :param message: the message itself. less than MSG_LEN_MAX (ARG_LEN_MAX for version 1).
+    :param version: the RDTP version to frame the message with. Defaults to RDTP_VERSION.
 
     """
-    msg_len = len(message)
-    if msg_len > ARG_LEN_MAX:
-    	print 'Message too long'
-    	return False
+    frame = encode_frame(action, status, (message,), version)
+    if frame is None:
+        return False
+
+    # Sends the actual message
+    send_frame(sock, frame)
+
+def encode_frame(action, status, args, version=RDTP_VERSION, opcodes=False, fields=False, request_id=None,
+                 compressor=None):
+    """
+    encode_frame: frames an action, a status and a list of arguments according to the RDTP protocol,
+    without copying the arguments into a single string. See send_message for the meaning of each parameter.
+
+    The frame is a list of segments (the header, the action, and the arguments with either the
+    colons or the field headers between them), which is all send_frame needs. A frame can be
+    sent any number of times, so a message going to many sockets only has to be framed once.
+
+    :param args: the list of arguments, which will be delimited by colons on the wire
+    :param opcodes: whether to send the action as its one-byte opcode. Only honored for version 2,
+    and for actions registered in rdtp_actions.
+    :param fields: whether to send the arguments as length-prefixed fields (see encode_field) rather
+    than delimited by colons. Only honored for version 2.
+    :param request_id: the request ID to tag the frame with, or None. Only honored for version 2.
+    :param compressor: the zlib compression object of the connection, or None. Messages of at least
+    COMPRESS_THRESHOLD bytes are compressed with it. Only honored for version 2.
+    :return On success, the list of segments. None if the action or the message do not fit in the
+    length fields of the requested version.
+    """
+    if isinstance(action, unicode):
+        action = action.encode('utf-8')
+
+    flags = 0
+    if opcodes and version == RDTP_VERSION_2 and action in OPCODES:
+        action = chr(OPCODES[action])
+        flags |= FLAG_OPCODE
+
+    segments = [None, action]
+    if request_id is not None and version == RDTP_VERSION_2:
+        flags |= FLAG_REQUEST_ID
+        segments.insert(1, RDTP_REQUEST_ID.pack(request_id))
+
+    msg_start = len(segments)
+    msg_len = 0
+    if fields and version == RDTP_VERSION_2:
+        flags |= FLAG_FIELDS
+        for arg in args:
+            field_header, value = encode_field(arg)
+            segments.append(field_header)
+            segments.append(value)
+            msg_len += len(field_header) + len(value)
+    else:
+        for i, arg in enumerate(args):
+            if isinstance(arg, unicode):
+                arg = arg.encode('utf-8')
+            if i > 0:
+                segments.append(':')
+                msg_len += 1
+            segments.append(arg)
+            msg_len += len(arg)
+
+    if compressor is not None and msg_len >= COMPRESS_THRESHOLD and version == RDTP_VERSION_2:
+        message = buffer(bytearray().join(segments[msg_start:]))
+        compressed = compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        segments[msg_start:] = [compressed]
+        msg_len = len(compressed)
+        flags |= FLAG_COMPRESSED
 
     action_len = len(action)
-    if action_len > ARG_LEN_MAX:
-    	print 'Action too long'
-    	return False
 
-    # Constructs RDTP message
-    to_send = RDTP_MAGIC + RDTP_VERSION + unichr(status)
-    to_send += unichr(action_len) + unichr(msg_len)
-    to_send += action
-    to_send += message
-    assert(len(to_send) == RDTP_HEADER_LENGTH + action_len + msg_len)
+    if version == RDTP_VERSION_1:
+        action_max, msg_max = ARG_LEN_MAX, ARG_LEN_MAX
+    else:
+        action_max, msg_max = ACTION_LEN_MAX, MSG_LEN_MAX
 
-    # Sends the actual message
-    sock.sendall(to_send)
+    if msg_len > msg_max:
+        log.warning("Message of %d bytes too long for RDTP version %d.", msg_len, version)
+        return None
+
+    if action_len > action_max:
+        log.warning("Action of %d bytes too long for RDTP version %d.", action_len, version)
+        return None
+
+    # Replies without a payload are by far the most common frames, so their
+    # headers are only ever packed once
+    if msg_len == 0 and not flags & FLAG_REQUEST_ID:
+        key = (action, status, version, flags)
+        frame = EMPTY_FRAMES.get(key)
+        if frame is None:
+            frame = EMPTY_FRAMES[key] = [pack_header(version, flags, status, action_len, 0), action]
+        return frame
+
+    segments[0] = pack_header(version, flags, status, action_len, msg_len)
+    return segments
+
+def is_compressed(frame):
+    """
+    is_compressed: whether a frame built by encode_frame carries a compressed message.
+    """
+    header = frame[0]
+    return ord(header[1]) == RDTP_VERSION_2 and bool(ord(header[2]) & FLAG_COMPRESSED)
+
+def encode_field(arg):
+    """
+    encode_field: turns an argument into a length-prefixed field. The type of the
+    field follows the type of the argument: str and unicode are FIELD_STR, bytearray
+    is FIELD_BYTES, and int and long are FIELD_INT.
+
+    :param arg: the argument to encode
+    :return the field header and the field value, as two separate segments
+    :raises TypeError if the argument is of none of the types above
+    """
+    if isinstance(arg, str):
+        kind, value = FIELD_STR, arg
+    elif isinstance(arg, unicode):
+        kind, value = FIELD_STR, arg.encode('utf-8')
+    elif isinstance(arg, bytearray):
+        kind, value = FIELD_BYTES, arg
+    elif isinstance(arg, (int, long)):
+        kind, value = FIELD_INT, RDTP_FIELD_INT.pack(arg)
+    else:
+        raise TypeError("Cannot send an argument of type {}.".format(type(arg).__name__))
+
+    length = len(value)
+    if length < FIELD_LONG:
+        return SHORT_FIELD_HEADERS[kind][length], value
+    return chr(kind) + chr(FIELD_LONG) + RDTP_FIELD_LONG_LENGTH.pack(length), value
+
+def decode_fields(buf, start, end):
+    """
+    decode_fields: decodes the fields between two offsets of a buffer, slicing every
+    argument straight out of it. The inverse of encode_field.
+
+    :param buf: a bytearray holding the fields
+    :param start: offset of the first field
+    :param end: offset right after the last field
+    :return the list of arguments: str for FIELD_STR, bytearray for FIELD_BYTES and int for FIELD_INT
+    :raises MalformedFrame if the fields do not exactly span the given range
+    """
+    args = []
+    offset = start
+    while offset < end:
+        if end - offset < 2:
+            raise MalformedFrame('truncated field header')
+        kind = buf[offset]
+        length = buf[offset + 1]
+        value_start = offset + 2
 
+        if length == FIELD_LONG:
+            if end - value_start < RDTP_FIELD_LONG_LENGTH.size:
+                raise MalformedFrame('truncated field header')
+            length, = RDTP_FIELD_LONG_LENGTH.unpack_from(buf, value_start)
+            value_start += RDTP_FIELD_LONG_LENGTH.size
+
+        offset = value_start + length
+        if offset > end:
+            raise MalformedFrame('truncated field')
+
+        if kind == FIELD_STR:
+            args.append(str(buf[value_start:offset]))
+        elif kind == FIELD_BYTES:
+            args.append(buf[value_start:offset])
+        elif kind == FIELD_INT and length == RDTP_FIELD_INT.size:
+            args.append(RDTP_FIELD_INT.unpack_from(buf, value_start)[0])
+        else:
+            raise MalformedFrame('bad field of type {}'.format(kind))
+
+    return args
+
+def check_frame_size(action_len, msg_len, max_frame_size):
+    """
+    check_frame_size: turns away the header of a frame bigger than we accept.
+
+    :raises MalformedFrame if the action and the message take more than max_frame_size bytes
+    """
+    if action_len + msg_len > max_frame_size:
+        raise MalformedFrame('frame of {} bytes, over the limit of {}'.format(action_len + msg_len,
+                                                                              max_frame_size))
+
+def pack_header(version, flags, status, action_len, msg_len):
+    """
+    pack_header: packs an RDTP header of the given version.
+
+    :return the header, as a string
+    """
+    if version == RDTP_VERSION_1:
+        return RDTP_V1_HEADER.pack(RDTP_MAGIC, version, status, action_len, msg_len)
+    return RDTP_V2_HEADER.pack(RDTP_MAGIC, version, flags, status, action_len, msg_len)
+
+def send_frame(sock, frame):
+    """
+    send_frame: writes a frame built by encode_frame to a socket. Blocks until the whole frame is sent.
+
+    The segments are joined once and sent with sendall (into a bytearray, since FIELD_BYTES
+    segments are bytearrays). Python 2 sockets have no vectored sendmsg to hand them to the
+    kernel as they are.
+
+    :param sock: the socket object along which to send the frame
+    :param frame: the list of segments returned by encode_frame
+    """
+    sock.sendall(bytearray().join(frame))
 
 def recv_nbytes(sock, n):
     """
@@ -110,20 +441,298 @@ def recv_nbytes(sock, n):
     :param n: number of bytes to read
 
     """
+    chunks = []
     bytes_received = 0
-    received = ""
     # keep on readin' until we get what we expected
     while bytes_received < n:
-        ready_to_read,_,_ = select.select([sock],[],[])
-        data = sock.recv(1, socket.MSG_PEEK)
+        new_recv = sock.recv(n - bytes_received)
+        if len(new_recv) == 0:
+            raise ClientDied
+        bytes_received += len(new_recv)
+        chunks.append(new_recv)
+    return ''.join(chunks)
+
+class OutboundQueue(object):
+    """
+    The frames waiting to be written to a non-blocking socket, as a queue of
+    segments. Frames are queued as they are, so a frame shared by many
+    connections is never copied per connection.
+    """
+
+    # Servers keep one per connection
+    __slots__ = ('segments', 'size')
+
+    def __init__(self):
+        self.segments = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, frame):
+        """
+        Queues a frame built by encode_frame.
+        """
+        for segment in frame:
+            if segment:
+                self.segments.append(segment)
+                self.size += len(segment)
+
+    def write_to(self, sock):
+        """
+        Writes as much of the queue to a non-blocking socket as it takes right now,
+        coalescing small segments into each send (Python 2 sockets have no
+        vectored sendmsg).
+
+        :param sock: the socket to write to
+        :return the number of bytes written
+        :raises socket.error for anything but the socket being full
+        """
+        written = 0
+
+        while self.segments:
+            try:
+                sent = sock.send(self.coalesce())
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            written += sent
+            self.consume(sent)
+
+        return written
+
+    def coalesce(self):
+        """
+        Joins the segments at the head of the queue into a single one (of up to
+        SEND_CHUNK_SIZE bytes, unless the first one is bigger already), so that
+        small frames do not take a send each.
+
+        :return the new head segment
+        """
+        segments = self.segments
+        if len(segments) > 1 and len(segments[0]) < SEND_CHUNK_SIZE:
+            chunk = []
+            chunk_size = 0
+            while segments and chunk_size + len(segments[0]) <= SEND_CHUNK_SIZE:
+                segment = segments.popleft()
+                chunk.append(segment)
+                chunk_size += len(segment)
+            if chunk:
+                segments.appendleft(str(bytearray().join(chunk)))
+        return segments[0]
+
+    def consume(self, n):
+        """
+        Drops the first n bytes of the queue, which were written.
+        """
+        self.size -= n
+        segments = self.segments
+        while n > 0:
+            segment = segments[0]
+            if n >= len(segment):
+                segments.popleft()
+                n -= len(segment)
+            else:
+                segments[0] = segment[n:]
+                n = 0
 
-        if len(data) == 0:
+class FrameEncoder(object):
+    """
+    Frames the outgoing messages of a single connection, according to what
+    was negotiated on it: the RDTP version the peer talks, whether actions
+    go out as opcodes, and whether arguments go out as fields.
+
+    On the server, request_id holds the ID of the request being handled on
+    this connection, which its response has to carry. On the client,
+    request_ids tells whether the server agreed to request IDs at all.
+
+    Once compression is turned on, compressor holds the zlib stream of this
+    direction of the connection.
+    """
+
+    # Servers keep one per connection
+    __slots__ = ('version', 'opcodes', 'fields', 'request_ids', 'request_id', 'compressor')
+
+    def __init__(self, version=RDTP_VERSION):
+        self.version = version
+        self.opcodes = False
+        self.fields = False
+        self.request_ids = False
+        self.request_id = None
+        self.compressor = None
+
+    def compress(self):
+        """
+        Turns on compression of large messages for the rest of the connection.
+        """
+        if self.compressor is None:
+            self.compressor = zlib.compressobj()
+
+    @property
+    def options(self):
+        """
+        Everything that changes how a frame looks on the wire. Two encoders
+        with the same options produce the same frames, except for compressed
+        ones (see is_compressed), which depend on everything sent before on
+        the connection, and cannot be shared.
+        """
+        return (self.version, self.opcodes, self.fields, self.compressor is not None)
+
+    def encode(self, action, status, args, request_id=None):
+        """
+        Frames a message. See encode_frame for details.
+        """
+        return encode_frame(action, status, args, self.version, self.opcodes, self.fields, request_id,
+                            self.compressor)
+
+class FrameDecoder(object):
+    """
+    Incrementally decodes the RDTP frames arriving on a single connection.
+
+    Each call to read_from does a single recv into a reusable chunk and appends
+    whatever arrived to the pending buffer. frames then parses every complete
+    frame in that buffer in one pass, and keeps any trailing partial frame around
+    until the rest of it arrives. Both RDTP versions are understood; the version
+    of the last decoded frame is kept in version, so replies can be framed the
+    way the peer expects. Compressed messages are inflated with the zlib stream
+    of the connection, which is set up with the first of them.
+    """
+
+    # Servers keep one per connection
+    __slots__ = ('buffer', 'chunk', 'chunk_view', 'version', 'decompressor', 'max_frame_size')
+
+    def __init__(self, chunk_size=RECV_CHUNK_SIZE, chunk=None, max_frame_size=MAX_FRAME_SIZE):
+        """
+        :param chunk_size: the most bytes a single read takes. Defaults to RECV_CHUNK_SIZE.
+        :param chunk: the bytearray to read into, in place of one of chunk_size
+        bytes. Decoders only ever read from one thread may share it, since
+        whatever is read is copied out at once. Defaults to None.
+        :param max_frame_size: the most bytes of action and message a frame may
+        have, before and after inflating it. Defaults to MAX_FRAME_SIZE.
+        """
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.chunk = chunk if chunk is not None else bytearray(chunk_size)
+        self.chunk_view = memoryview(self.chunk)
+        self.version = RDTP_VERSION
+        self.decompressor = None
+
+    def decompress(self, data):
+        """
+        Inflates a compressed message, carrying on the zlib stream of the connection.
+        A message inflates to at most max_frame_size bytes, so that a small
+        frame cannot make us allocate any amount of memory.
+
+        :raises MalformedFrame if the data is not part of a valid zlib stream,
+        or inflates to more than max_frame_size bytes
+        """
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+        try:
+            message = self.decompressor.decompress(data, self.max_frame_size)
+        except zlib.error as error:
+            raise MalformedFrame('bad compressed message ({})'.format(error))
+        if self.decompressor.unconsumed_tail:
+            raise MalformedFrame('compressed message inflates past the limit of {}'.format(self.max_frame_size))
+        return message
+
+    def read_from(self, sock, flags=0):
+        """
+        Reads whatever is available on sock (up to the chunk size) into the buffer.
+        Blocks if nothing is available and the socket is blocking (unless flags
+        includes socket.MSG_DONTWAIT).
+
+        :param sock: the socket to read from
+        :param flags: flags for recv_into. Defaults to 0.
+        :return the number of bytes read
+        :raises ClientDied if the peer closed the connection
+        """
+        n = sock.recv_into(self.chunk, 0, flags)
+        if n == 0:
             raise ClientDied
-        else:
-            assert(ready_to_read != [])
-            new_recv = sock.recv(n - bytes_received)
-            bytes_received += len(new_recv)
-            received += new_recv
-    assert(bytes_received == len(received))
-    return received
+        self.buffer += self.chunk_view[:n]
+        return n
+
+    def feed(self, data):
+        """
+        Appends already received data to the buffer.
+
+        :param data: a string with the received bytes
+        """
+        self.buffer += data
+
+    def frames(self):
+        """
+        Decodes every complete frame currently in the buffer, and drops them from it.
+
+        :return a list of (action, status, args, request_id) tuples, in the order they arrived.
+        args is the list of arguments, whether they were delimited by colons or sent as fields.
+        request_id is None for frames without one.
+        :raises MalformedFrame if the buffer does not hold an RDTP frame, or holds one bigger than max_frame_size
+        """
+        buf = self.buffer
+        end = len(buf)
+        offset = 0
+        frames = []
+
+        while end - offset >= RDTP_PREAMBLE.size:
+            magic, version = RDTP_PREAMBLE.unpack_from(buf, offset)
+            if magic != RDTP_MAGIC:
+                raise MalformedFrame('bad magic number {}'.format(magic))
+
+            flags = 0
+            if version == RDTP_VERSION_1:
+                header = RDTP_V1_HEADER
+                if end - offset < header.size:
+                    break
+                _, _, status, action_len, msg_len = header.unpack_from(buf, offset)
+            elif version == RDTP_VERSION_2:
+                header = RDTP_V2_HEADER
+                if end - offset < header.size:
+                    break
+                _, _, flags, status, action_len, msg_len = header.unpack_from(buf, offset)
+            else:
+                raise MalformedFrame('unknown version {}'.format(version))
+
+            # Before waiting for (and buffering) the rest of it
+            check_frame_size(action_len, msg_len, self.max_frame_size)
+
+            action_start = offset + header.size
+            request_id = None
+            if flags & FLAG_REQUEST_ID:
+                if end - action_start < RDTP_REQUEST_ID.size:
+                    break
+                request_id, = RDTP_REQUEST_ID.unpack_from(buf, action_start)
+                action_start += RDTP_REQUEST_ID.size
+
+            msg_start = action_start + action_len
+            msg_end = msg_start + msg_len
+            if msg_end > end:
+                break
+
+            if flags & FLAG_OPCODE:
+                action = ACTIONS[buf[action_start]] if action_len == 1 else None
+                if action is None:
+                    raise MalformedFrame('unknown opcode')
+            else:
+                action = str(buf[action_start:msg_start])
+
+            if flags & FLAG_COMPRESSED:
+                message = bytearray(self.decompress(buffer(buf, msg_start, msg_len)))
+                if flags & FLAG_FIELDS:
+                    args = decode_fields(message, 0, len(message))
+                else:
+                    args = str(message).split(':')
+            elif flags & FLAG_FIELDS:
+                args = decode_fields(buf, msg_start, msg_end)
+            else:
+                args = str(buf[msg_start:msg_end]).split(':')
+
+            frames.append((action, status, args, request_id))
+            self.version = version
+            offset = msg_end
 
+        del buf[:offset]
+        return frames
@@ -0,0 +1,204 @@
+"""
+The connections of an RDTPServer, and the users logged in through them.
+
+Every connection is a single RDTPConnection record, found in constant time
+either by its file descriptor (for the events of the poller) or by the user
+logged in through it (for the messages to that user). ConnectionRegistry
+keeps both indexes in step: a connection leaves both of them at once when it
+is removed, along with the user it held, so the server has a single place to
+learn whose presence a closed connection ends.
+"""
+
+import socket
+import sys
+import time
+from collections import deque
+
+import rdtp_common
+import rdtp_poller
+
+class RDTPConnection(object):
+    """
+    The state of a client connection: its socket, the frame decoder and
+    encoder that hold whatever was read of a partial frame and whatever was
+    negotiated with the client, and the frames waiting to be written to it.
+
+    There is one of these for every connection, most of them idle, so they
+    have slots rather than a dictionary of attributes.
+    """
+
+    __slots__ = ('sock', 'fd', 'decoder', 'encoder', 'outbound', 'writing', 'closed', 'username',
+                 'session_token', 'peer', 'busy', 'backlog', 'events', 'last_active', 'heartbeats',
+                 'pinged', 'connected_at', 'requests', 'read_bytes')
+
+    def __init__(self, sock, chunk=None):
+        """
+        :param sock: the socket of the connection
+        :param chunk: the bytearray the decoder receives into, which connections
+        read from a single thread can share. Defaults to one of its own.
+        """
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.decoder = rdtp_common.FrameDecoder(chunk=chunk)
+        self.encoder = rdtp_common.FrameEncoder()
+        self.outbound = rdtp_common.OutboundQueue()
+        # Whether the poller is watching the socket for writability
+        self.writing = False
+        self.closed = False
+        # The user logged in through this connection, and their session
+        self.username = None
+        self.session_token = None
+        # The worker at the other end, for connections between workers
+        self.peer = None
+        # Whether a request of this connection is on the handler pool, and
+        # the requests waiting for it, as (action, args, request_id)
+        self.busy = False
+        self.backlog = deque()
+        # The events the poller is watching the socket for
+        self.events = rdtp_poller.READ
+        # When we last read from the client, whether it answers pings, and
+        # whether we pinged it since
+        self.last_active = time.time()
+        self.heartbeats = False
+        self.pinged = False
+        # Counters, see ConnectionRegistry.stats
+        self.connected_at = self.last_active
+        self.requests = 0
+        self.read_bytes = 0
+
+    def idle(self):
+        """
+        Whether nothing is buffered or in progress on the connection.
+        """
+        return not (self.busy or self.backlog or self.outbound or self.decoder.buffer)
+
+def connection_bytes(connection):
+    """
+    Estimates the memory a connection takes in this process: its record, and
+    the objects that are its alone. Neither the kernel buffers of its socket
+    nor the zlib streams of compressing connections can be measured, so
+    they are left out.
+    """
+    parts = (connection, connection.sock, connection.decoder, connection.decoder.buffer,
+             connection.encoder, connection.outbound, connection.outbound.segments, connection.backlog)
+    size = sum(sys.getsizeof(part) for part in parts)
+    size += sum(sys.getsizeof(part.__dict__) for part in parts if hasattr(part, '__dict__'))
+    size += sum(sys.getsizeof(segment) for segment in connection.outbound.segments)
+    if connection.decoder.chunk is not ConnectionRegistry.shared_chunk:
+        size += sys.getsizeof(connection.decoder.chunk)
+    return size
+
+class ConnectionRegistry(object):
+    """
+    The connections of a server, by file descriptor, and the connection each
+    user is logged in through, by username.
+    """
+
+    # The receive chunk of every connection of the registry. They are all
+    # read from the event loop, one at a time, and the decoder copies out
+    # whatever arrives right away, so a single chunk does for all of them.
+    shared_chunk = bytearray(rdtp_common.RECV_CHUNK_SIZE)
+
+    def __init__(self):
+        self.by_fd = {}
+        self.by_user = {}
+
+    def __len__(self):
+        return len(self.by_fd)
+
+    def __iter__(self):
+        return self.by_fd.itervalues()
+
+    def connect(self, sock):
+        """
+        Creates the record of a new connection, and adds it.
+
+        :return the RDTPConnection
+        """
+        connection = RDTPConnection(sock, self.shared_chunk)
+        self.by_fd[connection.fd] = connection
+        return connection
+
+    def get(self, fd):
+        """
+        Returns the connection with a file descriptor, or None.
+        """
+        return self.by_fd.get(fd)
+
+    def for_socket(self, sock):
+        """
+        Returns the connection of a socket, or None if it is closed.
+        """
+        if sock is None:
+            return None
+        try:
+            connection = self.by_fd.get(sock.fileno())
+        except socket.error:
+            return None
+        if connection is None or connection.sock is not sock:
+            return None
+        return connection
+
+    def for_user(self, username):
+        """
+        Returns the connection a user is logged in through, or None.
+        """
+        return self.by_user.get(username)
+
+    def bind(self, connection, username, session_token):
+        """
+        Records that a user logged in through a connection, in place of
+        whichever connection they were logged in through before, and of
+        whichever user was logged in through this one.
+        """
+        self.unbind(connection)
+        previous = self.by_user.get(username)
+        if previous is not None:
+            previous.username = previous.session_token = None
+
+        connection.username = username
+        connection.session_token = session_token
+        self.by_user[username] = connection
+
+    def unbind(self, connection):
+        """
+        Records that the user of a connection is no longer logged in through it.
+
+        :return the (username, session_token) of that user, or None if there was none
+        """
+        username = connection.username
+        if username is None:
+            return None
+
+        session = (username, connection.session_token)
+        connection.username = connection.session_token = None
+        if self.by_user.get(username) is connection:
+            del self.by_user[username]
+        return session
+
+    def remove(self, connection):
+        """
+        Forgets a connection, and the user logged in through it.
+
+        :return the (username, session_token) of that user, or None if there was none
+        """
+        if self.by_fd.get(connection.fd) is connection:
+            del self.by_fd[connection.fd]
+        return self.unbind(connection)
+
+    def stats(self):
+        """
+        Returns counters about the connections, as a dictionary:
+
+        connections: open connections (to clients and to other workers)
+        logged_in_users: users logged in through them
+        idle_connections: connections with nothing buffered or in progress
+        idle_connection_bytes: the average memory each of those takes (see connection_bytes)
+        """
+        idle = [connection for connection in self.by_fd.itervalues() if connection.idle()]
+        return {
+            'connections': len(self.by_fd),
+            'logged_in_users': len(self.by_user),
+            'idle_connections': len(idle),
+            'idle_connection_bytes': sum(connection_bytes(connection) for connection in idle) / len(idle) if idle else 0,
+        }
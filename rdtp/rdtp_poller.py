@@ -0,0 +1,61 @@
+"""
+A thin wrapper around the readiness notification mechanism of the OS.
+
+Uses epoll where available (Linux) and poll everywhere else. Unlike select,
+neither of them is capped at FD_SETSIZE descriptors, and both keep the set
+of registered descriptors in the kernel, so waiting costs nothing per idle
+connection.
+"""
+
+import select
+
+READ = select.POLLIN
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP
+
+class Poller(object):
+    """
+    Waits for events on any number of file descriptors at once. Events are
+    level-triggered: a descriptor keeps being reported for as long as it is
+    ready, so callers may leave data behind and pick it up on the next poll.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.milliseconds = False
+        else:
+            self.poller = select.poll()
+            self.milliseconds = True
+
+    def register(self, fd, events):
+        """
+        Starts watching a file descriptor.
+
+        :param fd: the file descriptor
+        :param events: a combination of READ and WRITE
+        """
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        """
+        Changes the events a file descriptor is watched for.
+        """
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        """
+        Stops watching a file descriptor.
+        """
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        """
+        Blocks until some watched file descriptor is ready, or the timeout expires.
+
+        :param timeout: in seconds
+        :return a list of (fd, events) pairs
+        """
+        if self.milliseconds:
+            timeout = int(timeout * 1000)
+        return self.poller.poll(timeout)
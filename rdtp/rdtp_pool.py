@@ -0,0 +1,184 @@
+"""
+A bounded pool of threads for the request handlers that block on the
+database, so that a slow query does not freeze the event loop of
+RDTPServer, and with it every other connection.
+
+Handlers running on the pool must not touch the connections, which belong
+to the event loop. Whatever they need done there (like sending a response)
+is recorded on their task with defer, and done by the event loop once the
+task completes. The pool tells the event loop about completed tasks through
+a pipe, which the event loop watches along with its sockets.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+import Queue
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+class Task(object):
+    """
+    A function to run on the pool, and what it left for the event loop to do.
+    """
+
+    def __init__(self, function, args, connection=None, request_id=None):
+        """
+        :param function: the function to run
+        :param args: the arguments of the function
+        :param connection: the connection the task belongs to, if any. Defaults to None.
+        :param request_id: the ID of the request the task handles, if any. Defaults to None.
+        """
+        self.function = function
+        self.args = args
+        self.connection = connection
+        self.request_id = request_id
+        # (function, args) pairs, to be called on the event loop in order
+        self.callbacks = []
+        self.submitted = time.time()
+
+class HandlerPool(object):
+    """
+    A fixed number of threads running tasks in the order they were submitted.
+    """
+
+    def __init__(self, threads):
+        """
+        :param threads: how many threads to run
+        """
+        self.tasks = Queue.Queue()
+        self.completed = deque()
+        self.local = threading.local()
+
+        # Written by the threads whenever they complete a task, read by the event loop
+        self.wakeup_fd, self.notify_fd = os.pipe()
+        for fd in (self.wakeup_fd, self.notify_fd):
+            set_nonblocking(fd)
+
+        # Counters, see stats
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.max_pending = 0
+        self.tasks_done = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+
+        for i in range(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, function, args=(), connection=None, request_id=None):
+        """
+        Queues a function to run on the pool.
+
+        :return the Task
+        """
+        task = Task(function, args, connection, request_id)
+        with self.lock:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+        self.tasks.put(task)
+        return task
+
+    def current_task(self):
+        """
+        Returns the task being run by the calling thread, or None if it is
+        not one of the threads of the pool.
+        """
+        return getattr(self.local, 'task', None)
+
+    def defer(self, function, *args):
+        """
+        Makes the task being run by the calling thread call a function on the
+        event loop, once it completes.
+
+        :return True if the call was deferred, False if the calling thread is
+        not one of the threads of the pool (so the caller can go ahead)
+        """
+        task = getattr(self.local, 'task', None)
+        if task is None:
+            return False
+        task.callbacks.append((function, args))
+        return True
+
+    def work(self):
+        """
+        Runs tasks forever.
+        """
+        while 1:
+            task = self.tasks.get()
+            started = time.time()
+            self.local.task = task
+            try:
+                task.function(*task.args)
+            except Exception:
+                log.exception("A handler failed.")
+            finally:
+                self.local.task = None
+
+            with self.lock:
+                wait_time = started - task.submitted
+                self.pending -= 1
+                self.tasks_done += 1
+                self.wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+                self.run_time += time.time() - started
+
+            self.completed.append(task)
+            try:
+                os.write(self.notify_fd, 'x')
+            except OSError as error:
+                # The pipe is full, so the event loop has a wakeup coming anyway
+                if error.errno != errno.EAGAIN:
+                    raise
+
+    def completed_tasks(self):
+        """
+        Returns the tasks completed since the last call, in the order they
+        completed. Called by the event loop when wakeup_fd is readable.
+        """
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+        tasks = []
+        while self.completed:
+            tasks.append(self.completed.popleft())
+        return tasks
+
+    def stats(self):
+        """
+        Returns counters about the pool, as a dictionary:
+
+        pool_queue_depth: tasks submitted but not completed yet
+        pool_max_queue_depth: the most tasks ever waiting at once
+        pool_tasks: tasks completed so far
+        pool_wait_avg, pool_wait_max: seconds tasks waited for a thread
+        pool_run_avg: seconds tasks took to run
+        """
+        with self.lock:
+            done = self.tasks_done or 1
+            return {
+                'pool_queue_depth': self.pending,
+                'pool_max_queue_depth': self.max_pending,
+                'pool_tasks': self.tasks_done,
+                'pool_wait_avg': self.wait_time / done,
+                'pool_wait_max': self.max_wait_time,
+                'pool_run_avg': self.run_time / done,
+            }
+
+def set_nonblocking(fd):
+    """
+    Makes reads and writes on a file descriptor fail instead of blocking.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
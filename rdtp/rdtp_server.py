@@ -1,17 +1,209 @@
+import errno
+import logging
+import re
+import resource
 import socket
-import select
+import sys
+import time
+from chat.chat_log import Sampler
 from chat.chat_server import ChatServer
+from chat.chat_db import DEFAULT_BACKEND
+from chat.chat_db import DRAIN_BATCH
+from chat.chat_db import FETCH_LIMIT
 from chat.chat_db import GroupKeyError
 from chat.chat_db import UserKeyError
 from chat.chat_db import UserNotLoggedInError
 from chat.chat_db import GroupExists
 from chat.chat_db import GroupDoesNotExist
 from chat.chat_db import UsernameExists
+from chat.chat_db import UsernameDoesNotExist
 import rdtp_common
+import rdtp_poller
+from rdtp_connections import ConnectionRegistry
+import rdtp_pool
+import rdtp_timers
+from rdtp_actions import register_action
 from rdtp_common import ClientDied
+from rdtp_common import MalformedFrame
+from rdtp_common import SlowConsumer
+from rdtp_common import STATUS_BAD_ARGUMENTS
+from rdtp_common import STATUS_SERVER_ERROR
+from rdtp_common import STATUS_UNKNOWN_ACTION
 
-MAX_MSG_SIZE = 1024
-MAX_PENDING_CLIENTS = 10
+log = logging.getLogger(__name__)
+request_log = Sampler(log)
+
+MAX_PENDING_CLIENTS = socket.SOMAXCONN
+
+# Lets several processes listen on the same port, with the kernel spreading
+# the connections among them. Python 2 does not know the constant, which is
+# 15 on Linux, and which other systems may not have at all.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+# Seconds the event loop waits for events before looping anyway
+POLL_TIMEOUT = 3
+
+# Most chunks read from one connection per event, so that a client flooding
+# us cannot starve the others. Whatever is left is read on the next poll.
+MAX_READS_PER_EVENT = 16
+
+# Bytes of unwritten frames a client may have before it counts as a slow
+# consumer, and chat messages for it go by the slow consumer policy
+MAX_OUTBOUND_BYTES = 1024 * 1024
+
+# Responses are never subject to the policy, but a client whose outbound
+# queue grows this many times past the limit is disconnected regardless
+OUTBOUND_HARD_LIMIT_FACTOR = 4
+
+# What to do with chat messages for a slow consumer: drop them, spill them
+# to its message queue in the database (to be fetched later), or disconnect
+# it (spilling the message)
+SLOW_CONSUMER_DROP = 'drop'
+SLOW_CONSUMER_SPILL = 'spill'
+SLOW_CONSUMER_DISCONNECT = 'disconnect'
+SLOW_CONSUMER_POLICIES = (SLOW_CONSUMER_DROP, SLOW_CONSUMER_SPILL, SLOW_CONSUMER_DISCONNECT)
+
+# Threads running the handlers that block on the database (see rdtp_pool)
+HANDLER_THREADS = 8
+
+# Requests of a connection waiting for its earlier ones to be handled, after
+# which we stop reading from it until they are
+MAX_QUEUED_REQUESTS = 64
+
+# Seconds a client may go without sending us anything before it is taken for
+# dead, disconnected and logged out. Clients that agreed to heartbeats are
+# pinged halfway through, so they only need to answer.
+IDLE_TIMEOUT = 300
+
+# Most queued messages a fetch reply to a version 1 client could hold: the
+# shortest formatted message ("x >>> ") and its newline take 7 bytes
+V1_FETCH_PEEK = rdtp_common.ARG_LEN_MAX // 7 + 1
+
+# Seconds between the checks for idle clients (see rdtp_timers)
+TIMER_TICK = 1
+
+def raise_open_files_limit():
+    """
+    Raises the limit of open file descriptors of this process as far as we
+    are allowed to, since every client connection takes one.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, resource.error):
+            pass
+
+class Handler(object):
+    """
+    The handler of an action, and the arguments the action takes.
+    """
+
+    def __init__(self, function, min_args, max_args, validate, blocking):
+        self.function = function
+        self.min_args = min_args
+        self.max_args = max_args
+        self.validate = validate
+        self.blocking = blocking
+
+    def accepts(self, args):
+        """
+        Checks the arguments of a request before they are handed to the handler.
+
+        :param args: the list of arguments of the request
+        :return True if there are as many arguments as the action takes, and they are valid
+        """
+        if len(args) < self.min_args:
+            return False
+        if self.max_args is not None and len(args) > self.max_args:
+            return False
+        return self.validate is None or self.validate(*args)
+
+# Handlers of every action, by action name
+HANDLERS = {}
+
+# Handlers of the messages workers send each other (see join_workers), by action name
+BUS_HANDLERS = {}
+
+def handles(action, args=0, validate=None, opcode=None, registry=HANDLERS, blocking=False):
+    """
+    Decorator that makes a function the handler of an action. The function
+    is called with the server, the socket of the client and the arguments of
+    the request, and is expected to send the response. Requests with the wrong
+    arguments never reach it.
+
+    RDTPServer registers its own actions this way, and so can anyone adding
+    actions to it:
+
+        @handles('echo', args=(0, None), opcode=0x80)
+        def handle_echo(server, sock, *args):
+            server.send(sock, "R", 0, *args)
+
+    :param action: the action name
+    :param args: how many arguments the action takes: either a number, or a
+    (minimum, maximum) pair, where a maximum of None means any number. Defaults to 0.
+    :param validate: called with the arguments, returns whether they are valid. Defaults to None.
+    :param opcode: the opcode of a new action (see rdtp_actions). Defaults to None.
+    :param registry: where to register the handler. Defaults to HANDLERS, the
+    actions of clients; BUS_HANDLERS are the actions of other workers.
+    :param blocking: whether the handler blocks (on the database), and should
+    run on the handler pool rather than on the event loop. Defaults to False.
+    :raises ValueError if the action already has a handler
+    """
+    if isinstance(args, tuple):
+        min_args, max_args = args
+    else:
+        min_args = max_args = args
+
+    if action in registry:
+        raise ValueError("Action {} already has a handler.".format(action))
+    if opcode is not None:
+        register_action(action, opcode)
+
+    def register(function):
+        registry[action] = Handler(function, min_args, max_args, validate, blocking)
+        return function
+    return register
+
+def not_empty(*args):
+    """
+    Validates that no argument is empty.
+    """
+    return all(args)
+
+def cursor_arguments(session_token, since=0, limit=FETCH_LIMIT):
+    """
+    Validates the arguments of fetch_since: a cursor that is not negative,
+    and a page size that is positive.
+    """
+    try:
+        return int(since) >= 0 and int(limit) > 0
+    except ValueError:
+        return False
+
+def format_message(message):
+    """
+    Formats a queued message the way fetch hands it to clients.
+    """
+    if message['from_group_name'] is None:
+        return message['from_username'] + ' >>> ' + message['message']
+    return message['from_username'] + ' @ ' + message['from_group_name'] + ' >>> ' + message['message']
+
+def fitting_messages(messages):
+    """
+    How many of the oldest of some queued messages a fetch can answer with
+    in a version 1 frame, whose message holds at most ARG_LEN_MAX bytes.
+    """
+    length = -1
+    for i, message in enumerate(messages):
+        formatted = format_message(message)
+        if isinstance(formatted, unicode):
+            formatted = formatted.encode('utf-8')
+        # One newline between each message and the next
+        length += len(formatted) + 1
+        if length > rdtp_common.ARG_LEN_MAX:
+            return i
+    return len(messages)
 
 class RDTPServer(ChatServer):
     """
@@ -19,26 +211,115 @@ class RDTPServer(ChatServer):
 
     This class uses the Python-included socket and select libraries.
     These are standard ways to do networking, and are considerably 
-    low-level.
+    low-level. The event loop is built on epoll (or poll), through
+    rdtp_poller.
+
+    Nothing is ever written with a blocking call: frames go to the outbound
+    queue of the connection, which is written as far as the socket takes,
+    and the rest once the event loop finds the socket writable again.
+
+    The handlers that block on the database run on a pool of threads (see
+    rdtp_pool), one request of each connection at a time, so that their
+    responses keep the order of the requests.
+
+    Several servers can share a port, each in its own process (see
+    rdtp_workers). Each worker then tells the others which users are logged
+    in through it, and hands them the messages for their users.
+
+    Clients that stay quiet for longer than the idle timeout are disconnected
+    and logged out, so that half-open connections do not pile up, and their
+    users get their messages queued rather than written to a dead socket.
     """
     
-    def __init__(self, host, port):
-        ChatServer.__init__(self, host, port)
+    def __init__(self, host, port, slow_consumer_policy=SLOW_CONSUMER_SPILL,
+                 max_outbound_bytes=MAX_OUTBOUND_BYTES, reuse_port=False, threads=HANDLER_THREADS,
+                 idle_timeout=IDLE_TIMEOUT, presence_snapshot=None, db_backend=DEFAULT_BACKEND, db_path=None):
+        """
+        :param slow_consumer_policy: One of SLOW_CONSUMER_POLICIES. Defaults to spilling.
+        :param max_outbound_bytes: Bytes of unwritten frames a client may have
+        before it counts as a slow consumer.
+        :param reuse_port: Whether other processes may listen on the same port. Defaults to False.
+        :param threads: How many threads run the blocking handlers. With 0, they
+        run on the event loop. Defaults to HANDLER_THREADS.
+        :param idle_timeout: Seconds a client may stay quiet before it is
+        disconnected. With 0, clients are never disconnected for it. Defaults to IDLE_TIMEOUT.
+        :param presence_snapshot: See ChatServer. Defaults to None.
+        :param db_backend: See ChatServer. Defaults to MongoDB.
+        :param db_path: See ChatServer. Defaults to None.
+        """
+        ChatServer.__init__(self, host, port, presence_snapshot, db_backend, db_path)
+
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError("Unknown slow consumer policy: {}".format(slow_consumer_policy))
+        self.slow_consumer_policy = slow_consumer_policy
+        self.max_outbound_bytes = max_outbound_bytes
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        # Because of this line, recv and send won't block and will raise
-        # an error if they fail to send immediately.
-        # Because of the select.select, we can assume every recv
-        # will work correctly, but we have to try, except all sends
+        # Because of this line, accept won't block and will raise
+        # an error if there is no pending connection.
         self.socket.setblocking(0)
 
         # Magic to make socket reuse local addresses.
         # http://pubs.opengroup.org/onlinepubs/7908799/xns/getsockopt.html
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+        self.poller = rdtp_poller.Poller()
 
-        self.sockets = [self.socket]
-        self.sockets_by_user = {}
+        # Client connections, by file descriptor and by the user logged in through them
+        self.registry = ConnectionRegistry()
+
+        self.pool = rdtp_pool.HandlerPool(threads) if threads > 0 else None
+
+        # Every client connection is on the wheel, due when it would have
+        # been quiet for too long (see check_idle)
+        self.idle_timeout = idle_timeout
+        if idle_timeout > 0:
+            self.timers = rdtp_timers.TimerWheel(TIMER_TICK, int(idle_timeout / TIMER_TICK) + 1)
+        else:
+            self.timers = None
+        # The time the event loop last woke up
+        self.now = time.time()
+
+        # Frames of the group message being sent, by encoder options
+        self.group_frames = None
+
+        # When running as one of several workers: our index, the connections
+        # to the other workers by index, and the worker each user logged in
+        # through elsewhere is on
+        self.worker = None
+        self.peers = {}
+        self.user_workers = {}
+
+        # Users of other workers the group message being sent goes to, by worker
+        self.remote_deliveries = None
+
+        # Counters, see stats
+        self.written_bytes = 0
+        self.dropped_messages = 0
+        self.spilled_messages = 0
+        self.disconnected_consumers = 0
+        self.forwarded_messages = 0
+        self.evicted_connections = 0
+
+    def join_workers(self, worker, peers):
+        """
+        Makes this server one of several workers sharing a port. Must be
+        called before serve_forever.
+
+        :param worker: the index of this worker
+        :param peers: a connected socket to each of the other workers, by index
+        """
+        self.worker = worker
+        for index, sock in peers.iteritems():
+            sock.setblocking(0)
+            connection = self.registry.connect(sock)
+            connection.peer = index
+            connection.encoder.fields = True
+            self.peers[index] = connection
+            self.poller.register(connection.fd, rdtp_poller.READ)
 
     def serve_forever(self):
         """
@@ -47,259 +328,941 @@ class RDTPServer(ChatServer):
         it handles currently waiting responses.
         """
 
+        raise_open_files_limit()
+
         self.socket.bind((self.host, self.port))
         self.socket.listen(MAX_PENDING_CLIENTS)
-        print "RDTP Chat server listening on port %s" % self.port
+        self.poller.register(self.socket.fileno(), rdtp_poller.READ)
+        if self.pool is not None:
+            self.poller.register(self.pool.wakeup_fd, rdtp_poller.READ)
+        if self.worker is None:
+            log.info("RDTP Chat server listening on port %s", self.port)
+        else:
+            log.info("RDTP Chat server worker %s listening on port %s", self.worker, self.port)
 
         while 1:
-            # This blocks until we are ready to read some socket
-            ready_to_read,_,_ = select.select(self.sockets,[],[],3)
-
-            for sock in ready_to_read:
-                # New client connection!
-                # we accept the connection and get a new socket
-                # for it
-                if sock == self.socket:
-                    new_client_sock, client_addr = sock.accept()
-                    self.sockets.append(new_client_sock)
-                    print 'New client connection with address [%s:%s]' % client_addr
+            timeout = POLL_TIMEOUT
+            if self.timers is not None:
+                timeout = min(timeout, self.timers.timeout(time.time()))
+
+            # This blocks until some socket is ready to be read (or written)
+            ready = self.poller.poll(timeout)
+            self.now = time.time()
+            for fd, events in ready:
+                # New client connection(s)!
+                if fd == self.socket.fileno():
+                    self.accept_connections()
+                    continue
+
+                # Handlers finished on the pool
+                if self.pool is not None and fd == self.pool.wakeup_fd:
+                    for task in self.pool.completed_tasks():
+                        self.complete_task(task)
+                    continue
+
+                # A previous request in this round may have closed it
+                connection = self.registry.get(fd)
+                if connection is None:
+                    continue
+
+                # The client made room for more of its outbound queue
+                if events & rdtp_poller.WRITE:
+                    self.write_connection(connection)
+
                 # Old client wrote us something. It must be
-                # a message!
-                else:
-                    try:
-                        action, status, args = rdtp_common.recv(sock)
-                    except ClientDied:
-                        self.sockets.remove(sock)
-                        continue
+                # one or more messages!
+                if events & ~rdtp_poller.WRITE and not connection.closed:
+                    self.read_connection(connection)
+
+            if self.timers is not None:
+                for connection in self.timers.expired(self.now):
+                    self.check_idle(connection)
+
+    def accept_connections(self):
+        """
+        Accepts every pending client connection, and starts watching them.
+        """
+        while 1:
+            try:
+                new_client_sock, client_addr = self.socket.accept()
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            new_client_sock.setblocking(0)
+            connection = self.registry.connect(new_client_sock)
+            self.poller.register(connection.fd, rdtp_poller.READ)
+            if self.timers is not None:
+                self.timers.schedule(connection, self.idle_timeout)
+            log.debug('New client connection with address [%s:%s]', *client_addr)
+
+    def read_connection(self, connection):
+        """
+        Reads whatever a client sent us without blocking, and handles every
+        request that arrived whole. Partial requests stay in the decoder of the
+        connection until the rest of them arrives.
+
+        :param connection: the RDTPConnection of the client
+        """
+        connection.last_active = self.now
+        connection.pinged = False
+
+        died = False
+        try:
+            for i in range(MAX_READS_PER_EVENT):
+                connection.read_bytes += connection.decoder.read_from(connection.sock, socket.MSG_DONTWAIT)
+        except ClientDied:
+            died = True
+        except socket.error as error:
+            if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                died = True
+
+        try:
+            frames = connection.decoder.frames()
+        except MalformedFrame:
+            self.close_connection(connection)
+            return
+
+        # Answer in whichever RDTP version the client talks to us
+        connection.encoder.version = connection.decoder.version
+
+        sock = connection.sock
+        for action, status, args, request_id in frames:
+            if connection.closed:
+                return
+            if connection.peer is not None:
+                self.handle_bus_request(sock, action, args)
+            elif action:
+                self.dispatch(connection, action, args, request_id)
+            else:
+                log.debug('Client [%s:%s] is offline. Bye bye.', *sock.getpeername())
+                died = True
+                break
+
+        if died:
+            self.close_connection(connection)
+
+    def dispatch(self, connection, action, args, request_id):
+        """
+        Handles a request, unless the connection has earlier requests still
+        being handled, in which case it waits for them.
+
+        :param connection: the RDTPConnection of the client
+        :param request_id: the ID of the request, or None
+        """
+        connection.requests += 1
+        if connection.busy or connection.backlog:
+            connection.backlog.append((action, args, request_id))
+            if len(connection.backlog) >= MAX_QUEUED_REQUESTS:
+                self.watch(connection)
+            return
+
+        self.start_request(connection, action, args, request_id)
+
+    def start_request(self, connection, action, args, request_id):
+        """
+        Handles a request right away on the event loop, or starts handling it
+        on the pool if its handler blocks.
+        """
+        # Responses to this request must carry its ID
+        connection.encoder.request_id = request_id
 
-                    if action:
-                        print 'Client action: %s' % (action)
-                        self.handle_request(sock, action, args)
-                    else:
-                        print 'Client [%s:%s] is offline. Bye bye.' % (sock.getpeername())
-                        assert(sock in self.sockets)
-                        self.sockets.remove(sock)
+        handler = HANDLERS.get(action)
+        if self.pool is not None and handler is not None and handler.blocking:
+            connection.busy = True
+            self.pool.submit(self.handle_request, (connection.sock, action, args), connection, request_id)
+        else:
+            self.handle_request(connection.sock, action, args)
 
-    def create_account(self, username, password):
+    def complete_task(self, task):
         """
-        create_account attempts to create an account for a client. Initalizes a slot for a socket for the user
-        Uses mongoDB's interface to create an account by adding it to the database
+        Does what a task left for the event loop to do, and goes on with the
+        requests of its connection that were waiting for it.
+
+        :param task: an rdtp_pool.Task
+        """
+        connection = task.connection
+        if connection is not None:
+            connection.encoder.request_id = task.request_id
+
+        for function, args in task.callbacks:
+            function(*args)
+
+        if connection is None:
+            return
+        connection.busy = False
+        while connection.backlog and not connection.busy and not connection.closed:
+            action, args, request_id = connection.backlog.popleft()
+            self.start_request(connection, action, args, request_id)
+        if not connection.closed:
+            self.watch(connection)
+
+    def defer(self, function, *args):
+        """
+        Handlers running on the pool cannot touch the connections, so methods
+        that do start with
+
+            if self.defer(self.method, *args):
+                return
 
-        :param username: a string, no length to limit except by the RDTP protocol
-        :param password: a string, no length to limit except by RDTP protocol
+        which, on the pool, makes the event loop call the method once the
+        handler is done.
 
-        :return On success, returns True. On Failure, returns UsernameExists error
+        :return True if the call was deferred, False if we are on the event loop
         """
-        self.sockets_by_user[username] = None
-        super(RDTPServer, self).create_account(username, password)
+        return self.pool is not None and self.pool.defer(function, *args)
+
+    def spill(self, message, from_username, username, group_name=None):
+        """
+        Queues a message in the database, for a user it could not be delivered to.
+        """
+        if self.pool is not None and self.pool.current_task() is None:
+            self.pool.submit(self.chatDB.queue_message, (message, from_username, username, group_name))
+        else:
+            self.chatDB.queue_message(message, from_username, username, group_name)
+
+    def connection_for(self, sock):
+        """
+        Returns the RDTPConnection of a client socket, or None if it is closed.
+        """
+        return self.registry.for_socket(sock)
+
+    def write_connection(self, connection):
+        """
+        Writes as much of the outbound queue of a client as its socket takes
+        without blocking, and watches the socket for writability for as long
+        as something is left.
+
+        :param connection: the RDTPConnection of the client
+        """
+        try:
+            self.written_bytes += connection.outbound.write_to(connection.sock)
+        except socket.error:
+            self.close_connection(connection, flush=False)
+            return
+
+        writing = len(connection.outbound) > 0
+        if writing != connection.writing:
+            connection.writing = writing
+            self.watch(connection)
+
+    def watch(self, connection):
+        """
+        Watches a connection for reads, unless too many of its requests are
+        waiting already, and for writes while its outbound queue is not empty.
+
+        :param connection: the RDTPConnection of the client
+        """
+        events = 0
+        if len(connection.backlog) < MAX_QUEUED_REQUESTS:
+            events |= rdtp_poller.READ
+        if connection.writing:
+            events |= rdtp_poller.WRITE
+        if events != connection.events:
+            self.poller.modify(connection.fd, events)
+            connection.events = events
+
+    def check_idle(self, connection):
+        """
+        Called when a client connection comes up on the timer wheel: pings the
+        client if it has been quiet for half the idle timeout (and answers
+        pings), evicts it if it has been quiet for the whole of it, and
+        otherwise puts it back on the wheel for when it would be.
+
+        :param connection: the RDTPConnection of the client
+        """
+        if connection.closed:
+            return
+
+        idle = self.now - connection.last_active
+        # A request still on the pool is ours to answer, not the client's
+        if connection.busy:
+            self.timers.schedule(connection, self.idle_timeout)
+        elif idle >= self.idle_timeout:
+            log.info('Disconnecting client [%s], which was quiet for %d seconds.', connection.fd, idle)
+            self.evicted_connections += 1
+            self.evict(connection)
+        elif connection.heartbeats and idle >= self.idle_timeout / 2.0:
+            if not connection.pinged:
+                connection.pinged = True
+                self.send(connection.sock, "PING", 0)
+            self.timers.schedule(connection, self.idle_timeout - idle)
+        elif connection.heartbeats:
+            self.timers.schedule(connection, self.idle_timeout / 2.0 - idle)
+        else:
+            self.timers.schedule(connection, self.idle_timeout - idle)
+
+    def evict(self, connection):
+        """
+        Closes the connection of a client we take for dead. Its user is logged
+        out, so that messages for them are queued until they come back.
+
+        :param connection: the RDTPConnection of the client
+        """
+        self.close_connection(connection, flush=False)
+
+    def log_out_session(self, username, session_token):
+        """
+        Logs a user out in the database, once the connection they were logged
+        in through is gone, unless they logged in again since (with another
+        session token).
+        """
+        if self.pool is not None and self.pool.current_task() is None:
+            self.pool.submit(self.log_out_session, (username, session_token))
+            return
+
+        try:
+            self.logout(username, session_token)
+        except UserKeyError:
+            pass
+
+    def close_connection(self, connection, flush=True):
+        """
+        Forgets about a client connection and closes its socket. Every
+        connection closes through here, which is where the user logged in
+        through it, if any, goes offline: for the other workers, and in the
+        database.
+
+        :param connection: the RDTPConnection of the client
+        :param flush: whether to first write whatever of the outbound queue
+        the socket takes right away. Defaults to True.
+        """
+        if connection.closed:
+            return
+        connection.closed = True
+        if self.timers is not None:
+            self.timers.cancel(connection)
+        if flush and len(connection.outbound) > 0:
+            try:
+                self.written_bytes += connection.outbound.write_to(connection.sock)
+            except socket.error:
+                pass
+
+        session = self.registry.remove(connection)
+        self.poller.unregister(connection.fd)
+        connection.sock.close()
+
+        if connection.peer is not None:
+            log.warning('Lost worker %s.', connection.peer)
+            del self.peers[connection.peer]
+            for username, worker in self.user_workers.items():
+                if worker == connection.peer:
+                    del self.user_workers[username]
+                    self.presence.logout(username)
+        elif session is not None:
+            username, session_token = session
+            self.announce('offline', username)
+            self.log_out_session(username, session_token)
+
+    def close_socket(self, sock):
+        """
+        Forgets about a client connection and closes its socket.
+
+        :param sock: the socket object belonging to the client
+        """
+        if self.defer(self.close_socket, sock):
+            return
+
+        connection = self.connection_for(sock)
+        if connection is not None:
+            self.close_connection(connection)
 
     def kickout_user(self, username):
         """Kickout the current user. Used when a client logs in from a different place"""
-        try:
-            sock = self.sockets_by_user[username]
-            self.send(sock, 'M', 0, "You've been kicked, as someone has logged into your account. You should really be using 2FA.")
-            if sock in self.sockets:
-                self.sockets.remove(sock)
-                sock.close()
-        except KeyError:
-            print "Could not kickout the previous user, probably because he/she is leftover from a previous instantation of the server."
+        if self.defer(self.kickout_user, username):
+            return
+
+        if self.registry.for_user(username) is None and username in self.user_workers:
+            # Logged in through another worker
+            self.send_to_worker(self.user_workers[username], 'kickout', username)
+        else:
+            self.kickout_local_user(username)
+
+    def kickout_local_user(self, username):
+        """
+        Kickout a user logged in through this server. The new session takes
+        over their presence, so closing the old connection does not log them out.
+        """
+        connection = self.registry.for_user(username)
+        if connection is None:
+            log.info("Could not kickout the previous user, probably because he/she is leftover from a previous instantation of the server.")
+            return
+
+        self.registry.unbind(connection)
+        self.send(connection.sock, 'M', 0, "You've been kicked, as someone has logged into your account. You should really be using 2FA.")
+        self.close_connection(connection)
 
     def handle_request(self, sock, action, args):
         """
-        Dispatcher that actually calls the appropriate method for the requested client action
-        For responses, a status code of 0 is assumed to be all good for the client.
+        Dispatcher that actually calls the appropriate handler for the requested client action
+        (see handles). For responses, a status code of 0 is assumed to be all good for the client.
+        Requests for unknown actions, or with the wrong arguments, are answered with
+        STATUS_UNKNOWN_ACTION and STATUS_BAD_ARGUMENTS, and requests whose handler
+        fails with STATUS_SERVER_ERROR (or STATUS_BAD_ARGUMENTS for a bad regular
+        expression), so that every request gets its response.
 
         :param sock: the socket object belonging to the client that sent the message
         :param action: a string corresponding to the action the client wishes to take
         :param args: a list of strings corresponding to arguments required by the action
 
         """
-        print "Handling request. Action: {0}, args: {1}".format(action, args)
-        assert(len(args) > 0)
-        # As the command list grows, we could switch to a dictionary approach, since python lacks switches.
-        # Would give O(1) command lookup by hashing.
+        handler = HANDLERS.get(action)
+        if handler is None:
+            log.debug("Action not found: %s", action)
+            self.send(sock, "R", STATUS_UNKNOWN_ACTION)
+            return
 
-        ################
-        # Public actions
-        ################
-        if action == "username_exists":
-            username = args[0]
-            if not self.username_exists(username):
-                self.send(sock, "R", 0)
-            else:
-                self.send(sock, "R", 1)
+        # Without fields, even a message with no arguments splits into one
+        if args == [''] and handler.max_args == 0:
+            args = []
 
-        elif action == "create_account":
-            username = args[0]
-            password = args[1]
+        if not handler.accepts(args):
+            self.send(sock, "R", STATUS_BAD_ARGUMENTS)
+            return
 
-            try:
-                self.create_account(username, password)
-                self.send(sock, "R", 0)
-            except UsernameExists:
-                self.send(sock, "R", 2)
+        request_log("Handling request. Action: %s, args: %s", action, args)
 
-        elif action == "create_group":
-            group_id = args[0]
+        try:
+            handler.function(self, sock, *args)
+        except re.error:
+            log.debug("Bad regular expression for %s: %s", action, args)
+            self.send(sock, "R", STATUS_BAD_ARGUMENTS)
+        except Exception:
+            log.exception("The handler of %s failed.", action)
+            self.send(sock, "R", STATUS_SERVER_ERROR)
 
-            try:
-                self.create_group(group_id)
-                self.send(sock, "R", 0)
-            except GroupExists:
-                self.send(sock, "R", 2)
+    ################
+    # Public actions
+    ################
 
-        elif action == "login":
-            username = args[0]
-            password = args[1]
+    @handles("negotiate", args=(0, None))
+    def handle_negotiate(self, sock, *features):
+        # Agree on every optional feature the client asked for that we
+        # support. The reply itself still goes out the old way.
+        features = [feature for feature in features if feature in rdtp_common.FEATURES]
+        if rdtp_common.FEATURE_FIELDS not in features and rdtp_common.FEATURE_CURSORS in features:
+            # Pages are a message per argument, which only survive the trip
+            # when colons in messages do not split arguments
+            features.remove(rdtp_common.FEATURE_CURSORS)
+        self.send(sock, "R", 0, *features)
+        if rdtp_common.FEATURE_OPCODES in features:
+            self.encoder_for(sock).opcodes = True
+        if rdtp_common.FEATURE_FIELDS in features:
+            self.encoder_for(sock).fields = True
+        if rdtp_common.FEATURE_REQUEST_IDS in features:
+            self.encoder_for(sock).request_ids = True
+        if rdtp_common.FEATURE_COMPRESSION in features:
+            self.encoder_for(sock).compress()
+        if rdtp_common.FEATURE_HEARTBEATS in features:
+            self.connection_for(sock).heartbeats = True
 
-            success, session_token = self.login(username, password)
-            if success:
-                self.sockets_by_user[username] = sock
-                self.send(sock, "R", 0, session_token)
-            else:
-                self.send(sock, "R", 1)
+    # Anything a client sends keeps its connection alive (see check_idle), so
+    # there is nothing left to do with the answers to our pings. Clients may
+    # ping us too.
+    @handles("PING", args=(0, None))
+    def handle_ping(self, sock, *args):
+        self.send(sock, "PONG", 0)
 
-        elif action == "add_to_group_current_user":
-            session_token = args[0]
-            group_name = args[1]
+    @handles("PONG", args=(0, None))
+    def handle_pong(self, sock, *args):
+        pass
 
-            try:
-                username = self.username_for_session_token(session_token)
-                self.add_user_to_group(username, group_name)
-                self.send(sock, "R", 0)
-            except UserNotLoggedInError:
-                self.send(sock, "R", 1)
-            except GroupDoesNotExist:
-                self.send(sock, "R", 2)
+    @handles("username_exists", args=1, blocking=True)
+    def handle_username_exists(self, sock, username):
+        if not self.username_exists(username):
+            self.send(sock, "R", 0)
+        else:
+            self.send(sock, "R", 1)
 
-        elif action == "add_to_group":
-            username = args[0]
-            group_name = args[1]
+    @handles("create_account", args=2, validate=not_empty, blocking=True)
+    def handle_create_account(self, sock, username, password):
+        try:
+            self.create_account(username, password)
+            self.send(sock, "R", 0)
+        except UsernameExists:
+            self.send(sock, "R", 2)
 
-            try:
-                self.add_user_to_group(username, group_name)
-                self.send(sock, "R", 0)
-            except GroupDoesNotExist:
-                self.send(sock, "R", 2)
+    @handles("create_group", args=1, validate=not_empty, blocking=True)
+    def handle_create_group(self, sock, group_id):
+        try:
+            self.create_group(group_id)
+            self.send(sock, "R", 0)
+        except GroupExists:
+            self.send(sock, "R", 2)
 
-        elif action == "send_user":
-            session_token = args[0]
-            dest_user = args[1]
-            message = args[2]
+    @handles("login", args=2, blocking=True)
+    def handle_login(self, sock, username, password):
+        success, session_token = self.login(username, password)
+        if success:
+            self.logged_in(sock, username, session_token)
+            self.send(sock, "R", 0, session_token)
+        else:
+            self.send(sock, "R", 1)
 
-            try:
-                self.send_or_queue_message(session_token, message, dest_user)
-                self.send(sock, "R", 0)
-            except UserKeyError:
-                self.send(sock, "R", 2)
+    @handles("add_to_group_current_user", args=2, blocking=True)
+    def handle_add_to_group_current_user(self, sock, session_token, group_name):
+        try:
+            username = self.username_for_session_token(session_token)
+            self.add_user_to_group(username, group_name)
+            self.send(sock, "R", 0)
+        except UserNotLoggedInError:
+            self.send(sock, "R", 1)
+        except GroupDoesNotExist:
+            self.send(sock, "R", 2)
 
-            # TODO: Send C0 if user is not logged in.
-            # Will do this after we implement keeping track of sender username.
+    @handles("add_to_group", args=2, blocking=True)
+    def handle_add_to_group(self, sock, username, group_name):
+        try:
+            self.add_user_to_group(username, group_name)
+            self.send(sock, "R", 0)
+        except UsernameDoesNotExist:
+            self.send(sock, "R", 1)
+        except GroupDoesNotExist:
+            self.send(sock, "R", 2)
 
-        elif action == "send_group":
-            session_token = args[0]
-            dest_group = args[1]
-            message = args[2]
+    # Many users at once, in a single update of the database, by a logged
+    # in user. The response lists the usernames that do not exist, which
+    # were skipped.
+    @handles("add_users_to_group", args=(3, None), blocking=True)
+    def handle_add_users_to_group(self, sock, session_token, group_name, *usernames):
+        try:
+            self.username_for_session_token(session_token)
+            missing = self.add_users_to_group(usernames, group_name)
+            self.send(sock, "R", 0, *missing)
+        except UserNotLoggedInError:
+            self.send(sock, "R", 1)
+        except GroupDoesNotExist:
+            self.send(sock, "R", 2)
 
-            try:
-                self.send_message_to_group(session_token, message, dest_group)
-                self.send(sock, "R", 0)
-            except GroupDoesNotExist:
-                self.send(sock, "R", 2)
-            # TODO: Send C0 if user is not logged in.
-            # Will do this after we implement keeping track of sender username.
-
-        elif action == "get_groups":
-            wildcard = args[0]
-            if wildcard is None or wildcard == '':
-                wildcard = '*'
-
-            groups = [str(group['name']) for group in self.get_groups(wildcard)]
-            if len(groups) == 0:
-                self.send(sock, "R", 0)
-            else:
-                self.send(sock, "R", 0, *groups)
+    # Clients that do not send fields split messages at every colon, hence
+    # any number of arguments after the destination
+    @handles("send_user", args=(3, None), blocking=True)
+    def handle_send_user(self, sock, session_token, dest_user, *message):
+        try:
+            self.send_or_queue_message(session_token, ':'.join(message), dest_user)
+            self.send(sock, "R", 0)
+        except UserNotLoggedInError:
+            self.send(sock, "R", 1)
+        except UserKeyError:
+            self.send(sock, "R", 2)
+
+    @handles("send", args=(3, None), blocking=True)
+    @handles("send_group", args=(3, None), blocking=True)
+    def handle_send_group(self, sock, session_token, dest_group, *message):
+        try:
+            self.send_message_to_group(session_token, ':'.join(message), dest_group)
+            self.send(sock, "R", 0)
+        except UserNotLoggedInError:
+            self.send(sock, "R", 1)
+        except GroupDoesNotExist:
+            self.send(sock, "R", 2)
+
+    @handles("get_groups", args=(0, 1), blocking=True)
+    def handle_get_groups(self, sock, wildcard=None):
+        if wildcard is None or wildcard == '':
+            wildcard = '.*'
 
-        elif action == "get_users":
-            wildcard = args[0]
-            if wildcard is None or wildcard == '':
-                wildcard = '*'
+        groups = [str(group['name']) for group in self.get_groups(wildcard)]
+        self.send(sock, "R", 0, *groups)
 
-            users = [str(user['username']) for user in self.get_users(wildcard)]
-            if len(users) == 0:
+    @handles("get_users", args=(0, 1), blocking=True)
+    def handle_get_users(self, sock, wildcard=None):
+        if wildcard is None or wildcard == '':
+            wildcard = '.*'
+
+        users = [str(user['username']) for user in self.get_users(wildcard)]
+        self.send(sock, "R", 0, *users)
+
+    @handles("users_online", args=0, blocking=True)
+    def handle_users_online(self, sock):
+        self.send(sock, "R", 0, *[str(username) for username in self.users_online()])
+
+    @handles("get_users_in_group", args=1, blocking=True)
+    def handle_get_users_in_group(self, sock, group_name):
+        try:
+            users = self.get_users_in_group(group_name)
+            self.send(sock, "R", 0, *[str(username) for username in users])
+        except GroupDoesNotExist:
+            self.send(sock, "R", 2)
+
+    @handles("stats")
+    def handle_stats(self, sock):
+        # The counters of stats(), as name and value pairs. Runs on the event
+        # loop, which owns the connections and buffers they count
+        stats = self.stats()
+        self.send(sock, "R", 0, *[str(field) for name in sorted(stats) for field in (name, stats[name])])
+
+    #################################
+    # Authentication required actions
+    #################################
+
+    @handles("fetch", args=1, blocking=True)
+    def handle_fetch(self, sock, session_token):
+        # A batch of the oldest queued messages, taken out of the queue. A
+        # full batch means there may be more to fetch again
+        try:
+            username = self.username_for_session_token(session_token)
+            limit = DRAIN_BATCH
+            if self.encoder_for(sock).version == rdtp_common.RDTP_VERSION_1:
+                # Version 1 frames only hold ARG_LEN_MAX bytes, so only the
+                # messages that fit are taken. Status 2 means the oldest one
+                # never will, which is left queued for a newer client.
+                queued = self.get_user_queued_messages(username, V1_FETCH_PEEK)
+                limit = fitting_messages(queued)
+                if limit == 0:
+                    self.send(sock, "R", 2 if queued else 0)
+                    return
+            messages = self.drain_user_message_queue(username, limit)
+            if len(messages) == 0:
                 self.send(sock, "R", 0)
             else:
-                self.send(sock, "R", 0, *users)
+                messageString = '\n'.join(format_message(message) for message in messages)
+                self.send(sock, "R", 0, messageString)
+        except UserNotLoggedInError:
+            log.debug("Could not deliver messages to client with session_token %s because this client is not logged in.", session_token)
+            self.send(sock, "R", 1)
 
-        #################################
-        # Authentication required actions
-        #################################
-        elif action == "fetch":
-            session_token = args[0]
-            try:
-                username = self.username_for_session_token(session_token)
-                messages = self.get_user_queued_messages(username)
-                if len(messages) == 0:
-                    self.send(sock, "R", 0)
-                else:
-                    ret = []
-                    for message in messages:
-                        if message['from_group_name'] is None:
-                            ret.append(message['from_username'] + ' >>> ' + message['message'])
-                        else:
-                            ret.append(message['from_username'] + ' @ ' + message['from_group_name'] + ' >>> ' + message['message'])
-
-                    messageString = '\n'.join(ret)
-                    self.send(sock, "R", 0, messageString)
-                    self.clear_user_message_queue(username)
-            except UserNotLoggedInError:
-                print "Could not deliver messages to client with session_token {} because this client is not logged in.".format(session_token)
-
-        elif action == "send":
-            self.send_message_to_group(args[2], int(args[1]))
-
-        elif action == "logout":
-            session_token = args[0]
-            try:
-                username = self.username_for_session_token(session_token)
-                self.logout(username)
-                del self.sockets_by_user[username]
-                self.send(sock, "R", 0)
-            except UserKeyError:
-                self.send(sock, "R", 1)
-            except UserNotLoggedInError:
-                self.send(sock, "R", 2)
-        else:
-            print "Action not found."
+    @handles("fetch_since", args=(1, 3), validate=cursor_arguments, blocking=True)
+    def handle_fetch_since(self, sock, session_token, since=0, limit=FETCH_LIMIT):
+        # A page of the queue after the client's cursor, which acknowledges
+        # the pages up to it. The response is the cursor to ask with next
+        # (the same cursor if there are no messages), and then the messages;
+        # a page shorter than the limit is the last one.
+        since = int(since)
+        try:
+            username = self.username_for_session_token(session_token)
+            cursor, messages = self.fetch_user_messages(username, since, int(limit))
+        except (UserNotLoggedInError, UserKeyError):
+            log.debug("Could not deliver messages to client with session_token %s because this client is not logged in.", session_token)
+            self.send(sock, "R", 1)
+            return
+
+        self.send(sock, "R", 0, str(cursor), *[format_message(message) for message in messages])
+
+    @handles("logout", args=1, blocking=True)
+    def handle_logout(self, sock, session_token):
+        try:
+            username = self.username_for_session_token(session_token)
+            self.logout(username)
+            self.logged_out(username)
+            self.send(sock, "R", 0)
+        except UserKeyError:
+            self.send(sock, "R", 1)
+        except UserNotLoggedInError:
+            self.send(sock, "R", 2)
+
+    def logged_in(self, sock, username, session_token):
+        """
+        Remembers the connection a user logged in through, and tells the
+        other workers.
+        """
+        if self.defer(self.logged_in, sock, username, session_token):
+            return
+
+        connection = self.connection_for(sock)
+        if connection is None:
+            # Gone before the login completed, so log them right back out
+            self.log_out_session(username, session_token)
+            return
+        self.registry.bind(connection, username, session_token)
+        self.announce('online', username)
+
+    def logged_out(self, username):
+        """
+        Forgets the connection of a user who logged out, and tells the other workers.
+        """
+        if self.defer(self.logged_out, username):
+            return
+
+        connection = self.registry.for_user(username)
+        if connection is not None:
+            self.registry.unbind(connection)
+        self.announce('offline', username)
+
+    def send_message_to_group(self, session_token, message, group_name):
+        """
+        Same as ChatServer's, but the message frame is only built once for
+        the whole group, and then shared among all online members (see send_user).
+        Members logged in through other workers are handed to each of those
+        workers at once, in a single message.
+        """
+        self.start_group()
+        try:
+            super(RDTPServer, self).send_message_to_group(session_token, message, group_name)
+        finally:
+            self.finish_group(message, group_name)
+
+    def start_group(self):
+        """
+        Starts sharing frames among the deliveries of a group message.
+        """
+        if self.defer(self.start_group):
+            return
+
+        self.group_frames = {}
+        self.remote_deliveries = {}
+
+    def finish_group(self, message, group_name):
+        """
+        Hands a group message to the other workers with members of the group,
+        and stops sharing frames.
+        """
+        if self.defer(self.finish_group, message, group_name):
+            return
+
+        try:
+            for (worker, from_username), usernames in self.remote_deliveries.iteritems():
+                try:
+                    self.send_to_worker(worker, 'deliver', from_username, group_name, message, *usernames)
+                except ClientDied:
+                    for username in usernames:
+                        self.spill(message, from_username, username, group_name)
+        finally:
+            self.group_frames = None
+            self.remote_deliveries = None
 
     def send_user(self, message, from_username, username, group_name = None):
         """
         send a user (or a group!) a message. Does not return.
 
+        Users logged in through another worker get the message through it.
+
         Parameters:
         :param message: The actual message. Assumed to be less than the permitted message length by RDTP
         :param from_username: the sender's name
         :param username: the receiver's name
         :param group_name: Default none, but can specify a pre-existing group
         """
-        user_sock = self.sockets_by_user[username]
-        rdtp_message = ""
-        if group_name:
-            rdtp_message = "{0} @ {1} >>> {2}".format(from_username, group_name, message)
-        else:
-            rdtp_message = "{0} >>> {1}".format(from_username, message)
+        if self.defer(self.deliver, message, from_username, username, group_name):
+            return
+
+        worker = self.user_workers.get(username)
+        if worker is not None and self.registry.for_user(username) is None:
+            self.forwarded_messages += 1
+            if group_name and self.remote_deliveries is not None:
+                self.remote_deliveries.setdefault((worker, from_username), []).append(username)
+            else:
+                self.send_to_worker(worker, 'deliver', from_username, group_name or '', message, username)
+            return
+
+        self.send_local_user(message, from_username, username, group_name)
+
+    def deliver(self, message, from_username, username, group_name = None):
+        """
+        Same as send_user, but queues the message in the database if it cannot
+        be delivered. Deliveries deferred from the pool go through here, since
+        by the time they happen, nobody is left to catch the failure.
+        """
+        try:
+            self.send_user(message, from_username, username, group_name)
+        except Exception:
+            self.spill(message, from_username, username, group_name)
+
+    def send_local_user(self, message, from_username, username, group_name = None):
+        """
+        Same as send_user, but only for users logged in through this server.
+
+        :raises ClientDied if the user is not connected to this server
+        """
+        # The message is queued in the database if we raise
+        connection = self.registry.for_user(username)
+        if connection is None:
+            raise ClientDied()
 
         if message == "you don't deserve to live":
-            self.send(user_sock, "KILL", 0, "")
-        else:
-            self.send(user_sock, "M", 0, rdtp_message)
+            self.send(connection.sock, "KILL", 0, "")
+            return
 
-    def send(self, sock, action, status, *args):
+        if len(connection.outbound) >= self.max_outbound_bytes:
+            self.handle_slow_consumer(connection, username)
+            return
+
+        # Members of a group get the very same frame, so only build it once
+        # per set of encoder options in use, unless it had to be compressed
+        encoder = connection.encoder
+        sharing = group_name and self.group_frames is not None
+        frame = self.group_frames.get(encoder.options) if sharing else None
+        if frame is None:
+            if group_name:
+                rdtp_message = "{0} @ {1} >>> {2}".format(from_username, group_name, message)
+            else:
+                rdtp_message = "{0} >>> {1}".format(from_username, message)
+            frame = encoder.encode("M", 0, (rdtp_message,))
+            if sharing and not rdtp_common.is_compressed(frame):
+                self.group_frames[encoder.options] = frame
+
+        self.send_frame(connection.sock, frame)
+
+    def handle_slow_consumer(self, connection, username):
+        """
+        Applies the slow consumer policy to a chat message for a client whose
+        outbound queue is full.
+
+        :param connection: the RDTPConnection of the client
+        :param username: the user the message is for
+        :raises SlowConsumer if the message should be queued in the database instead
+        """
+        if self.slow_consumer_policy == SLOW_CONSUMER_DROP:
+            self.dropped_messages += 1
+            return
+
+        if self.slow_consumer_policy == SLOW_CONSUMER_DISCONNECT:
+            log.warning('Disconnecting %s, who is not reading its messages.', username)
+            self.disconnected_consumers += 1
+            self.close_connection(connection, flush=False)
+
+        self.spilled_messages += 1
+        raise SlowConsumer(username)
+
+    ##################################
+    ### Workers
+    ##################################
+
+    def send_to_worker(self, worker, action, *args):
+        """
+        Sends a message to another worker (see BUS_HANDLERS).
+
+        :param worker: the index of the worker
+        :raises ClientDied if we lost the worker
+        """
+        connection = self.peers.get(worker)
+        if connection is None:
+            raise ClientDied()
+        self.send_frame(connection.sock, connection.encoder.encode(action, 0, args))
+
+    def announce(self, action, username):
+        """
+        Tells every other worker that a user logged in ('online') or went
+        away ('offline') through this one.
+        """
+        if self.defer(self.announce, action, username):
+            return
+
+        for worker in self.peers.keys():
+            self.send_to_worker(worker, action, username)
+
+    def handle_bus_request(self, sock, action, args):
         """
-        See rdtp_common file for more details on send.
+        Dispatcher for the messages of other workers. They never get a response.
+
+        :param sock: the socket of the connection to the worker
+        :param action: a string corresponding to the action
+        :param args: a list of strings corresponding to arguments required by the action
         """
+        handler = BUS_HANDLERS.get(action)
+        if handler is None or not handler.accepts(args):
+            log.error("Bad message from another worker: %s", action)
+            return
+
+        handler.function(self, sock, *args)
+
+    @handles("online", args=1, registry=BUS_HANDLERS)
+    def handle_bus_online(self, sock, username):
+        self.user_workers[username] = self.connection_for(sock).peer
+        # Logging in there ended any session they had here
+        self.sessions.invalidate(username)
+        self.presence.login(username)
+
+    @handles("offline", args=1, registry=BUS_HANDLERS)
+    def handle_bus_offline(self, sock, username):
+        # Their session ended there (a logout, or a kickout), so its token
+        # must not stay valid here until it expires from the cache
+        self.sessions.invalidate(username)
+        if self.user_workers.get(username) == self.connection_for(sock).peer:
+            del self.user_workers[username]
+            self.presence.logout(username)
+
+    @handles("kickout", args=1, registry=BUS_HANDLERS)
+    def handle_bus_kickout(self, sock, username):
+        self.kickout_local_user(username)
+
+    @handles("deliver", args=(4, None), registry=BUS_HANDLERS)
+    def handle_bus_deliver(self, sock, from_username, group_name, message, *usernames):
+        # Whoever is not here anymore gets the message queued instead
+        self.group_frames = {}
         try:
-            rdtp_common.send(sock, action, status, *args)
-        except Exception as error:
-            print 'Failed to send message to client.'
-            print error
+            for username in usernames:
+                try:
+                    self.send_local_user(message, from_username, username, group_name or None)
+                except Exception:
+                    self.spill(message, from_username, username, group_name or None)
+        finally:
+            self.group_frames = None
+
+    def encoder_for(self, sock):
+        """
+        Returns the frame encoder of a client connection, which knows how
+        the client expects its frames.
+        """
+        connection = self.connection_for(sock)
+        return connection.encoder if connection else rdtp_common.FrameEncoder()
+
+    def send(self, sock, action, status, *args):
+        """
+        See rdtp_common file for more details on send. Responses ("R") are
+        tagged with the ID of the request being handled, if it had one.
+        """
+        if self.defer(self.send, sock, action, status, *args):
+            return
+
+        encoder = self.encoder_for(sock)
+        request_id = encoder.request_id if action == "R" else None
+        self.send_frame(sock, encoder.encode(action, status, args, request_id))
+
+    def send_frame(self, sock, frame):
+        """
+        Queues a frame built with rdtp_common.encode_frame for a client. Unless
+        the client is already behind, its queue is written right away, as far
+        as the socket takes; the event loop writes the rest.
+        """
+        if frame is None or self.defer(self.send_frame, sock, frame):
+            return
+
+        connection = self.connection_for(sock)
+        if connection is None:
+            log.debug('Failed to send message to client.')
+            return
+
+        connection.outbound.push(frame)
+        if connection.peer is None and \
+                len(connection.outbound) > self.max_outbound_bytes * OUTBOUND_HARD_LIMIT_FACTOR:
+            log.warning('Disconnecting client [%s], which is not reading its responses.', connection.fd)
+            self.disconnected_consumers += 1
+            self.close_connection(connection, flush=False)
+        elif not connection.writing:
+            self.write_connection(connection)
+
+    def stats(self):
+        """
+        Returns counters about the server, as a dictionary (which clients get
+        with the stats action):
+
+        queued_bytes: bytes of frames waiting to be written to clients
+        written_bytes: bytes written to clients so far
+        dropped_messages: chat messages dropped for slow consumers
+        spilled_messages: chat messages queued in the database for slow consumers
+        disconnected_consumers: clients disconnected for being too slow
+        forwarded_messages: chat messages handed to other workers
+        remote_users: users logged in through other workers
+        evicted_connections: clients disconnected for staying quiet too long
+
+        plus the counters of the connections (see rdtp_connections), of the
+        session cache (see chat_sessions), and of the handler pool, if any
+        (see rdtp_pool).
+        """
+        stats = {
+            'queued_bytes': sum(len(connection.outbound) for connection in self.registry),
+            'written_bytes': self.written_bytes,
+            'dropped_messages': self.dropped_messages,
+            'spilled_messages': self.spilled_messages,
+            'disconnected_consumers': self.disconnected_consumers,
+            'forwarded_messages': self.forwarded_messages,
+            'remote_users': len(self.user_workers),
+            'evicted_connections': self.evicted_connections,
+        }
+        stats.update(self.registry.stats())
+        stats.update(self.sessions.stats())
+        if self.pool is not None:
+            stats.update(self.pool.stats())
+        return stats
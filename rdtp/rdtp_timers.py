@@ -0,0 +1,86 @@
+"""
+A timer wheel, which RDTPServer uses to find the connections that have gone
+quiet without looking at every connection it has.
+
+The wheel is a ring of slots, one per tick. Scheduling an item drops it in
+the slot as many ticks ahead as its delay, and every tick empties one slot,
+so both cost the same however many items there are. Delays longer than the
+wheel are cut short: the item just comes up early, and is scheduled again.
+"""
+
+import math
+import time
+
+class TimerWheel(object):
+    """
+    Items (anything hashable) scheduled to come up after a delay, to the
+    nearest tick.
+    """
+
+    def __init__(self, tick, slots):
+        """
+        :param tick: seconds between ticks
+        :param slots: how many ticks ahead items can be scheduled
+        """
+        self.tick = tick
+        self.slots = [set() for i in range(slots + 1)]
+        self.position = 0
+        self.next_tick = time.time() + tick
+        # The slot of every scheduled item, so it can be moved or cancelled
+        self.slot_of = {}
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def schedule(self, item, delay):
+        """
+        Schedules an item to come up after a delay, in place of whenever it was
+        scheduled before.
+
+        :param delay: the delay in seconds, rounded up to whole ticks
+        """
+        ticks = int(math.ceil(delay / self.tick))
+        ticks = min(max(ticks, 1), len(self.slots) - 1)
+        slot = (self.position + ticks) % len(self.slots)
+
+        self.cancel(item)
+        self.slots[slot].add(item)
+        self.slot_of[item] = slot
+
+    def cancel(self, item):
+        """
+        Unschedules an item, if it was scheduled.
+        """
+        slot = self.slot_of.pop(item, None)
+        if slot is not None:
+            self.slots[slot].discard(item)
+
+    def timeout(self, now):
+        """
+        Returns the seconds until the next tick is due.
+        """
+        return max(0, self.next_tick - now)
+
+    def expired(self, now):
+        """
+        Advances the wheel by every tick due by now.
+
+        :return the items that came up, which are no longer scheduled
+        """
+        items = []
+        # After a stall longer than the wheel, one turn comes up with everything
+        for i in range(len(self.slots)):
+            if self.next_tick > now:
+                break
+            self.position = (self.position + 1) % len(self.slots)
+            self.next_tick += self.tick
+            slot = self.slots[self.position]
+            if slot:
+                for item in slot:
+                    del self.slot_of[item]
+                items.extend(slot)
+                slot.clear()
+
+        if self.next_tick <= now:
+            self.next_tick = now + self.tick
+        return items
@@ -0,0 +1,91 @@
+"""
+Runs an RDTP chat server as several processes (workers), so that it can
+use more than one core.
+
+Every worker is a whole RDTPServer listening on the same port, with
+SO_REUSEPORT, so the kernel spreads the client connections among them. The
+workers are connected to each other by Unix socket pairs, over which they
+talk RDTP too: each worker announces the users that log in through it, and
+hands the other workers the messages for their users (see join_workers in
+rdtp_server).
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+
+from rdtp_server import RDTPServer
+from rdtp_server import SO_REUSEPORT
+
+log = logging.getLogger(__name__)
+
+def serve_forever(host, port, workers, **options):
+    """
+    Starts the workers, and waits for them. If one of them dies, the others
+    are stopped as well.
+
+    :param host: The host the workers listen on
+    :param port: The port the workers listen on
+    :param workers: How many workers to start
+    :param options: Passed on to each RDTPServer
+    :raises ValueError if the system cannot share a port among processes
+    """
+    if SO_REUSEPORT is None:
+        raise ValueError("This system does not support SO_REUSEPORT.")
+
+    # buses[i][j] is the end worker i has of the connection to worker j
+    buses = [{} for index in range(workers)]
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            buses[i][j], buses[j][i] = socket.socketpair()
+
+    pids = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            for other in range(workers):
+                if other != index:
+                    for sock in buses[other].itervalues():
+                        sock.close()
+            run_worker(host, port, index, buses[index], options)
+
+        pids.append(pid)
+
+    for bus in buses:
+        for sock in bus.itervalues():
+            sock.close()
+
+    # Being terminated stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        pid, status = os.wait()
+        log.warning("Worker %s exited. Stopping the others.", pids.index(pid))
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+def run_worker(host, port, index, peers, options):
+    """
+    Runs a single worker, in the process forked for it. Never returns.
+
+    :param index: The index of the worker
+    :param peers: A connected socket to each of the other workers, by index
+    :param options: Passed on to the RDTPServer
+    """
+    try:
+        server = RDTPServer(host, port, reuse_port=True, **options)
+        server.join_workers(index, peers)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        log.exception("Worker %s failed.", index)
+    finally:
+        logging.shutdown()
+        os._exit(1)
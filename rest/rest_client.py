@@ -1,4 +1,5 @@
 from chat.chat_client import ChatClient
+from chat.chat_client import FETCH_PAGE
 from functools import wraps
 import requests
 import sys
@@ -41,6 +42,8 @@ class RESTClient(ChatClient):
         self.username = None
         self.session = None
         self.base_url = 'http://' + host + ':' + str(port)
+        # The sequence number of the last message we got (see fetch)
+        self.fetch_cursor = 0
 
     ###########
     ## USERS ##
@@ -96,6 +99,9 @@ class RESTClient(ChatClient):
         except:
             return 1
 
+        # Cursors are only good for the queue of the user they came from
+        self.fetch_cursor = 0
+
         return 0
 
     @check_session
@@ -165,18 +171,31 @@ class RESTClient(ChatClient):
         Fetch new messages from the server. Assumes that a session is already in place,
         and tries to fetch messages for the currently logged in account.
 
+        Messages are fetched FETCH_PAGE at a time after our cursor, until an
+        empty page, which acknowledges the last of them. A page that is lost
+        on the way is simply asked for again with the same cursor. Servers
+        that do not page queues answer the first request with all of them.
+
         :return: On success, returns a string containing all of the messages (or 
         "No new messages".) On failure, returns 1 if there was no session in place, and
         2 for other possible errors (see __handle_error).
         """
 
-        response = self.session.get(self.base_url + '/users/' + self.username + '/messages')
-        r = response.json()
+        messages = []
+        while 1:
+            response = self.session.get(self.base_url + '/users/' + self.username + '/messages',
+                                        params={'since': self.fetch_cursor, 'limit': FETCH_PAGE})
+            r = response.json()
 
-        if 'errors' in r:
-            return self.__handle_error(r)
+            if 'errors' in r:
+                return self.__handle_error(r)
 
-        messages = r['data']['messages']
+            messages.extend(r['data']['messages'])
+            if 'cursor' not in r['data']:
+                break
+            self.fetch_cursor = r['data']['cursor']
+            if r['data']['messages'] == []:
+                break
 
         if messages == []:
             return "No new messages."
@@ -239,6 +258,29 @@ class RESTClient(ChatClient):
 
         return 0
 
+    @check_session
+    def add_users_to_group(self, usernames, group_name):
+        """
+        Adds many users to a group at once. Assumes that a session is already
+        in place, like add_user_to_group.
+
+        :param usernames: The usernames of the users to be added
+        :param group_name: The name of the group to which we should add
+
+        :return: the list of usernames that do not exist (which were skipped)
+        on success, or else 1 if the session is invalid, 2 for other possible
+        errors (see __handle_error).
+        """
+
+        data = {'data': {'usernames': list(usernames)}}
+        response = self.session.post(self.base_url + '/groups/' + group_name + '/users', json=data)
+        r = response.json()
+
+        if 'errors' in r:
+            return self.__handle_error(r)
+
+        return r['data']['missing']
+
     @check_session
     def send_group(self, group_name, message):
         """
@@ -6,6 +6,8 @@ from bson import json_util
 
 from rest import rest_errors
 from chat.chat_server import ChatServer
+from chat.chat_db import DEFAULT_BACKEND
+from chat.chat_db import FETCH_LIMIT
 from chat.chat_db import GroupKeyError
 from chat.chat_db import UserKeyError
 from chat.chat_db import UserNotLoggedInError
@@ -40,17 +42,23 @@ class RESTServer(ChatServer):
     [http://flask.pocoo.org/docs/0.10/]
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, presence_snapshot=None, db_backend=DEFAULT_BACKEND, db_path=None):
         """
         Initializes a ChatServer on the given host and port, using
         Flask. Also initializes all the possible routes that this server
         will accept, calling the appropriate handlers.
 
+        Users logged in through REST are online, but messages cannot be
+        pushed to them, so they always get their messages queued.
+
         :param host: The host where this client should connect to
         :param port: The port that this client should connect to
+        :param presence_snapshot: See ChatServer. Defaults to None.
+        :param db_backend: See ChatServer. Defaults to MongoDB.
+        :param db_path: See ChatServer. Defaults to None.
         """
 
-        ChatServer.__init__(self, host, port)
+        ChatServer.__init__(self, host, port, presence_snapshot, db_backend, db_path)
         self.app = Flask("HTTPServer")
 
         # Login/Logout routes
@@ -231,15 +239,19 @@ class RESTServer(ChatServer):
         """
         Handles an add_user_to_group operation. This uses the Flask request 
         to get the group_id that is passed in the HTTP request. Assumes
-        the user is logged in.
+        the user is logged in. A list of usernames instead of a username adds
+        them all at once, skipping those that do not exist.
 
         :return: On success, JSON containing the group_id and
-        the username (and code 200). On failure, JSON containing the error code 
-        (as defined in rest_errors.py).
+        the username, or the usernames that do not exist (and code 200). On
+        failure, JSON containing the error code (as defined in rest_errors.py).
         """
 
         try:
-            username = request.json['data']['username']
+            data = request.json['data']
+            if 'usernames' in data:
+                return self.add_users_to_group_response(list(data['usernames']), group_id)
+            username = data['username']
         except:
             return rest_errors.bad_request()
 
@@ -254,6 +266,24 @@ class RESTServer(ChatServer):
 
         return json.dumps({'data': {'group_id': group_id, 'username': username}}), 201
 
+    def add_users_to_group_response(self, usernames, group_id):
+        """
+        Adds many users to a group for handle_add_user_to_group.
+
+        :return: On success, JSON containing the group_id and the usernames
+        that do not exist (and code 201). On failure, JSON containing the error
+        code (as defined in rest_errors.py).
+        """
+
+        try:
+            missing = self.add_users_to_group(usernames, group_id)
+        except GroupDoesNotExist:
+            return rest_errors.not_found()
+        except:
+            return rest_errors.internal_server_error()
+
+        return json.dumps({'data': {'group_id': group_id, 'missing': missing}}), 201
+
     @check_authorization
     def handle_get_groups(self):
         """
@@ -344,34 +374,47 @@ class RESTServer(ChatServer):
         """
         Handles a fetch operation. Assumes that the user is logged in.
 
+        Without a since query, takes a batch of at most DRAIN_BATCH of the
+        oldest queued messages; a full batch means there may be more to fetch
+        again. With one, returns a
+        page of at most limit (also a query) messages after that cursor, and
+        acknowledges the ones up to it (see ChatServer.fetch_user_messages),
+        along with the cursor to ask with next.
+
         :param user_id: The user_id that required this fetch.
 
         :return: On success, JSON containing a list of messages (and code 200)
         On failure, JSON containing the error code (as defined in rest_errors.py).
         """
 
+        since = request.args.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+                limit = int(request.args.get('limit', FETCH_LIMIT))
+            except ValueError:
+                return rest_errors.bad_request()
+            if since < 0 or limit <= 0:
+                return rest_errors.bad_request()
+
         try:
-            messages = self.get_user_queued_messages(user_id)
-            self.clear_user_message_queue(user_id)
+            if since is None:
+                messages = self.drain_user_message_queue(user_id)
+            else:
+                cursor, messages = self.fetch_user_messages(user_id, since, limit)
         except UserKeyError:
             return rest_errors.not_found()
         except:
             return rest_errors.internal_server_error()
 
-        return json.dumps({'data': {'messages': messages}})
+        if since is None:
+            return json.dumps({'data': {'messages': messages}})
+
+        return json.dumps({'data': {'messages': messages, 'cursor': cursor}})
 
     ##########
     ## MISC ##
     ##########
-    @check_authorization
-    def is_online(self, user_id):
-        """
-        Returns whether a user is online.
-
-        :return: False, since REST does not keep users connected.
-        """
-
-        return False
 
     def serve_forever(self):
         """ 
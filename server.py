@@ -1,16 +1,42 @@
 import socket
 import sys
 from rdtp.rdtp_server import RDTPServer
-from rest.rest_server import RESTServer
+from rdtp.rdtp_server import SLOW_CONSUMER_POLICIES
+from rdtp.rdtp_server import HANDLER_THREADS
+from rdtp.rdtp_server import IDLE_TIMEOUT
+from rdtp import rdtp_workers
+from chat import chat_log
+from chat import chat_db
 
 def usage():
     """
     Simple usage function that is printed when the command line arguments
     are not valid.
     """
-    print "Usage: python server.py <REST|RDTP>"
+    print "Usage: python server.py <REST|RDTP> [--slow-consumers <{}>] [--workers N] [--threads N] [--idle-timeout SECONDS]".format('|'.join(SLOW_CONSUMER_POLICIES)),
+    print "[--log-level <{}>] [--log-sample N] [--presence-snapshot FILE]".format('|'.join(sorted(chat_log.LEVELS))),
+    print "[--db <{}>] [--db-path FILE]".format('|'.join(chat_db.BACKENDS))
     exit()
 
+def parse_options(args):
+    """
+    Parses the optional command line arguments, which come in
+    --name value pairs.
+
+    :param args: The command line arguments after the server type
+
+    :return: A dictionary of option values, by name (without the dashes)
+    """
+    if len(args) % 2 != 0:
+        usage()
+
+    options = {}
+    for name, value in zip(args[::2], args[1::2]):
+        if not name.startswith('--'):
+            usage()
+        options[name[2:]] = value
+    return options
+
 def main():
     """
     Main routine of the program. By default, uses localhost and port 9999.
@@ -18,18 +44,60 @@ def main():
     arguments, and starts up the appropriate chat_server according to
     user input.
 
-    Assumes that there is a single command line argument, which is simply 
-    REST or RDTP.
+    The first command line argument is simply REST or RDTP. RDTP servers
+    also take --slow-consumers, the policy for clients that do not read
+    their messages fast enough (see rdtp_server), --workers, the number
+    of processes to serve from (see rdtp_workers), and --threads, the number
+    of threads per process for the requests that wait on the database
+    (see rdtp_pool), and --idle-timeout, the seconds after which quiet
+    clients are disconnected and logged out (0 for never).
+
+    Both servers take --log-level, the lowest level of the events logged,
+    and --log-sample, to log one of every N per-request and per-message
+    events when logging at the debug level (see chat_log), and
+    --presence-snapshot, a file to keep who is online in across restarts
+    (see chat_presence), and --db, the storage backend, with --db-path, the
+    database file of the sqlite backend (see chat_db.open_chat_db). The
+    memory backend keeps its data in the process, so it cannot be shared by
+    several workers.
     """
     HOST, PORT = "localhost", 9999
 
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2:
+        usage()
+    options = parse_options(sys.argv[2:])
+
+    level = options.get('log-level', chat_log.DEFAULT_LEVEL)
+    if level not in chat_log.LEVELS:
+        usage()
+    chat_log.configure(level, int(options.get('log-sample', chat_log.DEFAULT_SAMPLE)))
+    presence_snapshot = options.get('presence-snapshot')
+    db_backend = options.get('db', chat_db.DEFAULT_BACKEND)
+    if db_backend not in chat_db.BACKENDS:
         usage()
+    db_path = options.get('db-path')
 
     if sys.argv[1].upper() == 'REST':
-        chat_server = RESTServer(HOST, PORT)
+        # Imported here, so that RDTP servers run without Flask
+        from rest.rest_server import RESTServer
+        chat_server = RESTServer(HOST, PORT, presence_snapshot, db_backend, db_path)
     elif sys.argv[1].upper() == 'RDTP':
-        chat_server = RDTPServer(HOST, PORT)
+        policy = options.get('slow-consumers', 'spill')
+        if policy not in SLOW_CONSUMER_POLICIES:
+            usage()
+        workers = int(options.get('workers', '1'))
+        threads = int(options.get('threads', HANDLER_THREADS))
+        idle_timeout = float(options.get('idle-timeout', IDLE_TIMEOUT))
+        if workers > 1:
+            if db_backend == chat_db.BACKEND_MEMORY:
+                usage()
+            rdtp_workers.serve_forever(HOST, PORT, workers, slow_consumer_policy=policy, threads=threads,
+                                       idle_timeout=idle_timeout, presence_snapshot=presence_snapshot,
+                                       db_backend=db_backend, db_path=db_path)
+            return
+        chat_server = RDTPServer(HOST, PORT, slow_consumer_policy=policy, threads=threads,
+                                 idle_timeout=idle_timeout, presence_snapshot=presence_snapshot,
+                                 db_backend=db_backend, db_path=db_path)
     else:
         usage()
 
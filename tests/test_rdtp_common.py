@@ -0,0 +1,175 @@
+"""
+Round trips through the RDTP framing of rdtp_common.
+
+Run from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import struct
+import unittest
+
+from rdtp import rdtp_common
+from rdtp.rdtp_common import FIELD_LONG
+from rdtp.rdtp_common import FrameDecoder
+from rdtp.rdtp_common import MalformedFrame
+from rdtp.rdtp_common import decode_fields
+from rdtp.rdtp_common import encode_field
+from rdtp.rdtp_common import encode_frame
+
+def wire(frame):
+    """
+    The bytes of a frame built by encode_frame.
+    """
+    return str(bytearray().join(frame))
+
+def encode_fields(args):
+    """
+    The fields of a list of arguments, back to back, as a bytearray.
+    """
+    return bytearray().join(segment for arg in args for segment in encode_field(arg))
+
+class FieldTest(unittest.TestCase):
+
+    def round_trip(self, args):
+        buf = encode_fields(args)
+        return decode_fields(buf, 0, len(buf))
+
+    def test_str(self):
+        self.assertEqual(self.round_trip(['alice', '', 'hey']), ['alice', '', 'hey'])
+
+    def test_unicode_is_sent_as_utf8(self):
+        self.assertEqual(self.round_trip([u'caf\xe9']), [u'caf\xe9'.encode('utf-8')])
+
+    def test_bytes(self):
+        value = bytearray('\x00\xff:\n')
+        args = self.round_trip([value])
+        self.assertEqual(args, [value])
+        self.assertIsInstance(args[0], bytearray)
+
+    def test_int(self):
+        self.assertEqual(self.round_trip([0, -1, 2 ** 40]), [0, -1, 2 ** 40])
+
+    def test_colons(self):
+        self.assertEqual(self.round_trip(['a:b', ':', 'c']), ['a:b', ':', 'c'])
+
+    def test_short_and_long_lengths(self):
+        for length in (FIELD_LONG - 1, FIELD_LONG, 70000):
+            header, value = encode_field('x' * length)
+            self.assertEqual(len(header), 2 if length < FIELD_LONG else 6)
+            self.assertEqual(self.round_trip(['x' * length, 'y']), ['x' * length, 'y'])
+
+    def test_unsupported_type(self):
+        self.assertRaises(TypeError, encode_field, 1.5)
+
+    def test_truncated_header(self):
+        buf = encode_fields(['alice'])
+        self.assertRaises(MalformedFrame, decode_fields, buf, 0, 1)
+
+    def test_truncated_long_header(self):
+        buf = encode_fields(['x' * 300])
+        self.assertRaises(MalformedFrame, decode_fields, buf, 0, 4)
+
+    def test_truncated_value(self):
+        buf = encode_fields(['alice'])
+        self.assertRaises(MalformedFrame, decode_fields, buf, 0, len(buf) - 1)
+
+    def test_oversized_length(self):
+        buf = bytearray(chr(rdtp_common.FIELD_STR) + chr(FIELD_LONG) + struct.pack('!I', 0xFFFFFFFF) + 'x')
+        self.assertRaises(MalformedFrame, decode_fields, buf, 0, len(buf))
+
+    def test_bad_int(self):
+        buf = bytearray(chr(rdtp_common.FIELD_INT) + chr(3) + 'abc')
+        self.assertRaises(MalformedFrame, decode_fields, buf, 0, len(buf))
+
+    def test_unknown_type(self):
+        buf = bytearray(chr(0x7F) + chr(1) + 'a')
+        self.assertRaises(MalformedFrame, decode_fields, buf, 0, len(buf))
+
+class FrameTest(unittest.TestCase):
+
+    def decode(self, data):
+        decoder = FrameDecoder()
+        decoder.feed(data)
+        return decoder.frames()
+
+    def test_strings(self):
+        frame = encode_frame('send_user', 0, ['token', 'bob', 'hey'])
+        self.assertEqual(self.decode(wire(frame)), [('send_user', 0, ['token', 'bob', 'hey'], None)])
+
+    def test_colons_without_fields_split(self):
+        frame = encode_frame('send_user', 0, ['token', 'bob', 'a:b'])
+        self.assertEqual(self.decode(wire(frame))[0][2], ['token', 'bob', 'a', 'b'])
+
+    def test_fields(self):
+        args = ['token', 'a:b', bytearray('\x00\x01'), 42]
+        frame = encode_frame('send_user', 0, args, opcodes=True, fields=True, request_id=7)
+        self.assertEqual(self.decode(wire(frame)), [('send_user', 0, args, 7)])
+
+    def test_version_1(self):
+        frame = encode_frame('R', 2, ['x', 'y'], rdtp_common.RDTP_VERSION_1)
+        self.assertEqual(self.decode(wire(frame)), [('R', 2, ['x', 'y'], None)])
+
+    def test_compressed(self):
+        encoder = rdtp_common.FrameEncoder()
+        encoder.fields = True
+        encoder.compress()
+        decoder = FrameDecoder()
+        for i in range(3):
+            args = ['message {} '.format(i) * 100, 'a:b']
+            decoder.feed(wire(encoder.encode('R', 0, args)))
+            self.assertEqual(decoder.frames(), [('R', 0, args, None)])
+
+    def test_inflated_size_limit(self):
+        encoder = rdtp_common.FrameEncoder()
+        encoder.compress()
+        frame = encoder.encode('R', 0, ['x' * 100000])
+        self.assertLess(len(wire(frame)), 1000)
+        decoder = FrameDecoder(max_frame_size=10000)
+        decoder.feed(wire(frame))
+        self.assertRaises(MalformedFrame, decoder.frames)
+
+    def test_only_compressed_frames_are_marked(self):
+        encoder = rdtp_common.FrameEncoder()
+        encoder.compress()
+        self.assertFalse(rdtp_common.is_compressed(encoder.encode('M', 0, ['short'])))
+        self.assertTrue(rdtp_common.is_compressed(encoder.encode('M', 0, ['x' * rdtp_common.COMPRESS_THRESHOLD])))
+        self.assertFalse(rdtp_common.is_compressed(encode_frame('M', 0, ['short'], rdtp_common.RDTP_VERSION_1)))
+
+    def test_partial_frames(self):
+        data = wire(encode_frame('R', 0, ['one'], fields=True)) + wire(encode_frame('R', 1, ['two'], fields=True))
+        decoder = FrameDecoder()
+        frames = []
+        for byte in data:
+            decoder.feed(byte)
+            frames.extend(decoder.frames())
+        self.assertEqual(frames, [('R', 0, ['one'], None), ('R', 1, ['two'], None)])
+
+    def test_bad_magic(self):
+        self.assertRaises(MalformedFrame, self.decode, '\x00\x02' + '\x00' * 10)
+
+    def test_unknown_version(self):
+        self.assertRaises(MalformedFrame, self.decode, chr(rdtp_common.RDTP_MAGIC) + '\x09' + '\x00' * 10)
+
+    def test_oversized_frame_is_refused_from_its_header(self):
+        # Only the header of a frame claiming 4 GB, which must not be waited for
+        header = rdtp_common.pack_header(rdtp_common.RDTP_VERSION_2, 0, 0, 1, rdtp_common.MSG_LEN_MAX)
+        self.assertRaises(MalformedFrame, self.decode, header + 'R')
+
+    def test_frame_size_limit(self):
+        data = wire(encode_frame('R', 0, ['x' * 100]))
+        decoder = FrameDecoder(max_frame_size=101)
+        decoder.feed(data)
+        self.assertEqual(decoder.frames(), [('R', 0, ['x' * 100], None)])
+        decoder = FrameDecoder(max_frame_size=100)
+        decoder.feed(data)
+        self.assertRaises(MalformedFrame, decoder.frames)
+
+    def test_truncated_field_in_frame(self):
+        data = bytearray(wire(encode_frame('R', 0, ['alice'], fields=True)))
+        # One byte more in the field length than the message holds
+        data[-len('alice') - 1] += 1
+        self.assertRaises(MalformedFrame, self.decode, str(data))
+
+if __name__ == '__main__':
+    unittest.main()